@@ -0,0 +1,367 @@
+#
+# backup / restore benchmark against a local s3 stand-in
+#
+# generates a synthetic tree, then runs doBackup and doRestore with
+# encryption off and on against bench/fake_s3.py on loopback.  each run
+# executes in a freshly exec'd python process so its peak RSS is its own.
+# results (files/s, MB/s, request counts, peak RSS) are printed and
+# appended as json lines to --out, tagged with the current git commit, so
+# runs on different commits can be compared with --compare.
+#
+#   python bench/bench.py --profile mixed --files 2000 --workers 4
+#   python bench/bench.py --compare results-old.jsonl
+#
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import logging
+import tempfile
+import platform
+import subprocess
+import configparser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SRC_DIR = os.path.join(REPO_DIR, "src")
+
+KB = 1024
+MB = 1024 * 1024
+
+# file size distributions - (share of files, min bytes, max bytes)
+PROFILES = {
+    "small": [(1.0, 1 * KB, 64 * KB)],
+    "mixed": [(0.80, 1 * KB, 64 * KB), (0.18, 64 * KB, 4 * MB), (0.02, 8 * MB, 48 * MB)],
+    "large": [(1.0, 64 * MB, 256 * MB)],
+}
+
+
+#
+# parse a size distribution - a profile name or "share:min-max,..." in KB
+#
+def parseProfile(spec):
+    if (spec in PROFILES):
+        return PROFILES[spec]
+    buckets = list()
+    for part in spec.split(","):
+        share, sizes = part.split(":")
+        lo, hi = sizes.split("-")
+        buckets.append((float(share), int(lo) * KB, int(hi) * KB))
+    return buckets
+
+
+#
+# write a reproducible tree of fileCount files under root.  textRatio of
+# the files hold compressible text, the rest random bytes.
+#
+def generateTree(root, profile, fileCount, seed, textRatio):
+    rnd = random.Random(seed)
+    shares = [b[0] for b in profile]
+    words = [b"backup", b"restore", b"object", b"bucket", b"2024-01-01", b"INFO", b"ERROR", b"\n"]
+    corpus = b" ".join(rnd.choice(words) for w in range(2 * MB // 6))
+    total = 0
+    for i in range(fileCount):
+        share, lo, hi = rnd.choices(profile, weights=shares)[0]
+        size = rnd.randint(lo, hi)
+        d = os.path.join(root, "d{:03d}".format(i % 97), "s{:02d}".format(i % 13))
+        os.makedirs(d, exist_ok=True)
+        with open(os.path.join(d, "f{:07d}.dat".format(i)), 'wb') as f:
+            left = size
+            text = (rnd.random() < textRatio)
+            while (left > 0):
+                n = min(left, MB)
+                if (text):
+                    offset = rnd.randrange(len(corpus) - n)
+                    block = corpus[offset:offset + n]
+                else:
+                    block = rnd.getrandbits(n * 8).to_bytes(n, "little")
+                f.write(block)
+                left -= n
+        total += size
+    return total
+
+
+#
+# sha256 of every file under root, keyed by relative path
+#
+def treeDigest(root):
+    digests = dict()
+    for r, d, f in os.walk(root):
+        for file in f:
+            path = os.path.join(r, file)
+            h = hashlib.sha256()
+            with open(path, 'rb') as fh:
+                for block in iter(lambda: fh.read(MB), b""):
+                    h.update(block)
+            digests[os.path.relpath(path, root)] = h.hexdigest()
+    return digests
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return ""
+
+
+#
+# config for the client pointing at the local stand-in
+#
+def benchConfig(port, workDir, settings):
+    config = configparser.ConfigParser()
+    config.read(os.path.join(REPO_DIR, "config", "bkup.conf"))
+    config["DEFAULT"]["file.encryption_password"] = "benchpassword"
+    config["LOG"]["log.report_interval"] = "1000000"
+    config["S3"]["s3.server"] = "127.0.0.1:{}".format(port)
+    config["S3"]["s3.access_key"] = "bench"
+    config["S3"]["s3.secret_key"] = "benchsecret"
+    config["S3"]["s3.ssl_cacert"] = ""
+    config["S3"]["s3.bucket_name"] = "bench"
+    config["S3"]["s3.secure"] = "false"
+    # every file the client writes stays in workDir - an object index,
+    # checkpoint or manifest of an earlier run would not match the emptied
+    # stand-in bucket
+    config["LOG"]["log.metrics_jsonl"] = os.path.join(workDir, "state", "metrics.jsonl")
+    config["LOG"]["log.metrics_textfile_dir"] = ""
+    config["LOG"]["log.failure_report_dir"] = os.path.join(workDir, "state", "logs")
+    config["S3"]["s3.object_index_dir"] = os.path.join(workDir, "state", "index")
+    config["BACKUP"]["backup.manifest_dir"] = os.path.join(workDir, "state", "manifests")
+    config["BACKUP"]["backup.checkpoint_dir"] = os.path.join(workDir, "state", "checkpoints")
+    config["BACKUP"]["backup.crypto_spool_dir"] = os.path.join(workDir, "state", "spool")
+    for key, value in settings.items():
+        section = key.split(".")[0].upper()
+        if (section not in config):
+            section = "BACKUP"
+        config[section][key] = value
+    return config
+
+
+#
+# one backup or restore run - executed in a fresh python process started
+# by childRun, which passes args and reads the result through json files
+#
+def runPhase(phase, argsPath):
+    sys.path.insert(0, SRC_DIR)
+    import backup_util
+    from multiprocessing import Queue
+
+    with open(argsPath) as f:
+        args = json.load(f)
+    logger = logging.getLogger("bench")
+    logging.basicConfig(level=logging.ERROR)
+    config = configparser.ConfigParser()
+    config.read_dict(args["config"])
+
+    start = time.perf_counter()
+    if (phase == "backup"):
+        backup_util.doBackup(args["source"], "bench", Queue(), config, logger, False,
+                1 if args["encrypt"] else 0, "", args["mode"], args["workers"])
+    else:
+        backup_util.doRestore(args["target"], args["folder"], Queue(), config, logger, False, "",
+                args["workers"])
+    seconds = time.perf_counter() - start
+
+    with open(argsPath + ".result", 'w') as f:
+        json.dump({"seconds": seconds, "peak_rss_mb": peakRss()}, f)
+
+
+#
+# peak rss of this process in MB - VmHWM starts over at exec, so it only
+# covers the phase.  ru_maxrss where there is no /proc
+#
+def peakRss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if (line.startswith("VmHWM:")):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    import resource
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+#
+# run a phase in a newly exec'd interpreter - a forked / spawned child
+# would report the peak rss of the parent as well
+#
+def childRun(phase, args, workDir):
+    argsPath = os.path.join(workDir, "phase-args.json")
+    with open(argsPath, 'w') as f:
+        json.dump(args, f)
+    try:
+        subprocess.run([sys.executable, os.path.abspath(__file__), "--phase", phase,
+                        "--phase-args", argsPath], check=True)
+        with open(argsPath + ".result") as f:
+            return json.load(f)
+    finally:
+        for path in (argsPath, argsPath + ".result"):
+            if (os.path.exists(path)):
+                os.remove(path)
+
+
+#
+# folder the restore phase reads - in snapshot mode the snapshot the backup
+# phase just wrote under bench/, which sorts last
+#
+def restoreFolder(server, mode):
+    if (mode != "snapshot"):
+        return "bench"
+    snapshots = set(name.split("/")[1] for name in server.store.buckets.get("bench", {})
+                    if name.startswith("bench/snap-"))
+    if (len(snapshots) == 0):
+        return "bench"
+    return "bench/" + max(snapshots)
+
+
+def runScenario(opts, server, workDir, source, fileCount, totalBytes):
+    commit = gitCommit()
+    settings = dict(kv.split("=", 1) for kv in opts.set)
+    config = benchConfig(server.server_address[1], workDir, settings)
+    configDict = {s: dict(config[s]) for s in config.sections()}
+    configDict["DEFAULT"] = dict(config["DEFAULT"])
+    records = list()
+    sourceDigest = treeDigest(source)
+
+    for encrypt in opts.encrypt:
+        server.store.buckets.clear()
+        target = os.path.join(workDir, "restore")
+        shutil.rmtree(target, ignore_errors=True)
+        shutil.rmtree(os.path.join(workDir, "state"), ignore_errors=True)
+        args = {"config": configDict, "source": source, "target": target, "encrypt": encrypt,
+                "mode": opts.mode, "workers": opts.workers}
+
+        for phase in ("backup", "restore"):
+            if (phase == "restore"):
+                args["folder"] = restoreFolder(server, opts.mode)
+            server.store.resetCounts()
+            result = childRun(phase, args, workDir)
+            requests = server.store.counts()
+            record = {
+                "commit": commit,
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "host": platform.node(),
+                "python": platform.python_version(),
+                "scenario": opts.name or "{}-{}".format(opts.profile, fileCount),
+                "phase": phase,
+                "encrypt": encrypt,
+                "mode": opts.mode,
+                "workers": opts.workers,
+                "settings": settings,
+                "files": fileCount,
+                "bytes": totalBytes,
+                "seconds": round(result["seconds"], 3),
+                "files_per_s": round(fileCount / result["seconds"], 1),
+                "mb_per_s": round(totalBytes / MB / result["seconds"], 2),
+                "requests": requests,
+                "request_total": sum(requests.values()),
+                "peak_rss_mb": result["peak_rss_mb"],
+            }
+            if (phase == "backup"):
+                record["stored_bytes"] = server.store.storedBytes()
+            else:
+                restored = treeDigest(os.path.join(target, args["folder"]))
+                record["verified"] = (restored == sourceDigest)
+            records.append(record)
+            printRecord(record)
+    return records
+
+
+def printRecord(r):
+    print("{:<8} encrypt={:<5} {:>8.2f}s {:>9.1f} files/s {:>8.2f} MB/s {:>7} requests {:>8.1f} MB rss{}".format(
+            r["phase"], str(r["encrypt"]), r["seconds"], r["files_per_s"], r["mb_per_s"],
+            r["request_total"], r["peak_rss_mb"],
+            "" if r.get("verified", True) else "  RESTORE MISMATCH"))
+
+
+#
+# compare the latest results of two commits in a results file
+#
+def compare(path, base, head):
+    runs = [json.loads(line) for line in open(path) if line.strip()]
+    commits = list(dict.fromkeys(r["commit"] for r in runs))
+    if (len(commits) < 2 and not (base and head)):
+        print("need results from two commits to compare")
+        return
+    base = base or commits[-2]
+    head = head or commits[-1]
+
+    def latest(commit):
+        out = dict()
+        for r in runs:
+            if (r["commit"] == commit):
+                out[(r["scenario"], r["phase"], r["encrypt"])] = r
+        return out
+
+    old = latest(base)
+    new = latest(head)
+    print("{} -> {}".format(base, head))
+    for key in sorted(set(old) & set(new), key=str):
+        o = old[key]
+        n = new[key]
+        print("{:<20} {:<8} encrypt={:<5} MB/s {:>8.2f} -> {:>8.2f} ({:+.0%})  requests {:>7} -> {:>7}  rss {:>7.1f} -> {:>7.1f}".format(
+                key[0], key[1], str(key[2]), o["mb_per_s"], n["mb_per_s"],
+                n["mb_per_s"] / o["mb_per_s"] - 1 if o["mb_per_s"] else 0,
+                o["request_total"], n["request_total"], o["peak_rss_mb"], n["peak_rss_mb"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="backup / restore benchmark against a local s3 stand-in")
+    parser.add_argument("--profile", default="mixed",
+            help="size distribution: {} or share:minKB-maxKB,...".format("/".join(PROFILES)))
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--text-ratio", type=float, default=0.5, help="share of compressible files")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--mode", default="full")
+    parser.add_argument("--encrypt", default="off,on", help="off, on or off,on")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+            help="override a config setting (backup.*, restore.*, s3.*, log.*)")
+    parser.add_argument("--name", default="", help="scenario name in the results")
+    parser.add_argument("--work-dir", default="", help="where to build the tree (default: a temp dir)")
+    parser.add_argument("--out", default=os.path.join(BENCH_DIR, "results.jsonl"))
+    parser.add_argument("--compare", metavar="RESULTS", help="compare two commits in a results file and exit")
+    parser.add_argument("--base", default="")
+    parser.add_argument("--head", default="")
+    parser.add_argument("--phase", help=argparse.SUPPRESS)
+    parser.add_argument("--phase-args", help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+
+    if (opts.phase):
+        runPhase(opts.phase, opts.phase_args)
+        return
+    if (opts.compare):
+        compare(opts.compare, opts.base, opts.head)
+        return
+    opts.encrypt = [e.strip() == "on" for e in opts.encrypt.split(",")]
+
+    sys.path.insert(0, BENCH_DIR)
+    import fake_s3
+
+    workDir = opts.work_dir or tempfile.mkdtemp(prefix="s3bench-")
+    source = os.path.join(workDir, "source")
+    try:
+        shutil.rmtree(source, ignore_errors=True)
+        totalBytes = generateTree(source, parseProfile(opts.profile), opts.files, opts.seed, opts.text_ratio)
+        print("tree: {} files, {:.1f} MB".format(opts.files, totalBytes / MB))
+
+        server = fake_s3.start()
+        records = runScenario(opts, server, workDir, source, opts.files, totalBytes)
+        server.shutdown()
+
+        with open(opts.out, 'a') as f:
+            for r in records:
+                f.write(json.dumps(r, sort_keys=True) + "\n")
+        print("results appended to {}".format(opts.out))
+    finally:
+        if (not opts.work_dir):
+            shutil.rmtree(workDir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+#
+# in-memory s3 stand-in for benchmarks.  serves the subset of the s3 api
+# the backup client uses (buckets, list v1/v2, put / get / ranged get /
+# head / delete, multi-object delete, multipart uploads, server side copy)
+# over plain http on loopback.  requests are counted per http method.
+# signatures are not checked.
+#
+import time
+import uuid
+import hashlib
+import threading
+import xml.etree.ElementTree as ET
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+from xml.sax.saxutils import escape
+
+NS = "http://s3.amazonaws.com/doc/2006-03-01/"
+META_PREFIX = "x-amz-meta-"
+
+
+#
+# objects, in progress multipart uploads and request counters
+#
+class Store:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = dict()
+        self.uploads = dict()
+        self.requests = dict()
+
+    def resetCounts(self):
+        with self.lock:
+            self.requests = dict()
+
+    def counts(self):
+        with self.lock:
+            return dict(self.requests)
+
+    def storedBytes(self):
+        with self.lock:
+            return sum(len(o["data"]) for objs in self.buckets.values() for o in objs.values())
+
+
+def _now():
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
+
+
+def _xml(root, inner):
+    return '<?xml version="1.0" encoding="UTF-8"?><{0} xmlns="{1}">{2}</{0}>'.format(root, NS, inner)
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=b"", headers=None):
+        if isinstance(body, str):
+            body = body.encode("utf8")
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if (self.command != "HEAD"):
+            self.wfile.write(body)
+
+    def _error(self, status, code):
+        self._send(status, '<?xml version="1.0" encoding="UTF-8"?><Error><Code>{0}</Code>'
+                           '<Message>{0}</Message></Error>'.format(code))
+
+    def _body(self):
+        n = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(n) if n else b""
+
+    def _meta(self):
+        return {k[len(META_PREFIX):]: v for k, v in self.headers.items()
+                if k.lower().startswith(META_PREFIX)}
+
+    def handle_request(self):
+        store = self.server.store
+        url = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query, keep_blank_values=True).items()}
+        parts = url.path.lstrip("/").split("/", 1)
+        bucket = unquote(parts[0]) if parts[0] else None
+        key = unquote(parts[1]) if len(parts) > 1 and parts[1] else None
+
+        with store.lock:
+            store.requests[self.command] = store.requests.get(self.command, 0) + 1
+        body = self._body() if self.command in ("PUT", "POST") else b""
+
+        if (bucket is None):
+            return self._listBuckets(store)
+        with store.lock:
+            objs = store.buckets.setdefault(bucket, dict())
+        if (key is None):
+            return self._bucketRequest(store, bucket, objs, query, body)
+        return self._objectRequest(store, bucket, objs, key, query, body)
+
+    do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = handle_request
+
+    def _listBuckets(self, store):
+        inner = "".join("<Bucket><Name>{}</Name><CreationDate>2020-01-01T00:00:00.000Z</CreationDate>"
+                        "</Bucket>".format(b) for b in store.buckets)
+        return self._send(200, _xml("ListAllMyBucketsResult", "<Buckets>" + inner + "</Buckets>"))
+
+    def _bucketRequest(self, store, bucket, objs, query, body):
+        if ("location" in query):
+            return self._send(200, _xml("LocationConstraint", ""))
+        if (self.command == "PUT"):
+            return self._send(200)
+        if (self.command == "POST" and "delete" in query):
+            with store.lock:
+                for e in ET.fromstring(body).iter():
+                    if e.tag.endswith("Key"):
+                        objs.pop(e.text, None)
+            return self._send(200, _xml("DeleteResult", ""))
+        if ("uploads" in query):
+            prefix = query.get("prefix", "")
+            with store.lock:
+                uploads = [(uid, u) for uid, u in store.uploads.items() if u["key"].startswith(prefix)]
+            inner = "<Bucket>{}</Bucket><IsTruncated>false</IsTruncated>".format(bucket)
+            inner += "".join("<Upload><Key>{}</Key><UploadId>{}</UploadId><Initiated>2020-01-01T00:00:00.000Z"
+                             "</Initiated></Upload>".format(escape(u["key"]), uid) for uid, u in uploads)
+            return self._send(200, _xml("ListMultipartUploadsResult", inner))
+        return self._listObjects(store, bucket, objs, query)
+
+    def _listObjects(self, store, bucket, objs, query):
+        prefix = query.get("prefix", "")
+        delimiter = query.get("delimiter", "")
+        maxKeys = int(query.get("max-keys", "1000"))
+        marker = query.get("marker") or query.get("start-after") or query.get("continuation-token") or ""
+        with store.lock:
+            keys = sorted(k for k in objs if k.startswith(prefix) and k > marker)
+
+        contents = list()
+        prefixes = list()
+        count = 0
+        last = None
+        truncated = False
+        for k in keys:
+            if (delimiter and delimiter in k[len(prefix):]):
+                p = prefix + k[len(prefix):].split(delimiter)[0] + delimiter
+                if (p not in prefixes):
+                    if (count >= maxKeys):
+                        truncated = True
+                        break
+                    prefixes.append(p)
+                    count += 1
+                    last = k
+                continue
+            if (count >= maxKeys):
+                truncated = True
+                break
+            o = objs[k]
+            meta = ""
+            if (query.get("user-metadata") == "true"):
+                meta = "<UserMetadata>" + "".join("<{0}>{1}</{0}>".format(mk, escape(mv))
+                        for mk, mv in o["meta"].items()) + "</UserMetadata>"
+            contents.append("<Contents><Key>{}</Key><LastModified>{}</LastModified><ETag>\"{}\"</ETag>"
+                            "<Size>{}</Size><StorageClass>STANDARD</StorageClass>{}</Contents>".format(
+                            escape(k), o["lm"], o["etag"], len(o["data"]), meta))
+            count += 1
+            last = k
+
+        inner = "<Name>{}</Name><Prefix>{}</Prefix><IsTruncated>{}</IsTruncated>".format(
+                bucket, escape(prefix), "true" if truncated else "false")
+        if (truncated):
+            inner += "<NextMarker>{0}</NextMarker><NextContinuationToken>{0}</NextContinuationToken>".format(escape(last))
+        inner += "".join(contents)
+        inner += "".join("<CommonPrefixes><Prefix>{}</Prefix></CommonPrefixes>".format(escape(p)) for p in prefixes)
+        return self._send(200, _xml("ListBucketResult", inner))
+
+    def _objectRequest(self, store, bucket, objs, key, query, body):
+        m = self.command
+        if (m == "POST" and "uploads" in query):
+            uid = uuid.uuid4().hex
+            with store.lock:
+                store.uploads[uid] = {"key": key, "parts": dict(), "meta": self._meta()}
+            return self._send(200, _xml("InitiateMultipartUploadResult",
+                    "<Bucket>{}</Bucket><Key>{}</Key><UploadId>{}</UploadId>".format(bucket, escape(key), uid)))
+        if ("uploadId" in query):
+            return self._multipartRequest(store, bucket, objs, key, query, body)
+        if (m == "PUT" and self.headers.get("x-amz-copy-source")):
+            return self._copyObject(store, objs, key)
+        if (m == "PUT"):
+            etag = hashlib.md5(body).hexdigest()
+            with store.lock:
+                objs[key] = {"data": body, "etag": etag, "meta": self._meta(), "lm": _now()}
+            return self._send(200, headers={"ETag": '"{}"'.format(etag)})
+        if (m == "DELETE"):
+            with store.lock:
+                objs.pop(key, None)
+            return self._send(204)
+
+        with store.lock:
+            o = objs.get(key)
+        if (o is None):
+            return self._send(404) if m == "HEAD" else self._error(404, "NoSuchKey")
+        data = o["data"]
+        headers = {"ETag": '"{}"'.format(o["etag"]), "Last-Modified": "Wed, 01 Jan 2020 00:00:00 GMT"}
+        for k, v in o["meta"].items():
+            headers[META_PREFIX + k] = v
+        if (m == "HEAD"):
+            self.send_response(200)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            return
+
+        status = 200
+        rng = self.headers.get("Range")
+        if (rng):
+            start, end = rng.split("=")[1].split("-")
+            end = int(end) if end else len(data) - 1
+            data = data[int(start):end + 1]
+            status = 206
+        return self._send(status, data, headers)
+
+    def _multipartRequest(self, store, bucket, objs, key, query, body):
+        uid = query["uploadId"]
+        with store.lock:
+            upload = store.uploads.get(uid)
+        if (upload is None):
+            return self._error(404, "NoSuchUpload")
+
+        if (self.command == "PUT" and self.headers.get("x-amz-copy-source")):
+            o = self._copySource(store)
+            if (o is None):
+                return self._error(404, "NoSuchKey")
+            data = o["data"]
+            rng = self.headers.get("x-amz-copy-source-range")
+            if (rng):
+                start, end = rng.split("=")[1].split("-")
+                data = data[int(start):int(end) + 1]
+            etag = hashlib.md5(data).hexdigest()
+            upload["parts"][int(query["partNumber"])] = (data, etag)
+            return self._send(200, _xml("CopyPartResult", "<ETag>\"{}\"</ETag>"
+                    "<LastModified>2020-01-01T00:00:00.000Z</LastModified>".format(etag)))
+        if (self.command == "PUT"):
+            etag = hashlib.md5(body).hexdigest()
+            upload["parts"][int(query["partNumber"])] = (body, etag)
+            return self._send(200, headers={"ETag": '"{}"'.format(etag)})
+        if (self.command == "GET"):
+            inner = "<Bucket>{}</Bucket><Key>{}</Key><UploadId>{}</UploadId><IsTruncated>false</IsTruncated>".format(
+                    bucket, escape(key), uid)
+            inner += "".join("<Part><PartNumber>{}</PartNumber><LastModified>2020-01-01T00:00:00.000Z</LastModified>"
+                             "<ETag>\"{}\"</ETag><Size>{}</Size></Part>".format(n, p[1], len(p[0]))
+                             for n, p in sorted(upload["parts"].items()))
+            return self._send(200, _xml("ListPartsResult", inner))
+        if (self.command == "DELETE"):
+            with store.lock:
+                store.uploads.pop(uid, None)
+            return self._send(204)
+
+        # complete
+        numbers = [int(e.text) for e in ET.fromstring(body).iter() if e.tag.endswith("PartNumber")]
+        data = b"".join(upload["parts"][n][0] for n in numbers)
+        digests = b"".join(hashlib.md5(upload["parts"][n][0]).digest() for n in numbers)
+        etag = hashlib.md5(digests).hexdigest() + "-" + str(len(numbers))
+        with store.lock:
+            store.uploads.pop(uid, None)
+            objs[key] = {"data": data, "etag": etag, "meta": upload["meta"], "lm": _now()}
+        return self._send(200, _xml("CompleteMultipartUploadResult",
+                "<Location>{0}</Location><Bucket>{0}</Bucket><Key>{1}</Key><ETag>\"{2}\"</ETag>".format(
+                bucket, escape(key), etag)))
+
+    def _copySource(self, store):
+        source = unquote(self.headers.get("x-amz-copy-source")).lstrip("/")
+        srcBucket, srcKey = source.split("/", 1)
+        with store.lock:
+            return store.buckets.get(srcBucket, dict()).get(srcKey)
+
+    def _copyObject(self, store, objs, key):
+        o = self._copySource(store)
+        if (o is None):
+            return self._error(404, "NoSuchKey")
+        meta = o["meta"]
+        if (self.headers.get("x-amz-metadata-directive") == "REPLACE"):
+            meta = self._meta()
+        with store.lock:
+            objs[key] = {"data": o["data"], "etag": o["etag"], "meta": meta, "lm": _now()}
+        return self._send(200, _xml("CopyObjectResult", "<ETag>\"{}\"</ETag>"
+                "<LastModified>2020-01-01T00:00:00.000Z</LastModified>".format(o["etag"])))
+
+
+#
+# start a server on a free loopback port - returns it, store is server.store
+#
+def start(port=0):
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.store = Store()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,229 @@
+import time
+import random
+import threading
+import urllib3
+
+from run_metrics import CountingPoolManager
+
+# http statuses s3 uses to ask a client to slow down
+BACKOFF_STATUS = (429, 503)
+
+# parts / ranges are sized to take about this long on one connection
+PART_TARGET_SECONDS = 4.0
+
+MB = 1024 * 1024
+
+
+#
+# token bucket shared by every connection of a client - bytes beyond
+# rate per second make the caller sleep.  burst is one second of data.
+#
+class TokenBucket:
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        if (n <= 0):
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # go into debt - the caller sleeps until it is paid off, and
+            # later callers queue up behind it
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if (wait > 0):
+            time.sleep(wait)
+
+
+#
+# bytes in a request body - from its content-length when it is a stream
+#
+def bodyLength(body, headers):
+    if (body is None):
+        return 0
+    if (isinstance(body, (bytes, bytearray, memoryview))):
+        return len(body)
+    for key, value in (headers or {}).items():
+        if (key.lower() == "content-length"):
+            return int(value)
+    return 0
+
+
+#
+# counting pool manager that holds the bytes it sends and receives to a
+# token bucket.  request bodies are paid for before they are sent,
+# streamed responses as they are read.  responses the client preloads
+# (listings, stats, errors) are small and not counted.
+#
+class PacedPoolManager(CountingPoolManager):
+
+    def __init__(self, bucket, *args, **kwargs):
+        CountingPoolManager.__init__(self, *args, **kwargs)
+        self.bucket = bucket
+
+    def urlopen(self, method, url, *args, **kwargs):
+        self.bucket.consume(bodyLength(kwargs.get("body"), kwargs.get("headers")))
+
+        response = CountingPoolManager.urlopen(self, method, url, *args, **kwargs)
+        if (not kwargs.get("preload_content", True)):
+            read = response.read
+            bucket = self.bucket
+
+            def pacedRead(amt=None, *args, **kwargs):
+                data = read(amt, *args, **kwargs)
+                bucket.consume(len(data))
+                return data
+            response.read = pacedRead
+        return response
+
+
+#
+# urllib3 retry policy that reports throttling and connection errors to
+# a callback before retrying, so the controller hears about requests
+# urllib3 retries on its own.
+#
+# the wait before a retry is drawn at random between zero and the
+# exponential backoff (full jitter), capped at maxBackoff seconds - workers
+# hit by the same outage spread their retries out instead of coming back
+# all at once.  a Retry-After header from the server still wins
+#
+class BackoffRetry(urllib3.Retry):
+
+    def __init__(self, *args, onBackoff=None, maxBackoff=20, **kwargs):
+        urllib3.Retry.__init__(self, *args, **kwargs)
+        self.onBackoff = onBackoff
+        self.maxBackoff = maxBackoff
+
+    def new(self, **kw):
+        retry = urllib3.Retry.new(self, **kw)
+        retry.onBackoff = self.onBackoff
+        retry.maxBackoff = self.maxBackoff
+        return retry
+
+    def get_backoff_time(self):
+        backoff = min(self.maxBackoff, urllib3.Retry.get_backoff_time(self))
+        return random.uniform(0, backoff) if backoff > 0 else 0
+
+    def increment(self, method=None, url=None, response=None, error=None, *args, **kwargs):
+        if (self.onBackoff is not None):
+            if (error is not None or (response is not None and response.status in BACKOFF_STATUS)):
+                self.onBackoff()
+        return urllib3.Retry.increment(self, method, url, response, error, *args, **kwargs)
+
+
+#
+# AIMD concurrency limit for transfers.
+#
+# workers call acquire() before a transfer and release() after it with the
+# bytes moved.  the limit starts at start and stays between minLimit and
+# maxLimit.  every window the controller looks at what happened:
+#   - a throttle response, connection error or failed transfer halves the
+#     limit (multiplicative decrease)
+#   - otherwise, when the limit was reached and throughput still grew, the
+#     limit goes up - doubling until the first decrease (slow start), then
+#     by one (additive increase)
+#   - throughput that dropped, or latency that grew without any gain in
+#     throughput, takes one off the limit
+# the part size is picked so one part takes about PART_TARGET_SECONDS at
+# the throughput of a single connection.
+#
+class AdaptiveController:
+
+    def __init__(self, start, minLimit, maxLimit, logger, window=2.0, name="workers"):
+        self.minLimit = max(1, minLimit)
+        self.maxLimit = max(self.minLimit, maxLimit)
+        self.limit = max(self.minLimit, min(self.maxLimit, start))
+        self.logger = logger
+        self.window = window
+        self.name = name
+        self.cond = threading.Condition()
+        self.active = 0
+        self.slowStart = True
+        self.lastRate = 0.0
+        self.lastLatency = 0.0
+        self.streamRate = 0.0
+        self.resetWindow()
+
+    def resetWindow(self):
+        self.windowStart = time.monotonic()
+        self.windowBytes = 0
+        self.windowCount = 0
+        self.windowSeconds = 0.0
+        self.windowErrors = 0
+        self.windowActive = 0
+        self.saturated = False
+
+    def acquire(self):
+        with self.cond:
+            while (self.active >= self.limit):
+                self.saturated = True
+                self.cond.wait()
+            self.active += 1
+            if (self.active >= self.limit):
+                self.saturated = True
+
+    def release(self, nbytes, seconds, ok=True):
+        with self.cond:
+            self.active -= 1
+            self.windowBytes += nbytes
+            self.windowCount += 1
+            self.windowSeconds += seconds
+            self.windowActive += self.active + 1
+            if (not ok):
+                self.windowErrors += 1
+            self.adjust()
+            self.cond.notify_all()
+
+    # throttled or failed request seen by the transport - may come from any thread
+    def backoff(self):
+        with self.cond:
+            self.windowErrors += 1
+
+    def adjust(self):
+        elapsed = time.monotonic() - self.windowStart
+        if (elapsed < self.window or self.windowCount == 0):
+            return
+
+        rate = self.windowBytes / elapsed
+        latency = self.windowSeconds / self.windowCount
+        self.streamRate = rate / max(1.0, self.windowActive / self.windowCount)
+        old = self.limit
+
+        if (self.windowErrors > 0):
+            self.limit = max(self.minLimit, self.limit // 2)
+            self.slowStart = False
+        elif (self.lastRate > 0 and rate < self.lastRate * 0.8):
+            self.limit = max(self.minLimit, self.limit - 1)
+            self.slowStart = False
+        elif (self.saturated and rate >= self.lastRate * 1.05):
+            if (self.slowStart):
+                self.limit = min(self.maxLimit, self.limit * 2)
+            else:
+                self.limit = min(self.maxLimit, self.limit + 1)
+        elif (self.lastLatency > 0 and latency > self.lastLatency * 1.5 and self.limit > self.minLimit):
+            # more waiting for the same throughput - the link is queueing
+            self.limit -= 1
+            self.slowStart = False
+
+        if (self.limit != old):
+            self.logger.info("adaptive {}: [{}] -> [{}] - [{}MB/s] errors: [{}] latency: [{}s]".format(
+                    self.name, old, self.limit, round(rate / MB, 2), self.windowErrors,
+                    round(latency, 2)))
+        self.lastRate = rate
+        self.lastLatency = latency
+        self.resetWindow()
+
+    # part / range size for the throughput seen so far, between minSize and maxSize
+    def partSize(self, default, minSize, maxSize):
+        with self.cond:
+            streamRate = self.streamRate
+        if (streamRate <= 0):
+            return default
+        size = int(streamRate * PART_TARGET_SECONDS) // MB * MB
+        return max(minSize, min(maxSize, size))
@@ -0,0 +1,285 @@
+import os
+import io
+import struct
+import hashlib
+import threading
+import pyAesCrypt                       # older objects use the aes crypt format
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+#
+# chunked aes-256-gcm encryption format (version 1)
+#
+#   header   magic "S3AEAD", version, kdf id, chunk size, kdf iterations,
+#            kdf salt (16 bytes), file salt (16 bytes) - 48 bytes
+#   chunks   every chunkSize bytes of plaintext encrypted on its own,
+#            followed by its 16 byte gcm tag.  the last chunk may be
+#            shorter - an empty file is one empty chunk
+#
+# the password and kdf salt give a master key (pbkdf2-hmac-sha256), the
+# master key and file salt give the key of the file (hkdf-sha256).  a run
+# uses one kdf salt for all its files, so the slow pbkdf2 step runs once
+# per run instead of once per file.  chunk i is encrypted with the counter
+# i as nonce and authenticates the header, i and whether it is the last
+# chunk - chunks can not be reordered, swapped between files or cut off.
+#
+# chunks are independent, so they can be encrypted and decrypted in
+# parallel and any byte range of the plaintext can be restored from the
+# matching range of chunks.
+#
+MAGIC = b"S3AEAD"
+VERSION = 1
+KDF_PBKDF2_SHA256 = 1
+HEADER = struct.Struct(">6sBBII16s16s")
+HEADER_SIZE = HEADER.size
+TAG_SIZE = 16
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+KDF_ITERATIONS = 200000
+
+# config values for backup.encryption_format
+FORMATS = ("aescrypt", "aead")
+
+_masterKeys = dict()
+_masterLock = threading.Lock()
+
+
+#
+# raised when encrypted data is damaged, truncated or the password is wrong
+#
+class AeadError(ValueError):
+    pass
+
+
+#
+# pbkdf2 master key for a password and kdf salt - cached, since every file
+# of a run shares the same salt
+#
+def masterKey(password, salt, iterations):
+    cacheKey = (password, salt, iterations)
+    with _masterLock:
+        key = _masterKeys.get(cacheKey)
+    if (key is None):
+        key = hashlib.pbkdf2_hmac("sha256", password.encode("utf8"), salt, iterations)
+        with _masterLock:
+            _masterKeys[cacheKey] = key
+    return key
+
+
+def _fileKey(master, fileSalt):
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=fileSalt,
+                info=b"s3-backup-client aead v1").derive(master)
+
+
+def _readFull(source, n):
+    buf = bytearray()
+    while (len(buf) < n):
+        data = source.read(n - len(buf))
+        if not data:
+            break
+        buf += data
+    return bytes(buf)
+
+
+#
+# the key of one encrypted file - encrypts and decrypts its chunks by index
+#
+class FileCipher:
+
+    def __init__(self, header, key, chunkSize):
+        self.header = header
+        self.aead = AESGCM(key)
+        self.chunkSize = chunkSize
+
+    def _aad(self, index, last):
+        return self.header + struct.pack(">Q?", index, last)
+
+    def encryptChunk(self, index, data, last):
+        return self.aead.encrypt(struct.pack(">4xQ", index), bytes(data), self._aad(index, last))
+
+    def decryptChunk(self, index, data, last):
+        try:
+            return self.aead.decrypt(struct.pack(">4xQ", index), bytes(data), self._aad(index, last))
+        except InvalidTag:
+            raise AeadError("chunk {} failed authentication - wrong password or damaged data".format(index))
+
+
+#
+# encryption key for one run - derives the master key once and gives every
+# file its own salt.  small and picklable, so it can be handed to the
+# crypto pool processes
+#
+class EncryptionKey:
+
+    def __init__(self, password, chunkSize=DEFAULT_CHUNK_SIZE, iterations=KDF_ITERATIONS):
+        self.chunkSize = chunkSize
+        self.iterations = iterations
+        self.salt = os.urandom(16)
+        self.master = masterKey(password, self.salt, iterations)
+
+    def newFile(self):
+        fileSalt = os.urandom(16)
+        header = HEADER.pack(MAGIC, VERSION, KDF_PBKDF2_SHA256, self.chunkSize, self.iterations,
+                             self.salt, fileSalt)
+        return FileCipher(header, _fileKey(self.master, fileSalt), self.chunkSize)
+
+    # encrypt everything read from source into sink
+    def encryptStream(self, source, sink):
+        cipher = self.newFile()
+        sink.write(cipher.header)
+        index = 0
+        data = _readFull(source, self.chunkSize)
+        while True:
+            # read one chunk ahead to know which chunk is the last
+            following = _readFull(source, self.chunkSize) if len(data) == self.chunkSize else b""
+            last = (len(following) == 0)
+            sink.write(cipher.encryptChunk(index, data, last))
+            if (last):
+                break
+            data = following
+            index += 1
+
+    def encryptBytes(self, data):
+        out = io.BytesIO()
+        self.encryptStream(io.BytesIO(data), out)
+        return out.getvalue()
+
+
+#
+# file cipher for an encrypted header and the password
+#
+def openHeader(header, password):
+    if (len(header) < HEADER_SIZE):
+        raise AeadError("encrypted data is truncated")
+    magic, version, kdf, chunkSize, iterations, salt, fileSalt = HEADER.unpack(header[:HEADER_SIZE])
+    if (magic != MAGIC):
+        raise AeadError("not in the chunked aead format")
+    if (version != VERSION or kdf != KDF_PBKDF2_SHA256 or chunkSize <= 0):
+        raise AeadError("unsupported aead format version {}".format(version))
+    return FileCipher(header[:HEADER_SIZE], _fileKey(masterKey(password, salt, iterations), fileSalt),
+                      chunkSize)
+
+
+# number of chunks in an encrypted body of bodySize bytes
+def chunkCount(bodySize, chunkSize):
+    return max(1, -(-bodySize // (chunkSize + TAG_SIZE)))
+
+
+def encryptedSize(plainSize, chunkSize=DEFAULT_CHUNK_SIZE):
+    return HEADER_SIZE + plainSize + max(1, -(-plainSize // chunkSize)) * TAG_SIZE
+
+
+def plainSize(cipherSize, chunkSize):
+    body = cipherSize - HEADER_SIZE
+    plain = body - chunkCount(body, chunkSize) * TAG_SIZE
+    if (plain < 0):
+        raise AeadError("encrypted data is truncated")
+    return plain
+
+
+def isAead(data):
+    return data[:len(MAGIC)] == MAGIC
+
+
+#
+# decrypt inputLength bytes of the chunked format read from source into sink
+#
+def decryptStream(source, sink, password, inputLength):
+    cipher = openHeader(_readFull(source, HEADER_SIZE), password)
+    cipherChunk = cipher.chunkSize + TAG_SIZE
+    plainSize(inputLength, cipher.chunkSize)
+    count = chunkCount(inputLength - HEADER_SIZE, cipher.chunkSize)
+    for index in range(count):
+        data = _readFull(source, cipherChunk)
+        last = (index == count - 1)
+        if (len(data) < TAG_SIZE or (not last and len(data) < cipherChunk)):
+            raise AeadError("encrypted data is truncated")
+        sink.write(cipher.decryptChunk(index, data, last))
+
+
+#
+# encrypt source into sink - in the chunked aead format when key (an
+# EncryptionKey) is set, otherwise as an aes crypt stream
+#
+def encryptAny(source, sink, password, key=None):
+    if (key is not None):
+        key.encryptStream(source, sink)
+    else:
+        pyAesCrypt.encryptStream(source, sink, password, 64 * 1024)
+
+
+#
+# read() view of a stream with bytes already read from it put back in front
+#
+class PrefixedReader:
+
+    def __init__(self, prefix, source):
+        self.prefix = prefix
+        self.source = source
+
+    def read(self, n=-1):
+        if (n is None or n < 0):
+            data = self.prefix + self.source.read()
+            self.prefix = b""
+            return data
+        if (len(self.prefix) > 0):
+            data = self.prefix[:n]
+            self.prefix = self.prefix[n:]
+            if (len(data) < n):
+                data += self.source.read(n - len(data))
+            return data
+        return self.source.read(n)
+
+
+#
+# decrypt data in either format - the chunked aead format or aes crypt,
+# told apart by the first bytes
+#
+def decryptAny(source, sink, password, inputLength):
+    head = _readFull(source, len(MAGIC))
+    source = PrefixedReader(head, source)
+    if (isAead(head)):
+        decryptStream(source, sink, password, inputLength)
+    else:
+        pyAesCrypt.decryptStream(source, sink, password, 64 * 1024, inputLength)
+
+
+def decryptBytes(data, password):
+    out = io.BytesIO()
+    decryptAny(io.BytesIO(data), out, password, len(data))
+    return out.getvalue()
+
+
+#
+# decrypts the ranges of an aead object fetched by downloadRanged.  ranges
+# start after the header and are whole chunks, so each one decrypts on its
+# own and lands at its own offset in the plaintext
+#
+class RangeDecryptor:
+
+    def __init__(self, header, password, cipherSize):
+        self.cipher = openHeader(header, password)
+        self.cipherChunk = self.cipher.chunkSize + TAG_SIZE
+        self.start = HEADER_SIZE
+        self.outputSize = plainSize(cipherSize, self.cipher.chunkSize)
+        self.chunks = chunkCount(cipherSize - HEADER_SIZE, self.cipher.chunkSize)
+
+    # range size rounded down to whole chunks
+    def rangeSize(self, rangeSize):
+        return max(1, rangeSize // self.cipherChunk) * self.cipherChunk
+
+    # plaintext bytes in the encrypted range [offset, offset + length)
+    def outputLength(self, offset, length):
+        return length - (-(-length // self.cipherChunk)) * TAG_SIZE
+
+    # decrypt the range at offset - returns (plaintext offset, plaintext)
+    def decode(self, offset, data):
+        first = (offset - self.start) // self.cipherChunk
+        out = bytearray()
+        view = memoryview(data)
+        for pos in range(0, max(1, len(data)), self.cipherChunk):
+            index = first + pos // self.cipherChunk
+            out += self.cipher.decryptChunk(index, view[pos:pos + self.cipherChunk],
+                                            index == self.chunks - 1)
+        return first * self.cipher.chunkSize, bytes(out)
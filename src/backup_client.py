@@ -5,20 +5,30 @@ from tkinter import scrolledtext
 from tkinter import filedialog
 from tkinter import messagebox
 
+import multiprocessing
 from multiprocessing import Queue
 import threading
 from queue import Empty
+from collections import deque
 from decimal import Decimal, getcontext
 import os
 import sys
 import configparser                     # for parsing the config file
 import timeit                           # for timing program runtime
 import backup_util
+from progress import formatBytes, formatDuration
 import logging
 
 DELAY1 = 100
 DELAY2 = 100
 
+# queue messages handled per poll - the rest wait for the next one
+MAX_MESSAGES = 200
+
+# lines kept in the job status box and seconds between redraws of it
+LOG_LINES = 500
+LOG_REFRESH = 0.5
+
 # Queue must be global
 q = Queue()
 
@@ -89,9 +99,13 @@ class GUI(Frame):
         fTimer = Frame(self)
         lbl3 = Label(fTimer, text="Run Time: ")
         self.lbl4 = Label(fTimer, text="N/A")
+        lblProgress = Label(fTimer, text="Progress: ")
+        self.lbl5 = Label(fTimer, text="N/A")
         fTimer.grid(row=0, column=1, sticky=W, padx=20, pady=20)
         lbl3.pack(side="top")
         self.lbl4.pack(side="top")
+        lblProgress.pack(side="top")
+        self.lbl5.pack(side="top")
 
         # backup / restore radio button
         fRadio = Frame(self)
@@ -186,9 +200,17 @@ class GUI(Frame):
         self.chkboxEncrypt = Checkbutton(fchkbox, text="encrypt data",
             variable=self.doEncrypt, command=self.onCheckEncrypt)
 
+        self.workers = StringVar(fchkbox, config.get('BACKUP', 'backup.workers', fallback='4'))
+        fWorkers = Frame(fchkbox)
+        lblWorkers = Label(fWorkers, text="workers:")
+        self.entWorkers = Entry(fWorkers, width=4, textvariable=self.workers)
+
         fchkbox.grid(row=7, column=2, sticky=W, padx=10)
         self.chkboxQuitOnEnd.pack(side="top", anchor="w")
         self.chkboxEncrypt.pack(side="top", anchor="w")
+        fWorkers.pack(side="top", anchor="w")
+        lblWorkers.pack(side="left")
+        self.entWorkers.pack(side="left")
 
         # scrolled txt
         f4 = Frame(self)
@@ -213,10 +235,12 @@ class GUI(Frame):
     def onSelectRadio(self):
         # set value of lbl for inputDir
         if (self.br.get() == "restore"):
+            self.workers.set(config.get('RESTORE', 'restore.workers', fallback='8'))
             self.lbl1.config(text="Restore Directory:")
             self.backupBtn.config(state=DISABLED)
             self.restoreBtn.config(state=NORMAL)
         else:
+            self.workers.set(config.get('BACKUP', 'backup.workers', fallback='4'))
             self.lbl1.config(text="Input Directory:")
             self.backupBtn.config(state=NORMAL)
             self.restoreBtn.config(state=DISABLED)
@@ -236,13 +260,18 @@ class GUI(Frame):
             messagebox.showerror("Error", "s3Folder is empty")
             return
         
+        if (not self.workers.get().isdigit() or int(self.workers.get()) < 1):
+            messagebox.showerror("Error", "workers must be a positive number")
+            return
+
         inputDir = str(self.ent1.get())
         folder = str(self.ent2.get())
+        workers = int(self.workers.get())
         
         # start timer
         self.starttime = timeit.default_timer()
         self.backupBtn.config(state=DISABLED)
-        self.txt.delete("1.0", END)
+        self.resetProgress()
         
         useQ = True
         self.t = ThreadedBackupTask(inputDir, 
@@ -252,11 +281,9 @@ class GUI(Frame):
                     logger, 
                     useQ, 
                     self.doEncrypt.get(),
-                    self.selectedBucket.get())
+                    self.selectedBucket.get(),
+                    workers)
         self.t.start()
-        
-        # start progress bar
-        self.pbar.start(DELAY2)
 
         # look for values
         self.after(DELAY1, self.onGetValue)
@@ -277,21 +304,25 @@ class GUI(Frame):
             messagebox.showerror("Error", "s3Folder is empty")
             return
         
+        if (not self.workers.get().isdigit() or int(self.workers.get()) < 1):
+            messagebox.showerror("Error", "workers must be a positive number")
+            return
+
         inputDir = str(self.ent1.get())
         folder = str(self.ent2.get())
+        workers = int(self.workers.get())
         
         # start timer
         self.starttime = timeit.default_timer()
         self.restoreBtn.config(state=DISABLED)
         self.backupBtn.config(state=DISABLED)
-        self.txt.delete("1.0", END)
+        self.resetProgress()
         
         useQ = True
-        self.t = ThreadedRestoreTask(inputDir, folder, q, config, logger, useQ, self.selectedBucket.get())
+        self.t = ThreadedRestoreTask(inputDir, folder, q, config, logger, useQ, self.selectedBucket.get(), workers)
         self.t.start()
     
-        # start progress bar & look for values
-        self.pbar.start(DELAY2)
+        # look for values
         self.after(DELAY1, self.onGetValue)
 
     def onStop(self):
@@ -305,8 +336,63 @@ class GUI(Frame):
 
 
 
+    #
+    # clear the status box and run the progress bar until totals are known
+    #
+    def resetProgress(self):
+        self.log = deque(maxlen=LOG_LINES)
+        self.logChanged = False
+        self.logDrawn = 0
+        self.txt.delete("1.0", END)
+        self.lbl5.config(text="N/A")
+        self.pbar.stop()
+        self.pbar.config(mode='indeterminate', value=0)
+        self.pbar.start(DELAY2)
+
+    #
+    # a progress event of the running job - see progress.ProgressReporter
+    #
+    def onProgress(self, event):
+        self.log.extend(event["lines"])
+        self.logChanged = self.logChanged or len(event["lines"]) > 0
+
+        text = "{} files - {}".format(event["files"], formatBytes(event["bytes"]))
+        if (event["totalsKnown"]):
+            # switch to a determinate bar once the totals are final
+            if (str(self.pbar.cget('mode')) != 'determinate'):
+                self.pbar.stop()
+                self.pbar.config(mode='determinate', maximum=100)
+            done = 100
+            if (event["totalBytes"] > 0):
+                done = min(100, 100 * event["bytes"] / event["totalBytes"])
+            self.pbar.config(value=done)
+            text = "{} / {} files - {} / {}".format(event["files"], event["totalFiles"],
+                    formatBytes(event["bytes"]), formatBytes(event["totalBytes"]))
+        elif (event["totalFiles"] > 0):
+            text += " - scanning [{} files so far]".format(event["totalFiles"])
+        text += " - {}/s".format(formatBytes(event["rate"]))
+        if (event["eta"] is not None):
+            text += " - ETA {}".format(formatDuration(event["eta"]))
+        if (event["failed"] > 0):
+            text += " - failed: {}".format(event["failed"])
+        self.lbl5.config(text=text)
+
+    #
+    # redraw the status box from the last LOG_LINES lines - at most every
+    # LOG_REFRESH seconds, however fast lines come in
+    #
+    def drawLog(self, force=False):
+        now = timeit.default_timer()
+        if (not self.logChanged or (not force and now - self.logDrawn < LOG_REFRESH)):
+            return
+        self.txt.delete("1.0", END)
+        self.txt.insert('end', "\n".join(self.log) + "\n")
+        self.txt.yview('end')
+        self.logChanged = False
+        self.logDrawn = now
+
     # check for messages on q
-    # process msgs - increment progress bar
+    # process msgs - update progress bar and status box
     def onGetValue(self):
         # get some timing
         self.checktime = timeit.default_timer()
@@ -316,21 +402,23 @@ class GUI(Frame):
         msg = "{}m {}s".format(minutes, seconds)
         self.lbl4.config(text=msg)
 
+        # progress events arrive per interval, text messages for run steps
+        alive = self.t.is_alive()
         try:
-            while(q.qsize() > 0):
-                msg = q.get(0)
-                lines = int(self.txt.index('end').split('.')[0]) - 1
-                if (lines > 500):
-                    self.txt.delete('1.0', '2.0')
-
-                self.txt.insert('end', msg)
-                self.txt.insert('end', "\n")
-                self.txt.yview('end')
+            for i in range(MAX_MESSAGES if alive else sys.maxsize):
+                # a finished job may still have messages in the queue's pipe
+                msg = q.get_nowait() if alive else q.get(timeout=0.2)
+                if (isinstance(msg, dict)):
+                    self.onProgress(msg)
+                else:
+                    self.log.append(str(msg))
+                    self.logChanged = True
         except Empty:
-            print("queue is empty")
+            pass
+        self.drawLog(force=not alive)
 
         # if process is still alive - set timer and go again
-        if (self.t.is_alive()):
+        if (alive):
             self.after(DELAY1, self.onGetValue)
             return
         else:    
@@ -340,13 +428,12 @@ class GUI(Frame):
 
             if (self.quitOnEnd.get() == 1):
                 sys.exit(0)
-
             
 #
 # class for backup task
 #
 class ThreadedBackupTask(threading.Thread):
-    def __init__(self, inputDir, folder, q, config, logger, useQ, doEncrypt, bucket):
+    def __init__(self, inputDir, folder, q, config, logger, useQ, doEncrypt, bucket, workers):
         threading.Thread.__init__(self)
         self.inputDir = inputDir
         self.folder = folder
@@ -356,16 +443,18 @@ class ThreadedBackupTask(threading.Thread):
         self.useQ = useQ
         self.doEncrypt = doEncrypt
         self.bucket = bucket
+        self.workers = workers
 
     def run(self):
         backup_util.doBackup(self.inputDir, self.folder, 
-            self.q, self.config, self.logger, self.useQ, self.doEncrypt, self.bucket)
+            self.q, self.config, self.logger, self.useQ, self.doEncrypt, self.bucket,
+            workers=self.workers)
 
 #
 # class for restore task
 #
 class ThreadedRestoreTask(threading.Thread):
-    def __init__(self, inputDir, folder, q, config, logger, useQ, bucket):
+    def __init__(self, inputDir, folder, q, config, logger, useQ, bucket, workers):
         threading.Thread.__init__(self)
         self.inputDir = inputDir
         self.folder = folder
@@ -374,10 +463,12 @@ class ThreadedRestoreTask(threading.Thread):
         self.logger = logger
         self.useQ = useQ
         self.bucket = bucket
+        self.workers = workers
 
     def run(self):
         backup_util.doRestore(self.inputDir, self.folder, 
-            self.q, self.config, self.logger, self.useQ, self.bucket)
+            self.q, self.config, self.logger, self.useQ, self.bucket,
+            workers=self.workers)
 
 
 def main():  
@@ -388,4 +479,6 @@ def main():
 
 
 if __name__ == '__main__':
+    # needed for the encryption process pool in frozen executables
+    multiprocessing.freeze_support()
     main()  
\ No newline at end of file
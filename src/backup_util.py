@@ -1,8 +1,8 @@
 from datetime import datetime           # for date/time functions
-import pyAesCrypt                       # for encrypting files
 import configparser                     # for parsing the config file
 from minio import Minio                 # s3 library
 from minio.error import ResponseError   # for s3 exceptions
+from minio.definitions import Bucket
 import timeit                           # for timing program runtime
 
 import logging
@@ -10,10 +10,65 @@ import warnings
 import urllib3
 import os
 import io
+import threading
 import sys
+import tempfile
+import json
+
+from file_manifest import FileManifest, hashFile
+from upload_pipeline import UploadPipeline, BackupItem
+from restore_pipeline import RestorePipeline, RestoreItem
+from multipart_upload import (MultipartWriter, UploadStopped, choosePartSize, newPartExecutor, MIN_PART_SIZE,
+                              uploadFileMultipart, abortIncompleteUploads, copyObject, PART_SIZE_META)
+from ranged_download import downloadRanged, getRange, PositionalWriter, md5File, VerifyError
+from chunk_store import (Chunker, ChunkStore, storeFileChunks, chunkListData, restoreFileChunks,
+                         CHUNK_LIST_SUFFIX)
+from compression import (CompressingReader, DecompressingWriter, isCompressible, resolveCodec,
+                         CODEC_META)
+from run_metrics import CountingPoolManager, RetryCount, TimedReader, TimedWriter, runMetrics
+from adaptive import AdaptiveController
+from s3_transport import sharedTransport
+from checkpoint import openJournal
+from snapshot import ContentIndex, newSnapshotId, listSnapshots
+from run_manifest import RunManifest, loadRunManifest, removeRunManifest, runManifestName, isRunManifest
+from object_index import openObjectIndex, timestamp
+from crypto_pool import openCryptoPool
+from aead_crypt import EncryptionKey, RangeDecryptor, encryptAny, decryptAny, isAead, HEADER_SIZE, FORMATS
+from pack_store import (PackWriter, loadPackIndex, readPackEntries, decodePackEntry,
+                        PACK_SUFFIX, PACK_INDEX_SUFFIX)
+from progress import ProgressReporter, startPreScan, countedItems
+from retry_queue import errorClass, failureQueue, writeFailureReport
 
 stopFlag = False
 
+# guards the s3 clients of the shared transports - see connectToS3
+clientLock = threading.Lock()
+
+# unencrypted files up to this size are read into memory by the read stage,
+# bigger ones are streamed from disk by fput_object
+BUFFERED_UPLOAD_LIMIT = 8 * 1024 * 1024
+
+# chunk size used when streaming objects to disk on restore
+RESTORE_CHUNK_SIZE = 1024 * 1024
+
+# object metadata holding the sha256 of the original file content
+CONTENT_HASH_META = "x-amz-meta-sha256"
+
+# object metadata holding the modification time of the original file
+MTIME_META = "x-amz-meta-mtime"
+
+# supported restore modes
+RESTORE_MODES = ("full", "incremental")
+
+# supported backup modes
+BACKUP_MODES = ("full", "incremental", "dedup", "pack", "mirror", "snapshot")
+
+#
+# used by worker threads to check the stop flag set by the gui
+#
+def isStopped():
+    return stopFlag
+
 #
 # utility function to set s3 folder name
 #
@@ -28,46 +83,444 @@ def genS3Name(x):
     minioName = minioName.replace("\\", "/")
     return minioName
 
-def connectToS3(config):
+#
+# connect to s3
+# poolSize is the number of threads that will share the client - the
+# shared connection pool (see s3_transport) is grown to match so parallel
+# workers reuse connections.  0 leaves the pool as it is
+# onBackoff is called for every throttled or failed request urllib3 retries
+#
+# clients are kept per server and credentials, so later runs of the same
+# process also keep the bucket regions minio already looked up
+#
+def connectToS3(config, poolSize=0, onBackoff=None):
     # connect to s3
     s3Host = config['S3']['s3.server']
     s3Access = config['S3']['s3.access_key']
     s3Secret = config['S3']['s3.secret_key']
-    s3SslCert = config['S3']['s3.ssl_cacert']
-    os.environ['SSL_CERT_FILE'] = s3SslCert
+    secure = config.getboolean('S3', 's3.secure', fallback=True)
 
-    s3Client = ""
-    try:
-        s3Client = Minio(s3Host,
-                    access_key=s3Access,
-                    secret_key=s3Secret,
-                    secure=True)
-    except ResponseError:
-        print("error connecting to s3 via minio api.")
+    transport = sharedTransport(config, poolSize)
+    if (poolSize > 0):
+        transport.onBackoff = onBackoff
+
+    # clients are kept with the transport they are bound to, so they are
+    # dropped along with it when a bigger pool replaces it
+    key = (s3Host, s3Access, s3Secret, secure)
+    with clientLock:
+        s3Client = transport.clients.get(key)
+        if (s3Client is not None):
+            return s3Client
+
+        s3Client = ""
+        try:
+            s3Client = Minio(s3Host,
+                        access_key=s3Access,
+                        secret_key=s3Secret,
+                        secure=secure,
+                        http_client=transport.http)
+            transport.clients[key] = s3Client
+        except ResponseError:
+            print("error connecting to s3 via minio api.")
 
     return s3Client
 
 
+#
+# {method: count} of the requests a client sent - since the counts in
+# since when given, so runs sharing a client count their own requests
+#
+def requestCounts(s3Client, since=None):
+    httpClient = getattr(s3Client, "_http", None)
+    if (not isinstance(httpClient, CountingPoolManager)):
+        return dict()
+    counts = httpClient.counts()
+    if (since is not None):
+        counts = {method: count - since.get(method, 0) for method, count in counts.items()
+                  if count > since.get(method, 0)}
+    return counts
+
+
 #
 # get a list of buckets in a given account
+# served from the object index while its copy of the list is recent
 #
 def getBucketList(config):
     buckets = list()
+    objectIndex = openObjectIndex(config)
+    if (objectIndex is not None):
+        cached = objectIndex.buckets()
+        if (cached is not None):
+            objectIndex.close()
+            return [Bucket(name, datetime.fromtimestamp(created)) for name, created in cached]
+
     s3Client = connectToS3(config)
     try:
-        buckets = s3Client.list_buckets()
+        buckets = list(s3Client.list_buckets())
+        if (objectIndex is not None):
+            objectIndex.putBuckets([(b.name, b.creation_date.timestamp() if b.creation_date else 0)
+                                    for b in buckets])
     except ResponseError:
         print("error listing buckets in s3")
     except urllib3.exceptions.MaxRetryError:
         print("max retry error listing buckets")
+    finally:
+        if (objectIndex is not None):
+            objectIndex.close()
 
     return buckets
 
 
+#
+# build the s3 object name for a file under inputDir
+# returns the path relative to inputDir and the s3 name
+#
+def genS3ObjectName(inputDir, folder, inputFile):
+    drive_tail = os.path.splitdrive(inputFile)      # split drive from rest of filename
+    inputFileTail = drive_tail[1]
+    spos = inputFileTail.find(inputDir)
+    epos = spos + len(inputDir)
+    newTail = inputFileTail[epos:]
+    s3Name = folder + "\\" + newTail
+    s3Name = genS3Name(s3Name)
+    return genS3Name(newTail), s3Name
+
+
+#
+# walk inputDir and yield a BackupItem for every file found
+# suffix is added to every object name (".enc" for encrypted files)
+# relative paths are collected in seenPaths when it is passed in
+#
+def scanInputDir(inputDir, folder, suffix, seenPaths=None):
+    for r, d, f in os.walk(inputDir):
+        for file in f:
+            inputFile = os.path.join(r, file)
+
+            # need to make the s3 object name from the filepath
+            relPath, s3Name = genS3ObjectName(inputDir, folder, inputFile)
+            s3Name = s3Name + suffix
+
+            if (seenPaths is not None):
+                seenPaths.add(relPath)
+            yield BackupItem(inputFile, relPath, s3Name)
+
+
+#
+# read a file into memory - compressing and / or encrypting it first if requested
+# large unencrypted files are left on disk and streamed by fput_object
+# encryptionKey is an aead_crypt.EncryptionKey, or None for aes crypt
+# sets item.readTime and item.encodeTime
+#
+def loadBackupItem(item, encrypt, fileEncryptionPass, compressLevel=0, encryptionKey=None):
+    start = timeit.default_timer()
+    if (encrypt == "true" or item.codec):
+        with open(item.inputFile, 'rb') as file_data:
+            reader = TimedReader(file_data)
+            source = reader
+            if (item.codec):
+                source = CompressingReader(reader, item.codec, compressLevel)
+
+            if (encrypt == "true"):
+                #encrypt data
+                fCiph = io.BytesIO()
+                encryptAny(source, fCiph, fileEncryptionPass, encryptionKey)
+                fCiph.seek(0)
+                item.data = fCiph
+            else:
+                item.data = io.BytesIO(source.read())
+        item.readTime = reader.seconds
+        item.encodeTime = timeit.default_timer() - start - reader.seconds
+
+    elif (item.size <= BUFFERED_UPLOAD_LIMIT):
+        with open(item.inputFile, 'rb') as file_data:
+            item.data = io.BytesIO(file_data.read())
+        item.readTime = timeit.default_timer() - start
+
+
+#
+# encrypt a file in the crypto pool (compressing it first if requested)
+# into a spool file that is uploaded in place of the source.  packed
+# files are small and read back into memory for their pack
+# sets item.encodeTime
+#
+def spoolBackupItem(item, cryptoPool, fileEncryptionPass, compressLevel=0, encryptionKey=None):
+    spoolName, item.encodeTime = cryptoPool.encrypt(item.inputFile, fileEncryptionPass,
+            item.codec, compressLevel, encryptionKey)
+    if (item.packed):
+        try:
+            with open(spoolName, 'rb') as file_data:
+                item.data = io.BytesIO(file_data.read())
+        finally:
+            os.remove(spoolName)
+        return
+    item.uploadFile = spoolName
+    item.uploadSize = os.path.getsize(spoolName)
+
+
+#
+# remove the spool file of an item once it is no longer needed
+#
+def removeSpoolFile(item, logger):
+    try:
+        os.remove(item.uploadFile)
+    except OSError as err:
+        logger.error("error deleting spool file: [{}] [{}]".format(item.uploadFile, err))
+    item.uploadFile = None
+
+
+#
+# bytes a file will hold in memory while it is in flight
+#
+def backupItemHoldBytes(item, encrypt):
+    if (encrypt == "true" or item.codec):
+        # aes crypt adds a header, padding and an hmac - compressing data
+        # that barely compresses can add a little too
+        return item.size + item.size // 1000 + 1024
+    return min(item.size, BUFFERED_UPLOAD_LIMIT)
+
+
+#
+# user metadata for an item - compression codec, content hash and mtime
+#
+def itemMeta(item):
+    meta = dict()
+    if (item.codec):
+        meta[CODEC_META] = item.codec
+    if (item.sha256):
+        meta[CONTENT_HASH_META] = item.sha256
+    if (item.mtime):
+        meta[MTIME_META] = str(item.mtime)
+    return meta or None
+
+
+#
+# compress and / or encrypt a file straight into a multipart upload - the
+# output is never held in memory as a whole.  sets item.etag on success
+# and splits the time spent into reading, encoding and uploading
+#
+def streamUpload(s3Client, s3Bkt, item, encrypt, fileEncryptionPass, compressLevel,
+                 partSize, partsInFlight, executor, retries, logger, checkpoint=None,
+                 encryptionKey=None):
+    bufferSize = 64 * 1024
+    start = timeit.default_timer()
+    retryCount = RetryCount()
+    writer = MultipartWriter(s3Client, s3Bkt, item.s3Name,
+            choosePartSize(partSize, item.size), partsInFlight, executor, isStopped,
+            metadata=itemMeta(item), retries=retries, retryCount=retryCount,
+            checkpoint=checkpoint)
+    sink = TimedWriter(writer)
+    reader = None
+    try:
+        with open(item.inputFile, 'rb') as file_data:
+            reader = TimedReader(file_data)
+            source = reader
+            if (item.codec):
+                source = CompressingReader(reader, item.codec, compressLevel)
+
+            if (encrypt == "true"):
+                encryptAny(source, sink, fileEncryptionPass, encryptionKey)
+            else:
+                while True:
+                    data = source.read(bufferSize * 16)
+                    if not data:
+                        break
+                    sink.write(data)
+        closeStart = timeit.default_timer()
+        item.etag = writer.close()
+        item.objectSize = writer.length
+        sink.seconds += timeit.default_timer() - closeStart
+    except UploadStopped:
+        logger.info("stop flag found - aborting upload [{}]".format(item.s3Name))
+        writer.abort()
+    except Exception as err:
+        logger.error("ERROR: FILE_UPLOAD_ERROR [{}]".format(err))
+        item.error = errorClass(err)
+        writer.abort()
+
+    item.retries = retryCount.value
+    item.readTime = reader.seconds if reader is not None else 0
+    item.uploadTime = sink.seconds
+    item.encodeTime = max(0, timeit.default_timer() - start - item.readTime - item.uploadTime)
+
+
+#
+# upload a large unencrypted (or spooled encrypted) file as a parallel
+# multipart upload.  sets item.etag on success
+#
+def multipartFileUpload(s3Client, s3Bkt, item, partSize, partsInFlight, executor,
+                        retries, logger, checkpoint=None):
+    retryCount = RetryCount()
+    item.objectSize = item.uploadSize or item.size
+    try:
+        item.etag = uploadFileMultipart(s3Client, s3Bkt, item.s3Name, item.uploadFile or item.inputFile,
+                item.uploadSize or item.size, partSize, partsInFlight, executor, isStopped, retries,
+                itemMeta(item), retryCount, checkpoint)
+        if (item.etag is None):
+            logger.info("stop flag found - stopped upload [{}]".format(item.s3Name))
+    except Exception as err:
+        logger.error("ERROR: FILE_UPLOAD_ERROR [{}]".format(err))
+        item.error = errorClass(err)
+    item.retries = retryCount.value
+
+
+#
+# snapshot mode - copy an object with the same content server side
+# sets item.etag on success and clears item.copySource when the copy failed
+#
+def copyBackupItem(s3Client, s3Bkt, item, partSize, executor, retries, logger):
+    try:
+        item.etag = copyObject(s3Client, s3Bkt, item.copySource, item.s3Name, partSize,
+                executor, retries)
+    except Exception as err:
+        logger.warning("copy of [{}] failed - uploading it instead [{}]".format(item.copySource, err))
+        item.copySource = None
+
+
+#
+# dedup mode - upload the chunks of a file the store does not have yet,
+# then its chunk list.  sets item.etag on success
+#
+def dedupFileUpload(s3Client, s3Bkt, item, store, chunker, chunksInFlight, executor, logger):
+    try:
+        result = storeFileChunks(store, chunker, item.inputFile, executor, chunksInFlight, isStopped)
+        if (result is None):
+            logger.info("stop flag found - skipped chunk list [{}]".format(item.s3Name))
+            return
+
+        chunkList, newChunks, newBytes, sha256 = result
+        item.sha256 = sha256
+        item.sentBytes = newBytes
+        data = chunkListData(store, chunkList, item.size, sha256)
+        etag = s3Client.put_object(s3Bkt, item.s3Name, io.BytesIO(data), len(data),
+                content_type="application/json", metadata=itemMeta(item))
+        item.etag = etagOf(etag)
+        item.objectSize = len(data)
+        logger.debug("[{}] chunks: [{}] new: [{}]".format(item.s3Name, len(chunkList), newChunks))
+    except Exception as err:
+        logger.error("ERROR: FILE_UPLOAD_ERROR [{}]".format(err))
+        item.error = errorClass(err)
+
+
+#
+# upload a single prepared item - sets item.etag on success
+#
+def putBackupItem(s3Client, s3Bkt, item, logger):
+    try:
+        if (item.data is not None):
+            length = item.data.getbuffer().nbytes
+            result = s3Client.put_object(
+                    bucket_name=s3Bkt, 
+                    object_name=item.s3Name, 
+                    length=length,
+                    data=item.data,
+                    metadata=itemMeta(item)
+            )
+            item.objectSize = length
+        else:
+            # just copy the file (or its encrypted spool file) to s3
+            result = s3Client.fput_object(s3Bkt, item.s3Name, item.uploadFile or item.inputFile,
+                    metadata=itemMeta(item))
+            item.objectSize = item.uploadSize or item.size
+        item.etag = etagOf(result)
+    except ResponseError as err:
+        logger.error("ERROR: FILE_UPLOAD_ERROR [{}]".format(err))
+        item.error = errorClass(err)
+
+
+#
+# put_object returns (etag, version_id) - older minio versions return just the etag
+#
+def etagOf(result):
+    if isinstance(result, tuple):
+        result = result[0]
+    return str(result).replace('"', '')
+
+
+#
+# user metadata value from stat_object metadata or response headers
+# header names are case insensitive, so look them up that way
+#
+def objectMeta(metadata, name, default=""):
+    name = name.lower()
+    for key, value in (metadata or {}).items():
+        if (key.lower() == name):
+            return value
+    return default
+
+
+#
+# delete a list of object names from s3 - returns the number of delete errors
+# deleted objects are dropped from objectIndex as well
+#
+def removeObjects(s3Client, s3Bkt, objectNames, logger, objectIndex=None):
+    errors = 0
+    sent = [None]
+
+    def indexed(names):
+        for name in names:
+            objectIndex.remove(s3Bkt, name)
+            sent[0] = name
+            yield name
+
+    if (objectIndex is not None):
+        objectNames = indexed(objectNames)
+    try:
+        for del_err in s3Client.remove_objects(s3Bkt, objectNames):
+            errors += 1
+            logger.error("Deletion Error: {}".format(del_err))
+            if (objectIndex is not None):
+                # still there - its folder is listed again next time
+                objectIndex.expire(s3Bkt, del_err.object_name)
+    except Exception:
+        if (objectIndex is not None and sent[0] is not None):
+            objectIndex.expire(s3Bkt, sent[0])
+        raise
+    return errors
+
+
+#
+# (name, size, etag, user metadata, last modified) of the objects under
+# prefix - from the object index when it has a recent listing of prefix,
+# otherwise from a listing (that refreshes the index).  metadata is None
+# when not known
+#
+def listObjects(s3Client, s3Bkt, prefix, objectIndex=None):
+    if (objectIndex is not None):
+        return objectIndex.listing(s3Client, s3Bkt, prefix, isStopped)
+    return ((obj.object_name, obj.size, etagOf(obj.etag), None, timestamp(obj.last_modified))
+            for obj in s3Client.list_objects(s3Bkt, prefix=prefix, recursive=True))
+
+
+#
+# stream the listing under prefix and yield the names not in keep.
+# counts[0] is the number of names yielded so far
+#
+def orphanObjects(s3Client, s3Bkt, prefix, keep, counts, objectIndex=None):
+    for obj in listObjects(s3Client, s3Bkt, prefix, objectIndex):
+        if (obj[0] not in keep):
+            counts[0] += 1
+            yield obj[0]
+
+
 #
 # function to perform a backup job
 #
-def doBackup(inputDir, folder, q, config, logger, useQ, doEncrypt, bucket):
+# mode is one of:
+#   full        - delete everything under folder and upload the whole tree
+#   incremental - only upload new / changed files and only delete objects
+#                 whose source file is gone (tracked in a local manifest)
+#   dedup       - incremental, but files are split into content-defined
+#                 chunks stored once each in a shared chunk repository and
+#                 folder only holds a chunk list per file
+#   mirror      - upload the whole tree without wiping folder first, then
+#                 delete only the objects under folder that no local file
+#                 maps to - deletes stream from the listing in batches
+#   pack        - full, but files up to backup.pack_threshold_kb are grouped
+#                 into pack objects with an index instead of one object each
+# an empty mode uses backup.mode from the config
+# workers of 0 uses backup.workers from the config
+#
+def doBackup(inputDir, folder, q, config, logger, useQ, doEncrypt, bucket, mode="", workers=0):
     # suppress s3 warnings
     warnings.simplefilter('ignore', urllib3.exceptions.SecurityWarning)
 
@@ -86,16 +539,32 @@ def doBackup(inputDir, folder, q, config, logger, useQ, doEncrypt, bucket):
     else:
         encrypt = "false"
 
+    # aescrypt = one aes crypt stream per file, aead = chunked aes-gcm that
+    # restores can decrypt in parallel ranges.  restores read both
+    encryptionFormat = config.get('BACKUP', 'backup.encryption_format', fallback='aescrypt')
+    if (encryptionFormat not in FORMATS):
+        logger.error("unknown encryption format: [{}] - bailing out".format(encryptionFormat))
+        return
+    encryptionKey = None
+    if (encrypt == "true" and encryptionFormat == "aead"):
+        encryptionKey = EncryptionKey(fileEncryptionPass)
+
     s3Bkt = config['S3']['s3.bucket_name']
 
     # override s3Bkt if passed in from user
     if (bucket != ""):
         s3Bkt = bucket
 
-    # connect to s3
-    s3Client = connectToS3(config)
+    # backup mode - from config unless passed in
+    if (mode == ""):
+        mode = config.get('BACKUP', 'backup.mode', fallback='full')
+    if (mode not in BACKUP_MODES):
+        logger.error("unknown backup mode: [{}] - bailing out".format(mode))
+        return
+    logger.info("backup mode: [{}]".format(mode))
 
-    # make sure we have all of the input we need
+    # make sure we have all of the input we need - before the crypto pool,
+    # the s3 connection and the object index are opened
     if (inputDir == "" or folder == ""):
         logger.error("missing mandatory input parameter - bailing out")
         return
@@ -105,97 +574,644 @@ def doBackup(inputDir, folder, q, config, logger, useQ, doEncrypt, bucket):
         logger.error("inputDir: [{}] - directory does not exist".format(inputDir))
         return
 
+    # multipart settings for large files
+    mb = 1024 * 1024
+    streamThreshold = config.getint('BACKUP', 'backup.stream_threshold_mb', fallback=64) * mb
+    multipartThreshold = config.getint('BACKUP', 'backup.multipart_threshold_mb', fallback=64) * mb
+    partSize = config.getint('BACKUP', 'backup.part_size_mb', fallback=16) * mb
+    partsInFlight = config.getint('BACKUP', 'backup.parts_in_flight', fallback=2)
+    partRetries = config.getint('BACKUP', 'backup.part_retries', fallback=3)
+
+    # compression before encryption - skipped for files that will not shrink
+    try:
+        compression = resolveCodec(config.get('BACKUP', 'backup.compression', fallback=''))
+    except ValueError as err:
+        logger.error("{} - bailing out".format(err))
+        return
+    compressLevel = config.getint('BACKUP', 'backup.compression_level', fallback=0)
+
+    # store a sha256 of every file in its metadata for incremental restores
+    contentHash = config.getboolean('BACKUP', 'backup.content_hash', fallback=True)
+    if (compression):
+        logger.info("compression: [{}]".format(compression))
+
+    # pack mode - small files are grouped into pack objects
+    packThreshold = min(config.getint('BACKUP', 'backup.pack_threshold_kb', fallback=64) * 1024,
+                        BUFFERED_UPLOAD_LIMIT)
+    packSize = config.getint('BACKUP', 'backup.pack_size_mb', fallback=32) * mb
+
+    # dedup mode - chunks of one file upload in parallel instead of parts
+    chunker = None
+    if (mode == "dedup"):
+        kb = 1024
+        chunker = Chunker(config.getint('BACKUP', 'backup.chunk_min_kb', fallback=256) * kb,
+                          config.getint('BACKUP', 'backup.chunk_avg_kb', fallback=1024) * kb,
+                          config.getint('BACKUP', 'backup.chunk_max_kb', fallback=4096) * kb)
+        partsInFlight = config.getint('BACKUP', 'backup.chunks_in_flight', fallback=4)
+
+    # adaptive mode - the number of active uploads and the part size follow
+    # the throughput, latency and throttling seen.  workers is where it starts
+    workers = workers or config.getint('BACKUP', 'backup.workers', fallback=4)
+    controller = None
+    maxPartSize = partSize
+    if (config.getboolean('BACKUP', 'backup.adaptive', fallback=False)):
+        maxWorkers = max(workers, config.getint('BACKUP', 'backup.adaptive_max_workers', fallback=32))
+        controller = AdaptiveController(workers, 1, maxWorkers, logger, name="upload workers")
+        maxPartSize = max(partSize, config.getint('BACKUP', 'backup.adaptive_max_part_mb', fallback=64) * mb)
+        logger.info("adaptive uploads: [1-{}] workers - part size up to [{}MB]".format(
+                maxWorkers, maxPartSize // mb))
+        workers = maxWorkers
+
+    # encryption in a process pool - files are encrypted to spool files by
+    # up to one prepare thread per process, and uploaded from there
+    cryptoPool = None
+    prepareWorkers = workers
+    if (encrypt == "true" and mode != "dedup"):
+        cryptoPool = openCryptoPool(config, 'BACKUP')
+    if (cryptoPool is not None):
+        prepareWorkers = max(workers, cryptoPool.processes)
+        logger.info("crypto pool: [{}] processes - spool dir: [{}]".format(
+                cryptoPool.processes, cryptoPool.spoolDir or tempfile.gettempdir()))
+
+    # connect to s3 - upload workers and part uploads share one connection pool
+    s3Client = connectToS3(config, workers * (partsInFlight + 1),
+            controller.backoff if controller is not None else None)
+    requestBase = requestCounts(s3Client)
+
+    # local index of the objects in the bucket - the delete passes read it
+    # instead of listing the folder, and the uploads keep it current
+    objectIndex = openObjectIndex(config)
+
+    # checkpoint journal - a stopped, crashed or failed run is resumed by
+    # the next run of the same job
+    journal = openJournal(config, "backup", s3Bkt, folder, inputDir,
+            {"mode": mode, "encrypt": encrypt, "compression": compression,
+             "format": encryptionFormat if encrypt == "true" else ""})
+    resuming = (journal is not None and journal.resumed)
+    if (resuming):
+        msg = "resuming interrupted run - [{}] files done - [{}] multipart uploads to continue".format(
+                len(journal.files), len(journal.uploads))
+        logger.info(msg)
+        if (useQ):
+            q.put(msg)
+
+    # snapshot mode - every run writes a complete tree to a new snapshot
+    # folder under folder.  a resumed run keeps writing the snapshot it resumes
+    runFolder = folder
+    if (mode == "snapshot"):
+        snapshotId = journal.meta.get("snapshot") if resuming else None
+        if (snapshotId is None):
+            # a run started in the same second (another client) must not
+            # write into its snapshot
+            try:
+                taken = set(listSnapshots(s3Client, s3Bkt, genS3Name(folder)))
+            except (ResponseError, urllib3.exceptions.HTTPError) as err:
+                logger.warning("could not list snapshots of [{}] [{}]".format(genS3Name(folder), err))
+                taken = set()
+            snapshotId = newSnapshotId(taken)
+            if (journal is not None):
+                journal.setMeta("snapshot", snapshotId)
+        runFolder = folder + "\\" + snapshotId
+        msg = "snapshot: [{}]".format(genS3Name(runFolder))
+        logger.info(msg)
+        if (useQ):
+            q.put(msg)
 
     #
-    # clean out the target folder in s3
+    # clean out the target folder in s3 (full and pack mode only).  a
+    # resumed run keeps what the interrupted run uploaded and deletes the
+    # objects it did not write once it is done instead
     #
-    delete_start = timeit.default_timer()
-    logger.info("deleting objects from s3 for folder [{}]".format(folder))
-    objects_to_delete = s3Client.list_objects(s3Bkt, prefix=folder, recursive=True)
-    objects_to_delete = [x.object_name for x in objects_to_delete]
-    for del_err in s3Client.remove_objects(s3Bkt, objects_to_delete):
-        print("Deletion Error: {}".format(del_err))
-    delete_stop = timeit.default_timer()
-    delete_time = round(delete_stop - delete_start, 2)
-    msg = "s3 folder cleanup time: [{}s]".format(str(delete_time))
-    logger.info(msg)
-    if (useQ):
-        q.put(msg)
+    # the s3 prefix of folder - with the trailing slash, so the cleanups of
+    # folder "fo" leave "fo2" alone
+    folderPrefix = genS3Name(folder).rstrip("/") + "/"
+    if (mode in ("full", "pack") and not resuming):
+        delete_start = timeit.default_timer()
+        logger.info("deleting objects from s3 for folder [{}]".format(folder))
+        # remove_objects deletes in batches of 1000 as the listing streams in
+        objects_to_delete = listObjects(s3Client, s3Bkt, folderPrefix, objectIndex)
+        objects_to_delete = (x[0] for x in objects_to_delete)
+        removeObjects(s3Client, s3Bkt, objects_to_delete, logger, objectIndex)
+        delete_stop = timeit.default_timer()
+        delete_time = round(delete_stop - delete_start, 2)
+        msg = "s3 folder cleanup time: [{}s]".format(str(delete_time))
+        logger.info(msg)
+        if (useQ):
+            q.put(msg)
+
+    # the run manifest describes the folder once this run has finished -
+    # until then the folder has none, so restores list it instead
+    runManifest = RunManifest(genS3Name(runFolder), mode)
+    try:
+        removeRunManifest(s3Client, s3Bkt, runManifest.prefix)
+        if (objectIndex is not None):
+            objectIndex.remove(s3Bkt, runManifestName(runManifest.prefix))
+    except ResponseError as err:
+        logger.error("ERROR: RUN_MANIFEST_ERROR [{}] [{}]".format(runManifest.prefix, err))
+
+    # abort multipart uploads left behind by earlier runs that were killed
+    # - except the ones the journal can continue
+    liveUploads = set()
+    aborted = abortIncompleteUploads(s3Client, s3Bkt, folderPrefix, logger,
+            journal.uploadIds() if journal is not None else None, liveUploads)
+    if (aborted > 0):
+        logger.info("aborted [{}] leftover multipart uploads".format(aborted))
+    if (journal is not None):
+        journal.dropUploads(liveUploads)
+
+    # incremental / dedup mode - load the manifest from previous runs
+    manifest = None
+    seenPaths = None
+    staleObjects = list()
+    skipCount = 0
+    if (mode in ("incremental", "dedup")):
+        manifestDir = config.get('BACKUP', 'backup.manifest_dir', fallback='./manifests')
+        manifest = FileManifest(manifestDir, s3Bkt, folder)
+        seenPaths = set()
+        logger.info("using manifest: [{}]".format(manifest.path))
+
+    # snapshot mode - the manifest describes the latest snapshot, so files
+    # and content already in the bucket can be copied instead of uploaded
+    snapManifest = None
+    contents = None
+    copyCount = 0
+    if (mode == "snapshot"):
+        manifestDir = config.get('BACKUP', 'backup.manifest_dir', fallback='./manifests')
+        snapManifest = FileManifest(manifestDir, s3Bkt, "snapshots_" + folder)
+        contents = ContentIndex(snapManifest, encrypt == "true")
+        seenPaths = set()
+        logger.info("using manifest: [{}]".format(snapManifest.path))
+
+    # dedup mode - find out which chunks the repository already has
+    store = None
+    sentBytes = 0
+    suffix = ".enc" if encrypt == "true" else ""
+    if (mode == "dedup"):
+        repo = config.get('BACKUP', 'backup.repository', fallback='.chunkrepo')
+        store = ChunkStore(s3Client, s3Bkt, repo,
+                fileEncryptionPass if encrypt == "true" else "", encryptionKey, objectIndex)
+        known = store.loadKnown()
+        logger.info("chunk repository: [{}] - [{}] chunks stored".format(store.repo, known))
+        suffix = CHUNK_LIST_SUFFIX
+
+    # pack mode - packs live next to the files they hold
+    packer = None
+    if (mode == "pack"):
+        packer = PackWriter(s3Client, s3Bkt, genS3Name(folder + "\\.packs\\"), packSize, logger)
+
+    # part size for the next multipart upload - an upload being resumed
+    # keeps the part size it was started with
+    def filePartSize(item):
+        if (journal is not None):
+            pending = journal.pendingUpload(item.s3Name, item.size, item.mtime)
+            if (pending is not None):
+                return pending["partSize"]
+        if (controller is not None):
+            return controller.partSize(partSize, MIN_PART_SIZE, maxPartSize)
+        return partSize
+
+    # stat the file and decide whether it needs to be uploaded
+    def inspectItem(item):
+        st = os.stat(item.inputFile)
+        item.size = st.st_size
+        item.mtime = st.st_mtime
+
+        # uploaded by the interrupted run this one resumes
+        if (journal is not None):
+            done = journal.completed(item.s3Name)
+            if (done is not None and done["size"] == item.size and done["mtime"] == item.mtime):
+                item.skipped = True
+                item.resumed = True
+                item.etag = done["etag"]
+                item.sha256 = done["sha256"]
+                if (manifest is not None):
+                    item.entry = manifest.get(item.relPath)
+                return
+
+        # snapshot mode - files unchanged since the last snapshot and content
+        # that is already in the bucket are copied server side
+        if (contents is not None):
+            entry = snapManifest.get(item.relPath)
+            if (entry is not None and entry[0] == item.size and entry[1] == item.mtime and
+                    contents.usable(entry[3])):
+                item.sha256 = entry[2]
+                item.copySource = entry[3]
+                return
+            item.sha256 = hashFile(item.inputFile)
+            item.copySource, item.contentOwner = contents.claim(item.sha256, isStopped)
+            if (item.copySource is not None):
+                return
+
+        # skip files that have not changed since the last run
+        if (manifest is not None):
+            entry = manifest.get(item.relPath)
+            item.entry = entry
+            if (entry is not None and entry[3] == item.s3Name and
+                    entry[0] == item.size and entry[1] == item.mtime):
+                item.skipped = True
+                item.unchanged = True
+                return
+
+            item.sha256 = hashFile(item.inputFile)
+            if (entry is not None and entry[3] == item.s3Name and entry[2] == item.sha256):
+                item.skipped = True
+                item.unchanged = True
+                return
+
+        # dedup mode - chunks are read, hashed and sent while the file streams
+        if (store is not None):
+            item.stream = True
+            item.holdBytes = min(item.size, chunker.maxSize * (partsInFlight + 2))
+            return
+
+        if (contentHash and item.sha256 == ""):
+            item.sha256 = hashFile(item.inputFile)
+
+        if (compression and isCompressible(item.inputFile, item.size)):
+            item.codec = compression
+
+        # small files go into the open pack - the index records their hash
+        if (packer is not None and item.size <= packThreshold):
+            item.packed = True
+            if (item.sha256 == ""):
+                item.sha256 = hashFile(item.inputFile)
+            item.holdBytes = backupItemHoldBytes(item, encrypt)
+            return
+
+        # encrypted in the crypto pool - only the upload of the spool file
+        # is buffered
+        if (cryptoPool is not None):
+            item.partSize = choosePartSize(filePartSize(item), item.size)
+            if (item.size > multipartThreshold):
+                item.holdBytes = item.partSize * partsInFlight
+            else:
+                item.holdBytes = min(item.size, BUFFERED_UPLOAD_LIMIT)
+        # big encrypted or compressed files are sent straight into a multipart upload
+        elif ((encrypt == "true" or item.codec) and item.size > streamThreshold):
+            item.stream = True
+            item.partSize = choosePartSize(filePartSize(item), item.size)
+            item.holdBytes = item.partSize * (partsInFlight + 1)
+        # big plain files are uploaded as parallel parts read from disk
+        elif (item.size > multipartThreshold):
+            item.stream = True
+            item.partSize = choosePartSize(filePartSize(item), item.size)
+            item.holdBytes = item.partSize * partsInFlight
+        else:
+            item.holdBytes = backupItemHoldBytes(item, encrypt)
+
+    # encrypted uploads are not journaled - every run encrypts with a new
+    # salt and iv, so no part of an earlier upload would ever match
+    def uploadCheckpoint(item):
+        if (journal is None or encrypt == "true"):
+            return None
+        return journal.uploadCheckpoint(item.s3Name, item.size, item.mtime)
+
+    def inspect(item):
+        inspectStart = timeit.default_timer()
+        try:
+            inspectItem(item)
+        finally:
+            item.inspectTime = timeit.default_timer() - inspectStart
+
+    def load(item):
+        if (item.copySource is not None):
+            return
+        if (cryptoPool is not None):
+            spoolBackupItem(item, cryptoPool, fileEncryptionPass, compressLevel, encryptionKey)
+        elif (not item.stream):
+            loadBackupItem(item, encrypt, fileEncryptionPass, compressLevel, encryptionKey)
+
+    def upload(item):
+        if (controller is not None):
+            controller.acquire()
+        uploadStart = timeit.default_timer()
+        try:
+            uploadItem(item)
+        finally:
+            if (controller is not None):
+                moved = item.size
+                if (store is not None):
+                    moved = item.sentBytes
+                elif (item.copySource is not None):
+                    moved = 0
+                controller.release(moved, timeit.default_timer() - uploadStart, item.etag is not None)
+        # streamed uploads split their time up themselves
+        if (item.uploadTime == 0):
+            item.uploadTime = timeit.default_timer() - uploadStart
+
+    def uploadItem(item):
+        if (item.copySource is not None):
+            copyBackupItem(s3Client, s3Bkt, item, partSize, partExecutor, partRetries, logger)
+            if (item.etag is None):
+                # copy source is gone - send the file from disk
+                item.partSize = choosePartSize(filePartSize(item), item.size)
+                if (encrypt == "true"):
+                    streamUpload(s3Client, s3Bkt, item, encrypt, fileEncryptionPass, compressLevel,
+                            item.partSize, partsInFlight, partExecutor, partRetries, logger,
+                            uploadCheckpoint(item), encryptionKey)
+                elif (item.size > multipartThreshold):
+                    multipartFileUpload(s3Client, s3Bkt, item, item.partSize, partsInFlight,
+                            partExecutor, partRetries, logger, uploadCheckpoint(item))
+                else:
+                    putBackupItem(s3Client, s3Bkt, item, logger)
+        elif (item.packed):
+            name = item.s3Name[:-4] if encrypt == "true" else item.s3Name
+            item.etag = packer.add(name, item.data.getvalue(), item.size, item.sha256,
+                    item.codec, encrypt == "true", item.mtime)
+        elif (store is not None):
+            dedupFileUpload(s3Client, s3Bkt, item, store, chunker, partsInFlight,
+                    partExecutor, logger)
+        elif (item.stream and (encrypt == "true" or item.codec)):
+            streamUpload(s3Client, s3Bkt, item, encrypt, fileEncryptionPass, compressLevel,
+                    item.partSize, partsInFlight, partExecutor, partRetries, logger,
+                    uploadCheckpoint(item), encryptionKey)
+        elif (item.stream or item.uploadSize > multipartThreshold):
+            multipartFileUpload(s3Client, s3Bkt, item, item.partSize, partsInFlight,
+                    partExecutor, partRetries, logger, uploadCheckpoint(item))
+        else:
+            putBackupItem(s3Client, s3Bkt, item, logger)
 
 
     #
     # traverse input dir and upload files
     #
+    maxInflight = config.getint('BACKUP', 'backup.max_inflight_mb', fallback=256) * 1024 * 1024
+    logger.info("upload workers: [{}] - in-flight budget: [{}MB]".format(workers, maxInflight // (1024 * 1024)))
+    pipeline = UploadPipeline(workers, maxInflight, isStopped, logger, prepareWorkers)
+    partExecutor = newPartExecutor(workers * partsInFlight)
+    logMod = int(config['LOG']['log.report_interval'])
+
+    # mirror mode (and resumed full / pack runs) - object names this run
+    # maps local files to
+    keepObjects = set() if (mode == "mirror" or (resuming and mode in ("full", "pack"))) else None
+    failCount = 0
+    resumeCount = 0
+
+    # per-file records and a run summary for monitoring
+    metrics = runMetrics(config, "backup", {"bucket": s3Bkt, "folder": folder, "mode": mode})
+
+    # gui progress - counts and bytes per interval, totals from a walk of
+    # inputDir running alongside the backup
+    progress = None
+    if (useQ):
+        progress = ProgressReporter(q, "backup")
+        startPreScan(inputDir, progress, isStopped)
+
+    #
+    # failed uploads are held back while the main pass goes on, then
+    # retried from the file with fewer workers.  the loop below sees each
+    # file once, in its final state
+    #
+    def isFailed(item):
+        return item.failed or (not item.skipped and item.etag is None)
+
+    def itemName(item):
+        return item.s3Name
+
+    def freshItem(item):
+        return BackupItem(item.inputFile, item.relPath, item.s3Name)
+
+    def retryTransfer(items):
+        retryWorkers = max(1, min(workers, config.getint('BACKUP', 'backup.retry_workers', fallback=2)))
+        retryPipeline = UploadPipeline(retryWorkers, maxInflight, isStopped, logger,
+                min(prepareWorkers, retryWorkers))
+        return settled(retryPipeline.run(iter(items), inspect, load, upload))
+
+    # a failed file gives up its content claim right away, so files waiting
+    # for that content upload it themselves instead of waiting for the retry
+    def settled(results):
+        for item in results:
+            if (isFailed(item)):
+                if (item.uploadFile is not None):
+                    removeSpoolFile(item, logger)
+                if (item.contentOwner):
+                    contents.resolve(item.sha256, None)
+                    item.contentOwner = False
+            yield item
+
+    def backupResults():
+        scanned = scanInputDir(inputDir, runFolder, suffix, seenPaths)
+        for item in settled(pipeline.run(scanned, inspect, load, upload)):
+            if (isFailed(item) and failures.hold(item)):
+                continue
+            yield item
+        yield from failures.retry(retryTransfer)
+
+    failures = failureQueue(config, 'BACKUP', isStopped, logger, itemName, isFailed, freshItem)
+
     fileCount = 0
-    for r, d, f in os.walk(inputDir):
+    for item in backupResults():
+        fileCount += 1
+        if (item.uploadFile is not None):
+            removeSpoolFile(item, logger)
+        if (keepObjects is not None):
+            keepObjects.add(item.s3Name)
+        if (isFailed(item)):
+            failCount += 1
+            status = "failed"
+            failures.failed(item.s3Name, item.inputFile, item.error or ("Stopped" if stopFlag else ""))
+        elif (item.skipped):
+            status = "skipped"
+        elif (item.copySource is not None):
+            copyCount += 1
+            status = "copied"
+        else:
+            status = "ok"
+        metrics.record(item.s3Name, status, item.size, item.runTime, item.retries,
+                inspect_s=item.inspectTime, read_s=item.readTime,
+                encode_s=item.encodeTime, upload_s=item.uploadTime)
+        if (progress is not None):
+            line = None
+            if (not item.unchanged):
+                line = str(fileCount) + "|" + item.s3Name + "|" + str(item.runTime) + "s"
+            progress.fileDone(item.size, status == "failed", line)
+
+        # objects written by this run - packs are added once they are closed
+        if (objectIndex is not None and status in ("ok", "copied") and not item.packed):
+            if (item.copySource is not None):
+                objectIndex.copy(s3Bkt, item.copySource, item.s3Name, item.etag)
+            else:
+                objectIndex.put(s3Bkt, item.s3Name, item.objectSize, item.etag, itemMeta(item))
+
+        # packed files are only safe once their pack is uploaded - they
+        # are simply packed again by a resumed run
+        if (item.resumed):
+            resumeCount += 1
+        elif (journal is not None and item.etag is not None and not item.packed):
+            journal.fileDone(item.s3Name, size=item.size, mtime=item.mtime, etag=item.etag,
+                    sha256=item.sha256)
+
+        # snapshot mode - files waiting for this content can copy it now
+        if (item.contentOwner):
+            contents.resolve(item.sha256, item.s3Name if item.etag is not None else None)
+        if (snapManifest is not None and item.etag is not None):
+            snapManifest.put(item.relPath, item.size, item.mtime, item.sha256, item.s3Name, item.etag)
+
+        # packed files are recorded by their pack.  the codec is only known
+        # for objects this run wrote itself
+        if (item.unchanged):
+            runManifest.add(item.s3Name, item.size, item.entry[4], item.relPath,
+                    item.sha256 or item.entry[2], encrypt == "true", None, item.mtime)
+        elif (item.etag is not None and not item.failed and not item.packed):
+            written = (not item.skipped and item.copySource is None)
+            runManifest.add(item.s3Name, item.size, item.etag, item.relPath, item.sha256,
+                    encrypt == "true", item.codec if written else None, item.mtime)
+
+        if (item.unchanged):
+            skipCount += 1
+            # content unchanged but touched - just refresh the timestamp
+            if (item.sha256 != ""):
+                manifest.put(item.relPath, item.size, item.mtime, item.sha256, item.s3Name, item.entry[4])
+            continue
+
+        sentBytes += item.sentBytes
+        if (manifest is not None and item.etag is not None):
+            manifest.put(item.relPath, item.size, item.mtime, item.sha256, item.s3Name, item.etag)
+            # encryption setting changed - old object name is now stale
+            if (item.entry is not None and item.entry[3] != item.s3Name):
+                staleObjects.append(item.entry[3])
+
+        # log an entry for progress
+        if (fileCount % logMod == 0):
+            logger.info("fileCount: {} | s3File: [{}]".format(str(fileCount), item.s3Name))
+
+
+    if (progress is not None):
+        progress.close()
+    partExecutor.shutdown()
+    if (cryptoPool is not None):
+        cryptoPool.close()
+
+    # a scan that broke off leaves files out - the run counts as failed and
+    # nothing is deleted for files it did not see
+    scanError = pipeline.scanError
+    if (scanError is not None):
+        failCount += 1
+
+    if (packer is not None):
+        packer.close()
+
+        # failed packs are sent again on the retry schedule of files
+        attempt = 0
+        while (len(packer.failedPacks) > 0 and attempt < failures.attempts and failures.wait(attempt + 1)):
+            attempt += 1
+            logger.info("retrying [{}] failed packs - attempt [{}/{}]".format(
+                    len(packer.failedPacks), attempt, failures.attempts))
+            packer.retryFailed()
+        for packName, buf, entries, errors in packer.failedPacks:
+            for entry in entries:
+                failures.failed(entry["name"], packName, errors[-1], errors)
+        failCount += packer.failed
+        if (keepObjects is not None):
+            keepObjects.update(packer.uploaded)
+        for packName, packSize, etag in packer.stored:
+            runManifest.add(packName, packSize, etagOf(etag), encrypted=(encrypt == "true"),
+                    files=packer.packFiles.get(packName))
+            if (objectIndex is not None):
+                objectIndex.put(s3Bkt, packName, packSize, etag)
+        msg = "packed files: [{}] in [{}] packs - failed: [{}]".format(
+                packer.fileCount, packer.packCount, packer.failed)
+        logger.info(msg)
+        if (useQ):
+            q.put(msg)
+
+    if (store is not None):
+        msg = "new chunk data uploaded: [{}MB]".format(round(sentBytes / (1024 * 1024), 2))
+        logger.info(msg)
+        if (useQ):
+            q.put(msg)
+
+    #
+    # mirror mode / resumed full run - remove objects no local file maps
+    # to.  only once every upload succeeded - a failed upload may be replacing an object under
+    # another name (encryption turned on or off)
+    #
+    if (keepObjects is not None):
         if (stopFlag):
-            print("stop flag found - break main loop")
-            break
+            msg = "stop flag found - skipped deleting orphaned objects"
+        elif (failCount > 0):
+            msg = "[{}] uploads failed - skipped deleting orphaned objects".format(failCount)
+        else:
+            counts = [0]
+            prefix = genS3Name(folder).rstrip("/") + "/"
+            errors = removeObjects(s3Client, s3Bkt,
+                    orphanObjects(s3Client, s3Bkt, prefix, keepObjects, counts, objectIndex), logger,
+                    objectIndex)
+            msg = "orphaned objects deleted: [{}] - errors: [{}]".format(counts[0] - errors, errors)
+        logger.info(msg)
+        if (useQ):
+            q.put(msg)
 
-        for file in f:
-            if (stopFlag):
-                print("stop flag found - break")
-                break
+    #
+    # snapshot mode - forget files that are gone.  their objects stay in
+    # the earlier snapshots
+    #
+    if (snapManifest is not None):
+        if (not stopFlag and scanError is None):
+            for path, objName in snapManifest.entries():
+                if (path not in seenPaths):
+                    snapManifest.remove(path)
+        snapManifest.close()
+        state = "complete" if (not stopFlag and failCount == 0) else "incomplete"
+        msg = "snapshot [{}] {} - files copied server side: [{}]".format(
+                genS3Name(runFolder), state, copyCount)
+        logger.info(msg)
+        if (useQ):
+            q.put(msg)
 
-            fileCount += 1
-            fileStartTime = timeit.default_timer()
-            inputFile = os.path.join(r, file)
-            fileToUpload = inputFile
+    #
+    # incremental mode - remove objects whose source file is gone
+    # only safe when the walk finished - otherwise seenPaths is incomplete
+    #
+    if (manifest is not None):
+        if (not stopFlag and scanError is None):
+            for path, objName in manifest.entries():
+                if (path not in seenPaths):
+                    staleObjects.append(objName)
+                    manifest.remove(path)
 
-            # need to make the s3 object name from the filepath
-            drive_tail = os.path.splitdrive(inputFile)      # split drive from rest of filename
-            inputFileTail = drive_tail[1]
-            spos = inputFileTail.find(inputDir)
-            epos = spos + len(inputDir)
-            newTail = inputFileTail[epos:]
-            s3Name = folder + "\\" + newTail
-            s3Name = genS3Name(s3Name)
-
-            # if we have been instructed to encrypt
-            if encrypt == "true":
-                bufferSize = 64 * 1024
-
-                # read file / encrypt file / upload file
-                try:
-                    with open(inputFile, 'rb') as file_data:
-                        #encrypt data
-                        fCiph = io.BytesIO()
-                        pyAesCrypt.encryptStream(file_data, fCiph, fileEncryptionPass, bufferSize)
-                        ctlen = len(fCiph.getvalue())
-
-                        s3Name = s3Name + ".enc"
-
-                        fCiph.seek(0)
-                        s3Client.put_object(
-                                bucket_name=s3Bkt, 
-                                object_name=s3Name, 
-                                length=ctlen,
-                                data=fCiph
-                        )
-                except ResponseError as err:
-                   logger.error("ERROR: FILE_UPLOAD_ERROR [{}]".format(err))
+            if (len(staleObjects) > 0):
+                logger.info("deleting [{}] objects whose source is gone".format(len(staleObjects)))
+                removeObjects(s3Client, s3Bkt, staleObjects, logger, objectIndex)
 
-            else:
-                # just copy the file to s3
-                try:
-                    s3Client.fput_object(s3Bkt, s3Name, fileToUpload)
-                except ResponseError as err:
-                    logger.error("ERROR: FILE_UPLOAD_ERROR [{}]".format(err))
+        manifest.close()
+        msg = "unchanged files skipped: [{}] - objects deleted: [{}]".format(skipCount, len(staleObjects))
+        logger.info(msg)
+        if (useQ):
+            q.put(msg)
 
+    #
+    # write the run manifest - only for a run that finished without
+    # failures, otherwise the folder holds objects it would not list
+    #
+    if (not stopFlag and failCount == 0):
+        try:
+            manifestSize, etag = runManifest.write(s3Client, s3Bkt)
+            if (objectIndex is not None):
+                objectIndex.put(s3Bkt, runManifestName(runManifest.prefix), manifestSize, etag)
+            msg = "run manifest written: [{}] objects - [{}KB]".format(
+                    len(runManifest.objects), round(manifestSize / 1024, 1))
+        except ResponseError as err:
+            msg = "ERROR: RUN_MANIFEST_ERROR [{}] [{}]".format(runManifest.prefix, err)
+            logger.error(msg)
+    else:
+        msg = "run manifest not written - restores of [{}] list the folder".format(runManifest.prefix)
+    logger.info(msg)
+    if (useQ):
+        q.put(msg)
 
-            # log an entry for progress
-            logMod = int(config['LOG']['log.report_interval'])
-            if (fileCount % logMod == 0):
-                logger.info("fileCount: {} | s3File: [{}]".format(str(fileCount), s3Name))
-            
-            fileEndTime = timeit.default_timer()
-            fileRunTime = round(fileEndTime - fileStartTime, 2)
+    if (objectIndex is not None):
+        objectIndex.close()
 
-            # report back to gui
-            if (useQ):
-                msg = str(fileCount) + "|" + s3Name + "|" + str(fileRunTime) + "s"
-                q.put(msg)
+    # the journal is only needed again when there is work left to redo
+    if (journal is not None):
+        journal.close(not stopFlag and failCount == 0)
+        if (resumeCount > 0):
+            logger.info("files skipped - done by the interrupted run: [{}]".format(resumeCount))
 
+    logRunSummary(metrics.finish(requestCounts(s3Client, requestBase), stopFlag), logger)
+    status = reportFailures(config, "backup", {"bucket": s3Bkt, "folder": folder, "mode": mode},
+            failures, q, logger, useQ, scanError)
 
     stop = timeit.default_timer()
     runTime = stop - start
@@ -205,15 +1221,677 @@ def doBackup(inputDir, folder, q, config, logger, useQ, doEncrypt, bucket):
     
     if (useQ):
         q.put("Run Complete - run time: {}m {}s".format(minutes, seconds))
+    return status
 
 # end doBackup
 
 
+#
+# log the transfers recovered by retries and the ones that failed for
+# good, and write the failure report - returns the exit status of the run
+# listError is the error class of a scan / listing that broke off, or None
+#
+def reportFailures(config, kind, labels, failures, q, logger, useQ, listError=None):
+    msg = "failed transfers recovered by retries: [{}] - failed: [{}]".format(
+            failures.recovered, len(failures.failures))
+    logger.info(msg)
+    if (useQ):
+        q.put(msg)
+    for failure in failures.failures:
+        logger.error("ERROR: TRANSFER_FAILED [{}] [{}] attempts [{}]".format(
+                failure["name"], failure["error"], failure["attempts"]))
+    if (listError is not None):
+        msg = "ERROR: {} broke off [{}] - not every file was {}".format(
+                "scan" if kind == "backup" else "listing", listError,
+                "backed up" if kind == "backup" else "restored")
+        logger.error(msg)
+        if (useQ):
+            q.put(msg)
+    return writeFailureReport(config, kind, labels, failures, stopFlag, logger, listError)
+
+
+#
+# one line summary of a finished run's metrics
+#
+def logRunSummary(summary, logger):
+    logger.info("files: [{}] failed: [{}] skipped: [{}] copied: [{}] - [{} files/s] [{} MB/s] - latency p50/p99: [{}s/{}s] - requests: {}".format(
+            summary["files"], summary["failed"], summary["skipped"], summary["copied"], summary["files_per_s"],
+            summary["mb_per_s"], summary["latency_s"]["p50"], summary["latency_s"]["p99"],
+            summary["requests"]))
+
+
+
+#
+# local filename for a restored object
+#
+def genRestoreName(restoreDir, objName):
+    return os.path.join(restoreDir, *objName.split("/"))
+
+
+#
+# local filename an object restores to - without the .enc / .chunks suffix
+#
+def restoreFilename(restoreDir, objName):
+    if (objName.endswith(CHUNK_LIST_SUFFIX)):
+        objName = objName[:-len(CHUNK_LIST_SUFFIX)]
+    elif (objName.endswith(".enc")):
+        objName = objName[:-4]
+    return genRestoreName(restoreDir, objName)
+
+
+#
+# local files an object was restored to, as [path, size, mtime] - the
+# restore journal keeps them so a resumed run can tell they are still
+# there.  None when one of them is already gone
+#
+def restoredFiles(item):
+    names = item.written if item.objName.endswith(PACK_SUFFIX) else [item.filename]
+    files = list()
+    for name in names:
+        try:
+            st = os.stat(name)
+        except OSError:
+            return None
+        files.append([os.path.abspath(name), st.st_size, st.st_mtime_ns])
+    return files
+
+
+#
+# are the files of a restore journal record still on disk as written
+#
+def restoredFilesMatch(files):
+    if (files is None):
+        return False
+    for name, size, mtime in files:
+        try:
+            st = os.stat(name)
+        except OSError:
+            return False
+        if (st.st_size != size or st.st_mtime_ns != mtime):
+            return False
+    return True
+
+
+#
+# incremental restore - decides whether a local file already matches an
+# object.  size / mtime / sha256 / etag of files restored or checked are
+# kept in a local manifest, so unchanged files are not read again on the
+# next run.  every filename the remote side maps to is collected in
+# expected, for deleting local files that are gone remotely.
+#
+class RestoreState:
+
+    def __init__(self, s3Client, s3Bkt, manifest, restoreDir):
+        self.s3Client = s3Client
+        self.s3Bkt = s3Bkt
+        self.manifest = manifest
+        self.restoreDir = restoreDir
+        self.expected = set()
+
+    def key(self, filename):
+        return os.path.relpath(filename, self.restoreDir)
+
+    def expect(self, filename):
+        self.expected.add(os.path.normpath(filename))
+
+    # does filename already hold the content of the listed object
+    def matches(self, item, filename):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return False
+
+        key = self.key(filename)
+        rec = self.manifest.get(key)
+        if (rec is not None and rec[4] == item.etag and rec[0] == st.st_size and rec[1] == st.st_mtime):
+            return True
+
+        # planned from the run manifest - it already says what the object holds
+        if (item.codec is not None and item.sha256 != ""):
+            sha256 = item.sha256
+            codec = item.codec
+        else:
+            meta = self.s3Client.stat_object(self.s3Bkt, item.objName).metadata
+            sha256 = objectMeta(meta, CONTENT_HASH_META)
+            codec = objectMeta(meta, CODEC_META)
+        plain = (not codec and not item.objName.endswith((".enc", CHUNK_LIST_SUFFIX)))
+        if (plain and st.st_size != item.size):
+            return False
+
+        if (sha256):
+            local = hashFile(filename)
+            ok = (local == sha256)
+        elif (plain and len(item.etag) == 32):
+            # no content hash stored - a single part etag is the md5
+            local = ""
+            ok = (md5File(filename) == item.etag)
+        else:
+            return False
+
+        if (ok):
+            self.manifest.put(key, st.st_size, st.st_mtime, local, item.objName, item.etag)
+        return ok
+
+    # does filename already hold the content of a packed file
+    def entryMatches(self, entry, filename):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return False
+        if (st.st_size != entry["size"]):
+            return False
+
+        key = self.key(filename)
+        rec = self.manifest.get(key)
+        if (rec is not None and rec[2] == entry["sha256"] and rec[0] == st.st_size and rec[1] == st.st_mtime):
+            return True
+        if (hashFile(filename) != entry["sha256"]):
+            return False
+        self.manifest.put(key, st.st_size, st.st_mtime, entry["sha256"], entry["name"], "")
+        return True
+
+    def restored(self, filename, objName, etag, sha256=""):
+        st = os.stat(filename)
+        self.manifest.put(self.key(filename), st.st_size, st.st_mtime, sha256, objName, etag)
+
+    # delete files under root that no object maps to - returns the count
+    def removeExtraFiles(self, root, logger):
+        removed = 0
+        for r, d, f in os.walk(root):
+            for file in f:
+                filename = os.path.normpath(os.path.join(r, file))
+                if (filename in self.expected):
+                    continue
+                try:
+                    os.remove(filename)
+                    self.manifest.remove(self.key(filename))
+                    removed += 1
+                except OSError as err:
+                    logger.error("error deleting local file: [{}] [{}]".format(filename, err))
+        return removed
+
+
+#
+# settings for ranged restores of big objects
+#
+class RangedRestoreSettings:
+
+    def __init__(self, config):
+        mb = 1024 * 1024
+        self.threshold = config.getint('RESTORE', 'restore.ranged_threshold_mb', fallback=64) * mb
+        self.rangeSize = config.getint('RESTORE', 'restore.range_size_mb', fallback=16) * mb
+        self.rangesInFlight = config.getint('RESTORE', 'restore.ranges_in_flight', fallback=4)
+        self.retries = config.getint('RESTORE', 'restore.range_retries', fallback=3)
+        self.maxRangeSize = max(self.rangeSize,
+                config.getint('RESTORE', 'restore.adaptive_max_range_mb', fallback=64) * mb)
+        self.executor = None
+        self.controller = None
+        self.journal = None
+
+    # range size for the next object - follows the throughput in adaptive mode
+    def currentRangeSize(self):
+        if (self.controller is not None):
+            return self.controller.partSize(self.rangeSize, MIN_PART_SIZE, self.maxRangeSize)
+        return self.rangeSize
+
+
+#
+# restore a big object with parallel ranged GETs written at their offsets
+# into a preallocated temp file, then check size and etag.  encrypted
+# objects in the aead format are decrypted range by range when
+# fileEncryptionPass is given.
+# returns False without downloading when the object is compressed - it
+# has to be decompressed front to back - or is an aes crypt object that
+# has to be decrypted
+#
+def rangedRestoreObject(s3Client, s3Bkt, item, filename, ranged, logger, fileEncryptionPass=None):
+    st = s3Client.stat_object(s3Bkt, item.objName)
+    if (objectMeta(st.metadata, CODEC_META)):
+        return False
+    decoder = None
+    if (fileEncryptionPass is not None and item.objName.endswith(".enc")):
+        if (st.size < HEADER_SIZE):
+            return False
+        header = getRange(s3Client, s3Bkt, item.objName, 0, HEADER_SIZE, ranged.retries)
+        if (not isAead(header)):
+            return False
+        decoder = RangeDecryptor(header, fileEncryptionPass, st.size)
+    partSize = int(objectMeta(st.metadata, PART_SIZE_META, "0") or 0)
+    tgtDir = os.path.dirname(filename)
+    os.makedirs(tgtDir, exist_ok=True)
+    rangeSize = ranged.currentRangeSize()
+
+    # with a journal the temp file has a fixed name and is kept when the
+    # download stops or fails, so the next run only fetches missing ranges
+    checkpoint = None
+    if (ranged.journal is not None):
+        checkpoint = ranged.journal.rangeCheckpoint(item.objName, st.etag)
+        tmpName = os.path.join(tgtDir, ".restore-{}.part".format(os.path.basename(filename)))
+        if (not os.path.exists(tmpName)):
+            if (len(checkpoint.done) > 0):
+                checkpoint.reset()
+        elif (checkpoint.rangeSize > 0):
+            rangeSize = checkpoint.rangeSize
+            logger.info("resuming download [{}] - [{}] ranges already written".format(
+                    item.objName, len(checkpoint.done)))
+    else:
+        fd, tmpName = tempfile.mkstemp(dir=tgtDir, prefix=".restore-", suffix=".tmp")
+        os.close(fd)
+
+    retryCount = RetryCount()
+    keep = False
+    try:
+        done = downloadRanged(s3Client, s3Bkt, item.objName, tmpName, st.size, st.etag,
+                partSize, rangeSize, ranged.rangesInFlight, ranged.executor,
+                isStopped, ranged.retries, logger, retryCount, checkpoint, decoder)
+        item.retries = retryCount.value
+        if (done):
+            os.replace(tmpName, filename)
+            tmpName = None
+        keep = (checkpoint is not None)
+    except VerifyError:
+        if (checkpoint is not None):
+            checkpoint.reset()
+        raise
+    except Exception:
+        keep = (checkpoint is not None)
+        raise
+    finally:
+        if (not keep and tmpName is not None and os.path.exists(tmpName)):
+            os.remove(tmpName)
+
+    if (done):
+        item.filename = filename
+        item.ok = True
+    return True
+
+
+#
+# rebuild a file from a dedup chunk list object.  chunks are fetched in
+# parallel on the ranged executor and written at their offsets into a
+# preallocated temp file
+#
+def chunkedRestoreObject(s3Client, s3Bkt, item, filename, fileEncryptionPass, ranged, logger):
+    response = s3Client.get_object(s3Bkt, item.objName)
+    try:
+        doc = json.loads(response.read().decode("utf8"))
+    finally:
+        response.close()
+        response.release_conn()
+
+    if (sum(length for chunkId, length in doc["chunks"]) != doc["size"]):
+        raise ValueError("chunk list [{}] does not add up to the file size".format(item.objName))
+
+    store = ChunkStore(s3Client, s3Bkt, doc["repo"],
+            fileEncryptionPass if doc.get("encrypted", False) else "")
+    executor = ranged.executor if ranged is not None else newPartExecutor(1)
+    inFlight = ranged.rangesInFlight if ranged is not None else 1
+    tgtDir = os.path.dirname(filename)
+    os.makedirs(tgtDir, exist_ok=True)
+
+    fd, tmpName = tempfile.mkstemp(dir=tgtDir, prefix=".restore-", suffix=".tmp")
+    os.close(fd)
+    done = False
+    try:
+        writer = PositionalWriter(tmpName, doc["size"])
+        try:
+            done = restoreFileChunks(store, doc, writer, executor, inFlight, isStopped)
+        finally:
+            writer.close()
+        if (done):
+            os.replace(tmpName, filename)
+            tmpName = None
+    finally:
+        if (ranged is None):
+            executor.shutdown()
+        if (tmpName is not None and os.path.exists(tmpName)):
+            os.remove(tmpName)
+
+    if (done):
+        item.filename = filename
+        item.ok = True
+
+
+#
+# restore the files held in a pack object.  wanted(name, mtime) picks the
+# files to restore, None restores all of them.  a few files are read with ranged
+# GETs, most or all of a pack is streamed once.
+#
+def restorePackObject(s3Client, s3Bkt, item, restoreDir, fileEncryptionPass, logger, ranged=None,
+                      wanted=None, state=None):
+    index = loadPackIndex(s3Client, s3Bkt, item.objName)
+    entries = [e for e in index["files"] if wanted is None or wanted(e["name"], e.get("mtime"))]
+    retries = ranged.retries if ranged is not None else 0
+
+    # incremental restore - only extract files that differ locally
+    if (state is not None):
+        changed = list()
+        for entry in entries:
+            filename = genRestoreName(restoreDir, entry["name"])
+            state.expect(filename)
+            if (not state.entryMatches(entry, filename)):
+                changed.append(entry)
+        item.unchanged = (len(changed) == 0)
+        entries = changed
+
+    errors = 0
+    for entry, data in readPackEntries(s3Client, s3Bkt, item.objName, entries,
+                                       len(index["files"]), retries):
+        if (isStopped()):
+            return
+        filename = genRestoreName(restoreDir, entry["name"])
+        tmpName = None
+        try:
+            data = decodePackEntry(entry, data, fileEncryptionPass)
+            tgtDir = os.path.dirname(filename)
+            os.makedirs(tgtDir, exist_ok=True)
+            fd, tmpName = tempfile.mkstemp(dir=tgtDir, prefix=".restore-", suffix=".tmp")
+            with os.fdopen(fd, 'wb') as file_data:
+                file_data.write(data)
+            os.replace(tmpName, filename)
+            tmpName = None
+            item.written.append(filename)
+            if (state is not None):
+                state.restored(filename, entry["name"], "", entry["sha256"])
+        except Exception as err:
+            errors += 1
+            logger.error("ERROR: FILE_RESTORE_ERROR [{}] [{}]".format(entry["name"], err))
+            item.error = errorClass(err)
+        finally:
+            if (tmpName is not None and os.path.exists(tmpName)):
+                os.remove(tmpName)
+
+    item.filename = restoreDir
+    item.ok = (errors == 0)
+
+
+#
+# plain read() view of an http response.  urllib3 reports a response as
+# closed once the last byte is read, which trips up readers that peek
+# ahead (pyAesCrypt looks for the trailing hmac that way).
+#
+class ResponseReader:
+
+    def __init__(self, response):
+        self.response = response
+
+    def read(self, n=-1):
+        if (n is None or n < 0):
+            return self.response.read()
+        return self.response.read(n)
+
+
+#
+# fetch a single object, decrypt it if necessary and write it to disk
+# the response is streamed in chunks into a temp file next to the target,
+# which is renamed into place once complete - no whole-object buffers.
+# sets item.ok once the file has been written
+# ranged is a RangedRestoreSettings, or None to always download sequentially
+# state is a RestoreState for incremental restores - objects that already
+# match the local file are skipped
+# cryptoPool is a CryptoPool that decrypts whole encrypted objects, or None
+#
+def restoreObject(s3Client, s3Bkt, item, restoreDir, fileEncryptionPass, logger, ranged=None,
+                  state=None, cryptoPool=None, wanted=None):
+    objName = item.objName
+
+    # pack indexes are read along with their pack
+    if (objName.endswith(PACK_INDEX_SUFFIX)):
+        return
+    if (objName.endswith(PACK_SUFFIX)):
+        restorePackObject(s3Client, s3Bkt, item, restoreDir, fileEncryptionPass, logger, ranged,
+                wanted=wanted, state=state)
+        return
+
+    filename = restoreFilename(restoreDir, objName)
+    if (state is not None):
+        state.expect(filename)
+        if (state.matches(item, filename)):
+            item.filename = filename
+            item.ok = True
+            item.unchanged = True
+            return
+
+    fetchObject(s3Client, s3Bkt, item, filename, fileEncryptionPass, logger, ranged, cryptoPool)
+    if (state is not None and item.ok):
+        state.restored(filename, objName, item.etag)
+
+
+#
+# download a single object to filename - picks the chunked, ranged or
+# sequential path for it
+#
+def fetchObject(s3Client, s3Bkt, item, filename, fileEncryptionPass, logger, ranged=None,
+                cryptoPool=None):
+    objName = item.objName
+
+    # dedup chunk lists are rebuilt from the chunk repository
+    if (objName.endswith(CHUNK_LIST_SUFFIX)):
+        chunkedRestoreObject(s3Client, s3Bkt, item, filename, fileEncryptionPass, ranged, logger)
+        return
+
+    # big plain and aead encrypted objects are fetched as parallel byte
+    # ranges.  aes crypt files can only be decrypted front to back
+    if (ranged is not None and item.size > ranged.threshold):
+        if (rangedRestoreObject(s3Client, s3Bkt, item, filename, ranged, logger, fileEncryptionPass)):
+            return
+
+    # other encrypted objects are downloaded whole and decrypted in the crypto pool
+    if (cryptoPool is not None and objName.endswith(".enc")):
+        pooledRestoreObject(s3Client, s3Bkt, item, filename, fileEncryptionPass, logger, ranged,
+                cryptoPool)
+        return
+
+    try:
+        data = s3Client.get_object(s3Bkt, objName)
+    except ResponseError as err:
+        logger.error("error fetching object: [{}]".format(err))
+        item.error = errorClass(err)
+        return
+
+    # make sure target directory exists
+    encrypted = objName.endswith(".enc")
+    tgtDir = os.path.dirname(filename)
+
+    codec = objectMeta(data.headers, CODEC_META)
+
+    tmpName = None
+    try:
+        os.makedirs(tgtDir, exist_ok=True)
+        fd, tmpName = tempfile.mkstemp(dir=tgtDir, prefix=".restore-", suffix=".tmp")
+        with os.fdopen(fd, 'wb') as file_data:
+            # compressed objects are decompressed on the way to disk
+            sink = file_data
+            if (codec):
+                sink = DecompressingWriter(file_data, codec)
+
+            if (encrypted):
+                # decrypt straight from the http response into the temp file
+                logger.info("file is encrypted: decrypting")
+                datalen = int(data.headers.get('content-length', item.size))
+                decryptAny(ResponseReader(data), sink, fileEncryptionPass, datalen)
+            else:
+                for chunk in data.stream(RESTORE_CHUNK_SIZE):
+                    sink.write(chunk)
+
+            if (codec):
+                sink.close()
+
+        os.replace(tmpName, filename)
+        tmpName = None
+    finally:
+        data.close()
+        data.release_conn()
+        if (tmpName is not None and os.path.exists(tmpName)):
+            os.remove(tmpName)
+
+    item.filename = filename
+    item.ok = True
+
+
+#
+# restore an encrypted object by downloading the ciphertext to a temp file
+# next to the target - as parallel ranges when it is big - and decrypting
+# that file in the crypto pool.  sets item.ok once the file has been written
+#
+def pooledRestoreObject(s3Client, s3Bkt, item, filename, fileEncryptionPass, logger, ranged,
+                        cryptoPool):
+    tgtDir = os.path.dirname(filename)
+    os.makedirs(tgtDir, exist_ok=True)
+    cipherName = os.path.join(tgtDir, ".restore-{}.enc".format(os.path.basename(filename)))
+
+    codec = ""
+    fetched = False
+    if (ranged is not None and item.size > ranged.threshold):
+        # compressed objects come back False - they are fetched below
+        fetched = rangedRestoreObject(s3Client, s3Bkt, item, cipherName, ranged, logger)
+        if (fetched and not item.ok):
+            # stopped - the journal keeps the ranges already written
+            return
+        item.ok = False
+
+    tmpName = None
+    try:
+        if (not fetched):
+            data = s3Client.get_object(s3Bkt, item.objName)
+            try:
+                codec = objectMeta(data.headers, CODEC_META)
+                with open(cipherName, 'wb') as file_data:
+                    for chunk in data.stream(RESTORE_CHUNK_SIZE):
+                        file_data.write(chunk)
+            finally:
+                data.close()
+                data.release_conn()
+
+        logger.info("file is encrypted: decrypting")
+        fd, tmpName = tempfile.mkstemp(dir=tgtDir, prefix=".restore-", suffix=".tmp")
+        os.close(fd)
+        cryptoPool.decrypt(cipherName, tmpName, fileEncryptionPass, codec)
+        os.replace(tmpName, filename)
+        tmpName = None
+    finally:
+        for name in (tmpName, cipherName):
+            if (name is not None and os.path.exists(name)):
+                os.remove(name)
+
+    item.filename = filename
+    item.ok = True
+
+
+#
+# list objects under folder as RestoreItems - from the object index when
+# it has a recent listing of folder
+#
+def listRestoreItems(s3Client, s3Bkt, folder, objectIndex=None):
+    for name, size, etag, meta, modified in listObjects(s3Client, s3Bkt, folder, objectIndex):
+        if (isRunManifest(name)):
+            continue
+        item = RestoreItem(name, size, etag)
+        item.mtime = modified
+        if (meta is not None):
+            item.sha256 = meta.get(CONTENT_HASH_META, "")
+            item.codec = meta.get(CODEC_META, "")
+            if (MTIME_META in meta):
+                item.mtime = float(meta[MTIME_META])
+        yield item
+
+
+#
+# RestoreItems from the run manifest of folder, largest first so the long
+# downloads do not end up last.  returns None when the folder has no
+# usable manifest
+#
+def plannedRestoreItems(s3Client, s3Bkt, folder, logger):
+    try:
+        records = loadRunManifest(s3Client, s3Bkt, genS3Name(folder))
+    except (ResponseError, urllib3.exceptions.HTTPError, OSError, ValueError) as err:
+        logger.error("ERROR: RUN_MANIFEST_ERROR [{}] [{}]".format(folder, err))
+        return None
+    if (records is None):
+        return None
+
+    items = list()
+    for rec in records:
+        item = RestoreItem(rec["key"], rec["size"], rec["etag"])
+        item.sha256 = rec.get("sha256", "")
+        item.codec = rec.get("codec")
+        item.mtime = rec.get("mtime")
+        item.files = rec.get("files")
+        items.append(item)
+    items.sort(key=lambda item: item.size, reverse=True)
+    return items
+
+
+#
+# path of an object (or packed file) relative to the restore folder, as a
+# selective restore matches it
+#
+def restoreRelPath(prefix, objName):
+    if (objName.startswith(prefix)):
+        objName = objName[len(prefix):]
+    objName = objName.lstrip("/")
+    if (objName.endswith(CHUNK_LIST_SUFFIX)):
+        return objName[:-len(CHUNK_LIST_SUFFIX)]
+    if (objName.endswith(".enc")):
+        return objName[:-4]
+    return objName
+
+
+#
+# selective restore - the objects under folder that hold files selection
+# picks.  only the prefixes the selection can match are listed (or read
+# from the object index), plus the packs of the folder.  object names of
+# files backed up without a trailing slash on the input dir have an empty
+# segment after the folder, so both forms of each prefix are listed
+#
+def selectedRestoreItems(s3Client, s3Bkt, folder, selection, objectIndex=None):
+    prefix = genS3Name(folder).rstrip("/") + "/"
+    relPrefixes = selection.prefixes()
+    listPrefixes = [prefix]
+    if (relPrefixes != [""]):
+        listPrefixes = [prefix + ".packs/"]
+        for relPrefix in relPrefixes:
+            listPrefixes += [prefix + relPrefix, prefix + "/" + relPrefix]
+
+    found = dict()
+    for listPrefix in listPrefixes:
+        for item in listRestoreItems(s3Client, s3Bkt, listPrefix, objectIndex):
+            found[item.objName] = item
+    items = list(found.values())
+    items.sort(key=lambda item: item.size, reverse=True)
+    return items
+
+
+#
+# keep the items that hold a file selection picks.  packs stay when any of
+# their files matches - or when their files are not known up front
+#
+def selectRestoreItems(items, folder, selection):
+    prefix = genS3Name(folder).rstrip("/") + "/"
+    for item in items:
+        if (item.objName.endswith(PACK_INDEX_SUFFIX)):
+            continue
+        if (item.objName.endswith(PACK_SUFFIX)):
+            if (item.files is None or
+                    any(selection.matches(restoreRelPath(prefix, name), mtime) for name, mtime in item.files)):
+                yield item
+        elif (selection.matches(restoreRelPath(prefix, item.objName), item.mtime)):
+            yield item
+
 
 #
 # function to perform a restore job
 #
-def doRestore(restoreDir, folder, q, config, logger, useQ, bucket):
+# mode is one of:
+#   full        - download every object under folder
+#   incremental - only download objects that differ from the local file
+#                 (size / etag / sha256 metadata) and, with
+#                 restore.delete_extra, delete local files gone remotely
+# an empty mode uses restore.mode from the config
+# workers of 0 uses restore.workers from the config
+# selection (a RestoreFilter) restores only the files it picks
+#
+def doRestore(restoreDir, folder, q, config, logger, useQ, bucket, workers=0, mode="", selection=None):
     # make sure the restore directory exists
     if not os.path.exists(restoreDir):
         logger.info("making directory: {}".format(restoreDir))
@@ -227,13 +1905,37 @@ def doRestore(restoreDir, folder, q, config, logger, useQ, bucket):
     # start timer
     start = timeit.default_timer()
 
-    logger.info("===== STARTING BACKUP RUN =====")
+    logger.info("===== STARTING RESTORE RUN =====")
 
     # config settings for file encryption
     fileEncryptionPass = config['DEFAULT']['file.encryption_password']
 
-    # connect to s3
-    s3Client = connectToS3(config)
+    # adaptive mode - the number of active downloads and the range size
+    # follow the throughput, latency and throttling seen
+    workers = workers or config.getint('RESTORE', 'restore.workers', fallback=8)
+    ranged = RangedRestoreSettings(config)
+    controller = None
+    if (config.getboolean('RESTORE', 'restore.adaptive', fallback=False)):
+        maxWorkers = max(workers, config.getint('RESTORE', 'restore.adaptive_max_workers', fallback=32))
+        controller = AdaptiveController(workers, 1, maxWorkers, logger, name="download workers")
+        ranged.controller = controller
+        logger.info("adaptive downloads: [1-{}] workers - range size up to [{}MB]".format(
+                maxWorkers, ranged.maxRangeSize // (1024 * 1024)))
+        workers = maxWorkers
+
+    # decryption in a process pool - encrypted objects are downloaded to
+    # temp files and decrypted there
+    cryptoPool = openCryptoPool(config, 'RESTORE')
+    if (cryptoPool is not None):
+        logger.info("crypto pool: [{}] processes".format(cryptoPool.processes))
+
+    # one client - and one connection pool - shared by all download workers
+    # and the ranged GETs they start for big objects
+    logger.info("download workers: [{}]".format(workers))
+    ranged.executor = newPartExecutor(workers * ranged.rangesInFlight)
+    s3Client = connectToS3(config, workers * (ranged.rangesInFlight + 1),
+            controller.backoff if controller is not None else None)
+    requestBase = requestCounts(s3Client)
 
     # default s3 bucket (from config)    
     s3Bkt = config['S3']['s3.bucket_name']
@@ -242,61 +1944,233 @@ def doRestore(restoreDir, folder, q, config, logger, useQ, bucket):
     if (bucket != ""):
         s3Bkt = bucket
 
+    # restore mode - from config unless passed in
+    if (mode == ""):
+        mode = config.get('RESTORE', 'restore.mode', fallback='full')
+    if (mode not in RESTORE_MODES):
+        logger.error("unknown restore mode: [{}] - bailing out".format(mode))
+        ranged.executor.shutdown()
+        if (cryptoPool is not None):
+            cryptoPool.close()
+        return
+    logger.info("restore mode: [{}]".format(mode))
+
+    # incremental mode - local manifest of what this restore dir holds
+    state = None
+    if (mode == "incremental"):
+        manifestDir = config.get('BACKUP', 'backup.manifest_dir', fallback='./manifests')
+        manifest = FileManifest(manifestDir, s3Bkt,
+                "restore_{}_{}".format(folder, os.path.abspath(restoreDir)))
+        state = RestoreState(s3Client, s3Bkt, manifest, restoreDir)
+        logger.info("using manifest: [{}]".format(manifest.path))
+
+    # checkpoint journal - a stopped, crashed or failed restore is resumed
+    # by the next run.  incremental restores already skip objects that are
+    # on disk, so there it only tracks partly downloaded objects
+    journal = openJournal(config, "restore", s3Bkt, folder, restoreDir, {"mode": mode})
+    ranged.journal = journal
+
+    # the journal only describes the restore dir as the interrupted run left
+    # it - once files it restored are gone or changed it is started over
+    if (journal is not None and journal.resumed and state is None):
+        stale = sum(1 for rec in list(journal.files.values()) if not restoredFilesMatch(rec.get("files")))
+        if (stale > 0):
+            msg = "restore journal does not match [{}] - [{}] restored objects missing or changed".format(
+                    restoreDir, stale)
+            msg += " - starting over"
+            logger.warning(msg)
+            if (useQ):
+                q.put(msg)
+            journal.discard()
+
+    if (journal is not None and journal.resumed):
+        msg = "resuming interrupted restore - [{}] objects done - [{}] partial downloads".format(
+                len(journal.files), len(journal.ranges))
+        logger.info(msg)
+        if (useQ):
+            q.put(msg)
+
+    def restore(item):
+        # restored by the interrupted run this one resumes
+        if (journal is not None and state is None):
+            done = journal.completed(item.objName)
+            if (done is not None and done["etag"] == item.etag and restoredFilesMatch(done.get("files"))):
+                item.ok = True
+                item.resumed = True
+                return
+
+        if (controller is None):
+            restoreObject(s3Client, s3Bkt, item, restoreDir, fileEncryptionPass, logger, ranged, state,
+                    cryptoPool, wanted)
+            return
+
+        controller.acquire()
+        restoreStart = timeit.default_timer()
+        try:
+            restoreObject(s3Client, s3Bkt, item, restoreDir, fileEncryptionPass, logger, ranged, state,
+                    cryptoPool, wanted)
+        finally:
+            # unchanged objects move no data - they say nothing about the link
+            moved = item.size if (item.ok and not item.unchanged) else 0
+            controller.release(moved, timeit.default_timer() - restoreStart,
+                    item.ok or item.objName.endswith(PACK_INDEX_SUFFIX))
+
+
+    # the objects to restore come from the run manifest the last backup
+    # wrote - one GET instead of a listing.  folders without one are listed,
+    # or read from the object index
+    objectIndex = openObjectIndex(config)
+    items = None
+    if (config.getboolean('RESTORE', 'restore.use_manifest', fallback=True)):
+        items = plannedRestoreItems(s3Client, s3Bkt, folder, logger)
+
+    # selective restore - only objects holding files the selection picks.
+    # without a run manifest only the prefixes it can match are listed
+    wanted = None
+    if (selection is not None and selection.active()):
+        prefix = genS3Name(folder).rstrip("/") + "/"
+
+        # files of packs to extract
+        def wanted(name, mtime):
+            return selection.matches(restoreRelPath(prefix, name), mtime)
+
+        logger.info("selective restore: {}".format(selection.describe()))
+        if (items is None):
+            items = selectedRestoreItems(s3Client, s3Bkt, folder, selection, objectIndex)
+        items = list(selectRestoreItems(items, folder, selection))
+        msg = "restore selected: [{}] objects - [{}MB]".format(
+                len(items), round(sum(item.size for item in items) / (1024 * 1024), 2))
+    elif (items is not None):
+        msg = "restore planned from run manifest: [{}] objects - [{}MB]".format(
+                len(items), round(sum(item.size for item in items) / (1024 * 1024), 2))
+    else:
+        msg = "no run manifest - listing folder [{}]".format(folder)
+        items = listRestoreItems(s3Client, s3Bkt, folder, objectIndex)
+    logger.info(msg)
+    if (useQ):
+        q.put(msg)
+
+    # gui progress - planned restores know their totals up front, listed
+    # ones once the listing is done
+    progress = None
+    if (useQ):
+        progress = ProgressReporter(q, "restore")
+        if (isinstance(items, list)):
+            progress.setTotals(len(items), sum(item.size for item in items))
+        else:
+            items = countedItems(items, progress)
 
-    # list objects in bucket
     # write each object to a file
     # decrypt if necessary
-    objects = s3Client.list_objects(s3Bkt, prefix=folder, recursive=True)
+    pipeline = RestorePipeline(workers, isStopped, logger)
+    metrics = runMetrics(config, "restore", {"bucket": s3Bkt, "folder": folder, "mode": mode})
+
+    #
+    # failed downloads are held back while the main pass goes on, then
+    # retried with fewer workers.  the loop below sees each object once,
+    # in its final state
+    #
+    def isFailed(item):
+        return not (item.ok or item.unchanged or item.resumed or
+                    item.objName.endswith(PACK_INDEX_SUFFIX) or stopFlag)
+
+    def itemName(item):
+        return item.objName
+
+    def freshItem(item):
+        fresh = RestoreItem(item.objName, item.size, item.etag)
+        fresh.sha256 = item.sha256
+        fresh.codec = item.codec
+        fresh.mtime = item.mtime
+        fresh.files = item.files
+        return fresh
+
+    def retryTransfer(items):
+        retryWorkers = max(1, min(workers, config.getint('RESTORE', 'restore.retry_workers', fallback=2)))
+        return RestorePipeline(retryWorkers, isStopped, logger).run(iter(items), restore)
+
+    def restoreResults():
+        for item in pipeline.run(items, restore):
+            if (isFailed(item) and failures.hold(item)):
+                continue
+            yield item
+        yield from failures.retry(retryTransfer)
+
+    failures = failureQueue(config, 'RESTORE', isStopped, logger, itemName, isFailed, freshItem)
+
     objectCount = 0
-    for obj in objects:
+    skipCount = 0
+    failCount = 0
+    resumeCount = 0
+    for item in restoreResults():
         objectCount += 1
-        objName = obj.object_name
-        logger.info("{} object name: [{}]".format(objectCount, objName))
+        if (item.unchanged):
+            skipCount += 1
+        if (item.resumed):
+            resumeCount += 1
 
-        try:
-            data = s3Client.get_object(s3Bkt, objName)
-        except ResponseError as err:
-            print(err)
-            logger.error("error fetching object: [{}]".format(err))
-            continue
-
-        # convert object name to filename and make sure target directory exists
-        filename = restoreDir + "\\" + str(objName)
-        filename = filename.replace("/", "\\")    
-        tgtDir = os.path.dirname(filename)
-        if not os.path.exists(tgtDir):
-            os.makedirs(tgtDir)
-
-        # convert httpresponse to BytesIO
-        data1 = io.BytesIO(data.read())
-        datalen = len(data1.getvalue())
-        data1.seek(0)
-
-        # decrypt the file if it is encrypted
-        if (filename.endswith(".enc")):
-            logger.info("file is encrypted: decrypting")
-            bufferSize = 64 * 1024
-            decryptedFileName = filename[:-4]
-            
-            fDec = io.BytesIO()
-            pyAesCrypt.decryptStream(data1, fDec, fileEncryptionPass, bufferSize, datalen)
-
-            # new data and filename
-            filename = decryptedFileName
-            data1 = fDec
-            data1.seek(0)
-            
-
-        # write object data to a file
-        with open(filename, 'wb') as file_data:
-            file_data.write(data1.getvalue())
-
-        file_data.close()
+        # pack indexes are read with their pack and objects never started
+        # because of a stop count as skipped
+        if (item.ok and not item.unchanged and not item.resumed):
+            status = "ok"
+            files = restoredFiles(item) if journal is not None else None
+            if (files is not None):
+                journal.fileDone(item.objName, etag=item.etag, files=files)
+        elif (item.unchanged or item.resumed or item.objName.endswith(PACK_INDEX_SUFFIX) or stopFlag):
+            status = "skipped"
+        else:
+            status = "failed"
+            failCount += 1
+            failures.failed(item.objName, item.filename or restoreFilename(restoreDir, item.objName),
+                    item.error)
+            # the index may be out of date - list the folder next time
+            if (objectIndex is not None):
+                objectIndex.expire(s3Bkt, item.objName)
+        metrics.record(item.objName, status, item.size, item.runTime, item.retries)
+        logger.info("{} object name: [{}]".format(objectCount, item.objName))
         
+        if (progress is not None):
+            progress.fileDone(item.size, status == "failed",
+                    str(objectCount) + " | object name [{}]".format(item.objName))
+    # end loop
+    if (progress is not None):
+        progress.close()
+    ranged.executor.shutdown()
+    if (cryptoPool is not None):
+        cryptoPool.close()
+    if (objectIndex is not None):
+        objectIndex.close()
+
+    #
+    # incremental mode - optionally delete local files gone remotely
+    # only safe when the listing finished - otherwise expected is incomplete
+    #
+    if (state is not None):
+        removed = 0
+        if (config.getboolean('RESTORE', 'restore.delete_extra', fallback=False)):
+            if (stopFlag or pipeline.listError):
+                logger.info("listing incomplete - skipped deleting local files")
+            elif (wanted is not None):
+                logger.info("selective restore - skipped deleting local files")
+            else:
+                root = genRestoreName(restoreDir, genS3Name(folder).rstrip("/"))
+                removed = state.removeExtraFiles(root, logger)
+
+        state.manifest.close()
+        msg = "unchanged objects skipped: [{}] - local files deleted: [{}]".format(skipCount, removed)
+        logger.info(msg)
         if (useQ):
-            msg = str(objectCount) + " | object name [{}]".format(objName)
             q.put(msg)
-    # end loop
+
+    # the journal is only needed again when there is work left to redo
+    if (journal is not None):
+        journal.close(not stopFlag and not pipeline.listError and failCount == 0)
+        if (resumeCount > 0):
+            logger.info("objects skipped - restored by the interrupted run: [{}]".format(resumeCount))
+
+    logRunSummary(metrics.finish(requestCounts(s3Client, requestBase), stopFlag), logger)
+    status = reportFailures(config, "restore", {"bucket": s3Bkt, "folder": folder, "mode": mode},
+            failures, q, logger, useQ, pipeline.listError)
 
     stop = timeit.default_timer()
     runTime = stop - start
@@ -306,5 +2180,6 @@ def doRestore(restoreDir, folder, q, config, logger, useQ, bucket):
     
     if (useQ):
         q.put("Run Complete - run time: {}m {}s".format(minutes, seconds))
+    return status
 
-## end doRestore
\ No newline at end of file
+## end doRestore
@@ -0,0 +1,285 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+
+# the journal is fsynced at most this often - a crash loses at most this
+# much progress, which the next run simply redoes
+SYNC_INTERVAL = 1.0
+
+
+#
+# append-only checkpoint journal of one backup or restore run.
+#
+# every completed file, started multipart upload, finished part and
+# finished download range is appended as a json line.  a run that is
+# stopped, crashes or has failures leaves its journal behind and the next
+# run of the same job replays it to skip work that is already done.  a
+# run that finishes cleanly deletes it.  the first line records the
+# settings the run was made with - a journal written with other settings
+# is thrown away.
+#
+class CheckpointJournal:
+
+    def __init__(self, journalDir, kind, bucket, folder, source, settings):
+        os.makedirs(journalDir, exist_ok=True)
+        self.path = os.path.join(journalDir, journalName(kind, bucket, folder, source))
+        self.lock = threading.Lock()
+        self.files = dict()         # name -> file record
+        self.uploads = dict()       # name -> multipart upload record with its parts
+        self.ranges = dict()        # name -> {"etag", "rangeSize", "done": {n: md5}}
+        self.meta = dict()          # run level values, e.g. the snapshot being written
+        self.lastSync = time.monotonic()
+        self.header = {"t": "run", "kind": kind, "settings": settings}
+
+        self.resumed = self._replay(self.header)
+        if (not self.resumed):
+            self._clear()
+        self._compact(self.header)
+
+    def _clear(self):
+        self.files.clear()
+        self.uploads.clear()
+        self.ranges.clear()
+        self.meta.clear()
+
+    # forget the replayed state - what it describes is gone, e.g. the
+    # files of a restore were deleted since
+    def discard(self):
+        with self.lock:
+            self.out.close()
+            self._clear()
+            self.resumed = False
+            self._compact(self.header)
+
+    # rewrite the journal with just the live state - drops a torn last
+    # line and keeps the journal from growing across many resumes
+    def _compact(self, header):
+        tmpName = self.path + ".tmp"
+        self.out = open(tmpName, 'w')
+        self._write(header)
+        for key, value in self.meta.items():
+            self._write({"t": "meta", "key": key, "value": value})
+        for rec in self.files.values():
+            self._write(rec)
+        for name, upload in self.uploads.items():
+            rec = dict(upload)
+            parts = rec.pop("parts")
+            self._write(rec)
+            for n, etag in parts.items():
+                self._write({"t": "part", "name": name, "uploadId": upload["uploadId"],
+                             "n": n, "etag": etag})
+        for name, ranges in self.ranges.items():
+            for n, md5 in ranges["done"].items():
+                self._write({"t": "range", "name": name, "etag": ranges["etag"],
+                             "rangeSize": ranges["rangeSize"], "n": n, "md5": md5})
+        os.fsync(self.out.fileno())
+        self.out.close()
+        os.replace(tmpName, self.path)
+        self.out = open(self.path, 'a')
+
+    # load an earlier journal - returns True when it belongs to this job
+    def _replay(self, header):
+        if (not os.path.exists(self.path)):
+            return False
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        if (len(lines) == 0):
+            return False
+        try:
+            if (json.loads(lines[0]) != header):
+                return False
+        except ValueError:
+            return False
+
+        for line in lines[1:]:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                # torn write at a crash - everything after it is lost
+                break
+            self._apply(rec)
+        return True
+
+    def _apply(self, rec):
+        t = rec["t"]
+        name = rec.get("name")
+        if (t == "file"):
+            self.files[name] = rec
+            self.uploads.pop(name, None)
+            self.ranges.pop(name, None)
+        elif (t == "mpu"):
+            rec["parts"] = dict()
+            self.uploads[name] = rec
+        elif (t == "part"):
+            upload = self.uploads.get(name)
+            if (upload is not None and upload["uploadId"] == rec["uploadId"]):
+                upload["parts"][rec["n"]] = rec["etag"]
+        elif (t == "range"):
+            ranges = self.ranges.get(name)
+            if (ranges is None or ranges["etag"] != rec["etag"] or ranges["rangeSize"] != rec["rangeSize"]):
+                ranges = {"etag": rec["etag"], "rangeSize": rec["rangeSize"], "done": dict()}
+                self.ranges[name] = ranges
+            ranges["done"][rec["n"]] = rec["md5"]
+        elif (t == "drop"):
+            self.uploads.pop(name, None)
+            self.ranges.pop(name, None)
+        elif (t == "meta"):
+            self.meta[rec["key"]] = rec["value"]
+
+    def _write(self, rec, sync=False):
+        self.out.write(json.dumps(rec, separators=(",", ":")) + "\n")
+        self.out.flush()
+        now = time.monotonic()
+        if (sync or now - self.lastSync >= SYNC_INTERVAL):
+            os.fsync(self.out.fileno())
+            self.lastSync = now
+
+    def record(self, rec):
+        with self.lock:
+            if (self.out is None):
+                return
+            self._apply(dict(rec))
+            self._write(rec)
+
+    # record of a file finished by an earlier run, or None
+    def completed(self, name):
+        with self.lock:
+            return self.files.get(name)
+
+    def fileDone(self, name, **fields):
+        rec = {"t": "file", "name": name}
+        rec.update(fields)
+        self.record(rec)
+
+    def setMeta(self, key, value):
+        self.record({"t": "meta", "key": key, "value": value})
+
+    # upload ids of multipart uploads the journal can resume
+    def uploadIds(self):
+        with self.lock:
+            return set(u["uploadId"] for u in self.uploads.values())
+
+    # forget uploads that no longer exist on the server
+    def dropUploads(self, liveIds):
+        with self.lock:
+            gone = [name for name, u in self.uploads.items() if u["uploadId"] not in liveIds]
+        for name in gone:
+            self.record({"t": "drop", "name": name})
+        return len(gone)
+
+    # multipart upload of name started by an earlier run for the same
+    # source file (size, mtime), or None
+    def pendingUpload(self, name, size, mtime):
+        with self.lock:
+            upload = self.uploads.get(name)
+            if (upload is None or upload["size"] != size or upload["mtime"] != mtime):
+                return None
+            return upload
+
+    def uploadCheckpoint(self, name, size, mtime):
+        return UploadCheckpoint(self, name, size, mtime, self.pendingUpload(name, size, mtime))
+
+    def rangeCheckpoint(self, name, etag):
+        with self.lock:
+            ranges = self.ranges.get(name)
+            if (ranges is not None and ranges["etag"] != etag):
+                ranges = None
+        return RangeCheckpoint(self, name, etag, ranges)
+
+    # clean is True when the run finished with nothing left to redo
+    def close(self, clean):
+        with self.lock:
+            if (self.out is None):
+                return
+            os.fsync(self.out.fileno())
+            self.out.close()
+            self.out = None
+        if (clean):
+            os.remove(self.path)
+
+
+#
+# resume state of one multipart upload - the upload id and the etags of
+# the parts that are already on the server
+#
+class UploadCheckpoint:
+
+    def __init__(self, journal, name, size, mtime, upload):
+        self.journal = journal
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.uploadId = upload["uploadId"] if upload else None
+        self.partSize = upload["partSize"] if upload else 0
+        self.parts = dict(upload["parts"]) if upload else dict()
+
+    def started(self, uploadId, partSize):
+        self.uploadId = uploadId
+        self.partSize = partSize
+        self.parts = dict()
+        self.journal.record({"t": "mpu", "name": self.name, "uploadId": uploadId,
+                             "partSize": partSize, "size": self.size, "mtime": self.mtime})
+
+    def partDone(self, partNumber, etag):
+        self.journal.record({"t": "part", "name": self.name, "uploadId": self.uploadId,
+                             "n": partNumber, "etag": etag})
+
+    # etag of a part the server already holds with the same data, or None
+    def resumedPart(self, partNumber, data):
+        etag = self.parts.get(partNumber)
+        if (etag is not None and etag.replace('"', '') == hashlib.md5(data).hexdigest()):
+            return etag
+        return None
+
+
+#
+# resume state of one ranged download - the ranges of the temp file that
+# are already written, with their md5
+#
+class RangeCheckpoint:
+
+    def __init__(self, journal, name, etag, ranges):
+        self.journal = journal
+        self.name = name
+        self.etag = etag
+        self.rangeSize = ranges["rangeSize"] if ranges else 0
+        self.done = dict(ranges["done"]) if ranges else dict()
+
+    # ranges already written for this range size
+    def resumed(self, rangeSize):
+        if (rangeSize != self.rangeSize):
+            return dict()
+        return self.done
+
+    def rangeDone(self, rangeSize, index, md5):
+        self.journal.record({"t": "range", "name": self.name, "etag": self.etag,
+                             "rangeSize": rangeSize, "n": index, "md5": md5})
+
+    # the temp file is gone or bad - start the object over
+    def reset(self):
+        self.done = dict()
+        self.rangeSize = 0
+        self.journal.record({"t": "drop", "name": self.name})
+
+
+#
+# journal filename for a job
+#
+def journalName(kind, bucket, folder, source):
+    digest = hashlib.sha1(os.path.abspath(source).encode("utf8")).hexdigest()[:12]
+    name = "{}_{}_{}".format(kind, bucket, folder)
+    name = re.sub(r'[^A-Za-z0-9._-]+', '_', name)
+    return "{}_{}.journal".format(name, digest)
+
+
+#
+# checkpoint journal for a job from the config, or None when turned off
+#
+def openJournal(config, kind, bucket, folder, source, settings):
+    if (not config.getboolean('BACKUP', 'backup.checkpoint', fallback=True)):
+        return None
+    journalDir = config.get('BACKUP', 'backup.checkpoint_dir', fallback='./checkpoints')
+    return CheckpointJournal(journalDir, kind, bucket, folder, source, settings)
@@ -0,0 +1,331 @@
+import io
+import json
+import hmac
+import random
+import hashlib                          # chunk ids
+import threading
+from concurrent.futures import Future
+
+from aead_crypt import encryptAny, decryptBytes
+
+# numpy is optional - without it chunk boundaries are found by a python
+# loop over every byte, which only manages a few MB/s
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# suffix of the per-file chunk list objects
+CHUNK_LIST_SUFFIX = ".chunks"
+
+# gear table for the rolling hash - fixed seed so every run and every
+# host cuts the same content at the same places
+_rnd = random.Random(0x5EED)
+GEAR = [_rnd.getrandbits(64) for i in range(256)]
+MASK64 = (1 << 64) - 1
+
+# bytes hashed per numpy pass - small enough for the arrays to stay in
+# the cpu cache, and bytes after the cut point are not hashed for nothing
+SCAN_BLOCK = 32 * 1024
+
+
+#
+# content-defined chunker (fastcdc style gear hash with normalized
+# chunking).  boundaries depend only on nearby content, so an edit in
+# the middle of a file only changes the chunks around the edit.
+#
+# the hash at a byte only depends on the 64 bytes before it (older ones
+# are shifted out), so with numpy it is worked out for a whole block at
+# once.  both ways cut the same content at the same places
+#
+class Chunker:
+
+    def __init__(self, minSize, avgSize, maxSize):
+        self.minSize = minSize
+        self.avgSize = avgSize
+        self.maxSize = maxSize
+        bits = max(avgSize.bit_length() - 1, 1)
+        # harder to match before the average size, easier after it
+        self.maskS = (1 << (bits + 1)) - 1
+        self.maskL = (1 << (bits - 1)) - 1
+        self.gear = None
+        if (numpy is not None):
+            self.gear = numpy.array(GEAR, dtype=numpy.uint64)
+
+    # length of the next chunk at the start of buf - buf holds at least
+    # maxSize bytes unless the end of the file has been reached
+    def cutPoint(self, buf):
+        n = len(buf)
+        if (n <= self.minSize):
+            return n
+        if (n > self.maxSize):
+            n = self.maxSize
+
+        normal = min(self.avgSize, n)
+        if (self.gear is not None):
+            return self.blockCutPoint(buf, n, normal)
+        gear = GEAR
+        maskS = self.maskS
+        maskL = self.maskL
+        h = 0
+        i = self.minSize
+        while (i < normal):
+            h = ((h << 1) + gear[buf[i]]) & MASK64
+            if not (h & maskS):
+                return i + 1
+            i += 1
+        while (i < n):
+            h = ((h << 1) + gear[buf[i]]) & MASK64
+            if not (h & maskL):
+                return i + 1
+            i += 1
+        return n
+
+    # cutPoint with numpy.  h at byte i is the sum of gear[buf[i - k]] << k
+    # for the bytes since minSize, k < 64 - built up by doubling the
+    # number of bytes summed six times
+    def blockCutPoint(self, buf, n, normal):
+        view = memoryview(buf)
+        u64 = numpy.uint64
+        start = self.minSize
+        while (start < n):
+            end = min(start + SCAN_BLOCK, n)
+            # the 63 bytes before the block - zero before minSize
+            lo = max(self.minSize, start - 63)
+            h = numpy.zeros(63 + end - start, dtype=u64)
+            h[63 - (start - lo):] = self.gear[numpy.frombuffer(view[lo:end], dtype=numpy.uint8)]
+            shift = 1
+            while (shift < 64):
+                h[shift:] += h[:-shift] << u64(shift)
+                shift *= 2
+            h = h[63:]
+
+            # first byte whose hash matches the mask of its position
+            split = min(max(normal - start, 0), end - start)
+            hits = numpy.flatnonzero((h[:split] & u64(self.maskS)) == 0)
+            if (len(hits) == 0):
+                hits = numpy.flatnonzero((h[split:] & u64(self.maskL)) == 0) + split
+            if (len(hits) > 0):
+                return start + int(hits[0]) + 1
+            start = end
+        return n
+
+    # yield the chunks of a file object, reading it block by block
+    def chunks(self, f):
+        buf = bytearray()
+        eof = False
+        while True:
+            while (not eof and len(buf) < self.maxSize):
+                data = f.read(self.maxSize * 2)
+                if not data:
+                    eof = True
+                buf += data
+
+            if (len(buf) == 0):
+                break
+            cut = self.cutPoint(buf)
+            yield bytes(buf[:cut])
+            del buf[:cut]
+
+
+#
+# deduplicated chunk store in a bucket.  each unique chunk is stored once
+# under <repo>/chunks/<id[:2]>/<id>.  with encryption on, chunk ids are
+# keyed with the password so they do not reveal the plaintext hash, and
+# each chunk is encrypted on its own - in the aead format when
+# encryptionKey (an aead_crypt.EncryptionKey) is set.  with an object
+# index the chunks already stored are read from it instead of a listing.
+#
+class ChunkStore:
+
+    def __init__(self, s3Client, s3Bkt, repo, encryptionPass, encryptionKey=None, objectIndex=None):
+        self.s3Client = s3Client
+        self.s3Bkt = s3Bkt
+        self.repo = repo.strip("/")
+        self.encryptionPass = encryptionPass
+        self.encryptionKey = encryptionKey
+        self.objectIndex = objectIndex
+        self.known = set()
+        self.pending = dict()       # chunk id -> Future of an upload in progress
+        self.lock = threading.Lock()
+        self.idKey = None
+        if (encryptionPass):
+            self.idKey = hashlib.sha256(b"chunk-id:" + encryptionPass.encode("utf8")).digest()
+
+    # load the ids of chunks already in the bucket
+    def loadKnown(self):
+        prefix = self.repo + "/chunks/"
+        if (self.objectIndex is not None):
+            names = (obj[0] for obj in self.objectIndex.listing(self.s3Client, self.s3Bkt, prefix))
+        else:
+            names = (obj.object_name for obj in self.s3Client.list_objects(self.s3Bkt, prefix=prefix,
+                                                                           recursive=True))
+        for name in names:
+            self.known.add(name.rsplit("/", 1)[-1])
+        return len(self.known)
+
+    def chunkId(self, chunk):
+        if (self.idKey is not None):
+            return hmac.new(self.idKey, chunk, hashlib.sha256).hexdigest()
+        return hashlib.sha256(chunk).hexdigest()
+
+    def chunkKey(self, chunkId):
+        return "{}/chunks/{}/{}".format(self.repo, chunkId[:2], chunkId)
+
+    # reserve a chunk id for upload.  returns (True, future) when the
+    # caller must upload it and then call finish, otherwise (False, future)
+    # where future is another thread's upload of the same chunk, or None
+    # when it is already stored
+    def claim(self, chunkId):
+        with self.lock:
+            if (chunkId in self.pending):
+                return False, self.pending[chunkId]
+            if (chunkId in self.known):
+                return False, None
+            future = Future()
+            self.pending[chunkId] = future
+            return True, future
+
+    def finish(self, chunkId, err=None):
+        with self.lock:
+            future = self.pending.pop(chunkId)
+            if (err is None):
+                self.known.add(chunkId)
+        if (err is None):
+            future.set_result(True)
+        else:
+            future.set_exception(err)
+
+    def putChunk(self, chunkId, chunk):
+        data = chunk
+        if (self.encryptionPass):
+            fCiph = io.BytesIO()
+            encryptAny(io.BytesIO(chunk), fCiph, self.encryptionPass, self.encryptionKey)
+            data = fCiph.getvalue()
+        etag = self.s3Client.put_object(self.s3Bkt, self.chunkKey(chunkId), io.BytesIO(data), len(data))
+        if (self.objectIndex is not None):
+            self.objectIndex.put(self.s3Bkt, self.chunkKey(chunkId), len(data), etag)
+
+    def getChunk(self, chunkId, encrypted):
+        response = self.s3Client.get_object(self.s3Bkt, self.chunkKey(chunkId))
+        try:
+            data = response.read()
+        finally:
+            response.close()
+            response.release_conn()
+        if (encrypted):
+            data = decryptBytes(data, self.encryptionPass)
+        return data
+
+
+#
+# split a file into chunks and upload the ones the store does not have.
+# chunk uploads run on executor with at most inFlight outstanding.
+# returns (chunk list, new chunks, new bytes, sha256 of the file), or
+# None when stopped.  raises if any chunk the file needs failed to upload,
+# including ones uploaded for another file at the same time.
+#
+def storeFileChunks(store, chunker, filename, executor, inFlight, shouldStop):
+    slots = threading.BoundedSemaphore(max(1, inFlight))
+    chunkList = list()
+    waits = list()
+    failed = list()
+    fileHash = hashlib.sha256()
+    newChunks = 0
+    newBytes = 0
+    stopped = False
+
+    def upload(chunkId, chunk):
+        try:
+            store.putChunk(chunkId, chunk)
+            store.finish(chunkId)
+        except Exception as err:
+            store.finish(chunkId, err)
+            failed.append(err)
+        finally:
+            slots.release()
+
+    with open(filename, 'rb') as f:
+        for chunk in chunker.chunks(f):
+            if (shouldStop() or len(failed) > 0):
+                stopped = True
+                break
+            fileHash.update(chunk)
+            chunkId = store.chunkId(chunk)
+            chunkList.append([chunkId, len(chunk)])
+            mine, future = store.claim(chunkId)
+            if (future is not None):
+                waits.append(future)
+            if (mine):
+                slots.acquire()
+                newChunks += 1
+                newBytes += len(chunk)
+                executor.submit(upload, chunkId, chunk)
+
+    # every chunk this file refers to must be stored before its list is
+    for future in waits:
+        err = future.exception()
+        if (err is not None):
+            raise err
+
+    if (stopped):
+        return None
+    return chunkList, newChunks, newBytes, fileHash.hexdigest()
+
+
+#
+# chunk list object for a file
+#
+def chunkListData(store, chunkList, size, sha256):
+    doc = {
+        "version": 1,
+        "repo": store.repo,
+        "size": size,
+        "sha256": sha256,
+        "encrypted": bool(store.encryptionPass),
+        "chunks": chunkList,
+    }
+    return json.dumps(doc, separators=(",", ":")).encode("utf8")
+
+
+#
+# rebuild a file from its chunk list.  chunks are fetched in parallel on
+# executor and written at their offsets through writer
+# (a ranged_download.PositionalWriter).  every chunk is checked against
+# its id, which covers the whole file.  returns False when stopped.
+#
+def restoreFileChunks(store, doc, writer, executor, inFlight, shouldStop):
+    slots = threading.BoundedSemaphore(max(1, inFlight))
+    encrypted = doc.get("encrypted", False)
+    futures = list()
+    failed = list()
+
+    def fetch(chunkId, length, offset):
+        try:
+            data = store.getChunk(chunkId, encrypted)
+            if (len(data) != length or store.chunkId(data) != chunkId):
+                raise ValueError("chunk {} does not match its id".format(chunkId))
+            writer.write(data, offset)
+        except Exception as err:
+            failed.append(err)
+            raise
+        finally:
+            slots.release()
+
+    offset = 0
+    try:
+        for chunkId, length in doc["chunks"]:
+            slots.acquire()
+            if (shouldStop() or len(failed) > 0):
+                slots.release()
+                break
+            futures.append(executor.submit(fetch, chunkId, length, offset))
+            offset += length
+
+        for future in futures:
+            future.result()
+    finally:
+        for future in futures:
+            future.exception()
+
+    return len(futures) == len(doc["chunks"])
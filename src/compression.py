@@ -0,0 +1,146 @@
+import os
+import zlib
+import math
+from collections import Counter
+
+# zstandard is optional - zlib is used when it is not installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# object metadata recording the codec an object was compressed with
+CODEC_META = "x-amz-meta-codec"
+
+CODECS = ("zlib", "zstd")
+
+# extensions of files that are already compressed - not worth another pass
+INCOMPRESSIBLE_EXTS = {
+    ".gz", ".tgz", ".bz2", ".tbz2", ".xz", ".txz", ".zst", ".lz4", ".lzma", ".7z",
+    ".zip", ".rar", ".cab", ".jar", ".war", ".apk", ".whl", ".docx", ".xlsx", ".pptx",
+    ".odt", ".ods", ".odp", ".epub", ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic",
+    ".mp3", ".mp4", ".m4a", ".m4v", ".mkv", ".mov", ".avi", ".webm", ".ogg", ".flac",
+    ".aac", ".pdf", ".enc", ".aes", ".gpg",
+}
+
+# sample taken from the file to judge how compressible it is
+SAMPLE_SIZE = 64 * 1024
+
+# bits per byte above which a sample is treated as incompressible
+ENTROPY_LIMIT = 7.5
+
+
+#
+# codec to use for a configured compression setting ("", zlib or zstd)
+# falls back to zlib when zstandard is not installed
+#
+def resolveCodec(setting):
+    setting = (setting or "").strip().lower()
+    if (setting in ("", "none", "off", "false")):
+        return ""
+    if (setting not in CODECS):
+        raise ValueError("unknown compression codec: [{}]".format(setting))
+    if (setting == "zstd" and zstandard is None):
+        return "zlib"
+    return setting
+
+
+#
+# shannon entropy of a byte string in bits per byte
+#
+def entropy(data):
+    if (len(data) == 0):
+        return 0.0
+    total = len(data)
+    bits = 0.0
+    for c in Counter(data).values():
+        p = c / total
+        bits -= p * math.log2(p)
+    return bits
+
+
+#
+# quick check whether a file is worth compressing - looks at the extension
+# first, then at the entropy of a sample from the start and the middle
+#
+def isCompressible(filename, size):
+    ext = os.path.splitext(filename)[1].lower()
+    if (ext in INCOMPRESSIBLE_EXTS):
+        return False
+    if (size < 64):
+        return False
+
+    half = SAMPLE_SIZE // 2
+    with open(filename, 'rb') as f:
+        sample = f.read(half)
+        if (size > SAMPLE_SIZE):
+            f.seek(size // 2)
+            sample += f.read(half)
+    return entropy(sample) < ENTROPY_LIMIT
+
+
+def _compressor(codec, level):
+    if (codec == "zstd"):
+        return zstandard.ZstdCompressor(level=level or 3).compressobj()
+    return zlib.compressobj(level if level else zlib.Z_DEFAULT_COMPRESSION)
+
+
+def _decompressor(codec):
+    if (codec == "zstd"):
+        if (zstandard is None):
+            raise ValueError("object is zstd compressed but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompressobj()
+    if (codec == "zlib"):
+        return zlib.decompressobj()
+    raise ValueError("unknown compression codec: [{}]".format(codec))
+
+
+#
+# read() view of a file that returns its compressed bytes.  reads return
+# exactly n bytes until the end of the stream, as pyAesCrypt expects.
+#
+class CompressingReader:
+
+    def __init__(self, f, codec, level=0, blockSize=1024 * 1024):
+        self.f = f
+        self.blockSize = blockSize
+        self.comp = _compressor(codec, level)
+        self.buf = bytearray()
+        self.eof = False
+
+    def read(self, n=-1):
+        while (not self.eof and (n is None or n < 0 or len(self.buf) < n)):
+            data = self.f.read(self.blockSize)
+            if data:
+                self.buf += self.comp.compress(data)
+            else:
+                self.buf += self.comp.flush()
+                self.eof = True
+
+        if (n is None or n < 0):
+            n = len(self.buf)
+        out = bytes(self.buf[:n])
+        del self.buf[:n]
+        return out
+
+
+#
+# file-like object that decompresses everything written to it into f.
+# close() checks the stream was complete; it does not close f.
+#
+class DecompressingWriter:
+
+    def __init__(self, f, codec):
+        self.f = f
+        self.codec = codec
+        self.decomp = _decompressor(codec)
+
+    def write(self, data):
+        self.f.write(self.decomp.decompress(data))
+        return len(data)
+
+    def close(self):
+        if (self.codec == "zlib"):
+            self.f.write(self.decomp.flush())
+            if (not self.decomp.eof):
+                raise ValueError("compressed stream is truncated")
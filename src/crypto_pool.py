@@ -0,0 +1,91 @@
+import os
+import tempfile
+import timeit                           # for timing the work done in a process
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from compression import CompressingReader, DecompressingWriter
+from aead_crypt import encryptAny, decryptAny
+
+#
+# runs in a pool process - compress (when codec is set) and encrypt the
+# file src into the file dst, in the aead format when key is set.  only the
+# names (and the small key) cross the process boundary.
+# returns the seconds it took
+#
+def encryptFile(src, dst, password, codec="", level=0, key=None):
+    start = timeit.default_timer()
+    with open(src, 'rb') as source, open(dst, 'wb') as sink:
+        reader = source
+        if (codec):
+            reader = CompressingReader(source, codec, level)
+        encryptAny(reader, sink, password, key)
+    return timeit.default_timer() - start
+
+
+#
+# runs in a pool process - decrypt the file src (either format) into the
+# file dst, decompressing it on the way when codec is set.  returns the seconds it took
+#
+def decryptFile(src, dst, password, codec=""):
+    start = timeit.default_timer()
+    with open(src, 'rb') as source, open(dst, 'wb') as sink:
+        writer = sink
+        if (codec):
+            writer = DecompressingWriter(sink, codec)
+        decryptAny(source, writer, password, os.path.getsize(src))
+        if (codec):
+            writer.close()
+    return timeit.default_timer() - start
+
+
+#
+# pool of processes that encrypt and decrypt whole files, so aes crypt
+# runs on every core instead of on one core behind the gil.  callers
+# block on the result in their own worker thread.
+#
+# processes are started with spawn - forking a process that is already
+# running threads can leave locks held in the child.  scripts that use
+# the pool need an `if __name__ == "__main__":` guard.
+#
+class CryptoPool:
+
+    def __init__(self, processes, spoolDir=""):
+        self.processes = processes or os.cpu_count() or 1
+        self.spoolDir = spoolDir or None
+        if (self.spoolDir is not None):
+            os.makedirs(self.spoolDir, exist_ok=True)
+        self.executor = ProcessPoolExecutor(max_workers=self.processes,
+                mp_context=multiprocessing.get_context("spawn"))
+
+    # encrypt src into a new spool file - returns (spool file name, seconds).
+    # the caller removes the spool file once it is uploaded
+    def encrypt(self, src, password, codec="", level=0, key=None):
+        fd, spoolName = tempfile.mkstemp(dir=self.spoolDir, prefix="s3bkup-", suffix=".enc")
+        os.close(fd)
+        try:
+            seconds = self.executor.submit(encryptFile, src, spoolName, password, codec, level,
+                    key).result()
+        except BaseException:
+            os.remove(spoolName)
+            raise
+        return spoolName, seconds
+
+    # decrypt src into dst - returns the seconds it took
+    def decrypt(self, src, dst, password, codec=""):
+        return self.executor.submit(decryptFile, src, dst, password, codec).result()
+
+    def close(self):
+        self.executor.shutdown()
+
+
+#
+# crypto pool for backups or restores from the config, or None when turned off
+# section is "BACKUP" or "RESTORE"
+#
+def openCryptoPool(config, section):
+    key = section.lower()
+    if (not config.getboolean(section, key + '.crypto_pool', fallback=False)):
+        return None
+    return CryptoPool(config.getint(section, key + '.crypto_processes', fallback=0),
+                      config.get('BACKUP', 'backup.crypto_spool_dir', fallback=''))
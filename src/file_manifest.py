@@ -0,0 +1,100 @@
+import os
+import re
+import sqlite3                          # persistent manifest storage
+import hashlib                          # for content hashes
+import threading
+
+#
+# local manifest of files that have been backed up to a bucket/folder.
+# one sqlite database per bucket/folder pair, one row per source file.
+#
+class FileManifest:
+
+    def __init__(self, manifestDir, bucket, folder):
+        if not os.path.exists(manifestDir):
+            os.makedirs(manifestDir)
+
+        self.path = os.path.join(manifestDir, manifestName(bucket, folder))
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS files ("
+                        "path TEXT PRIMARY KEY, "
+                        "size INTEGER, "
+                        "mtime REAL, "
+                        "sha256 TEXT, "
+                        "object_name TEXT, "
+                        "etag TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)")
+        self.db.commit()
+
+    # returns (size, mtime, sha256, object_name, etag) or None
+    def get(self, path):
+        with self.lock:
+            cur = self.db.execute("SELECT size, mtime, sha256, object_name, etag "
+                                  "FROM files WHERE path = ?", (path,))
+            return cur.fetchone()
+
+    def put(self, path, size, mtime, sha256, objectName, etag):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO files "
+                            "(path, size, mtime, sha256, object_name, etag) "
+                            "VALUES (?, ?, ?, ?, ?, ?)",
+                            (path, size, mtime, sha256, objectName, etag))
+            self._commitEvery()
+
+    def remove(self, path):
+        with self.lock:
+            self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+            self._commitEvery()
+
+    # object names of files with content sha256 (at most limit)
+    def findHash(self, sha256, limit=8):
+        with self.lock:
+            cur = self.db.execute("SELECT object_name FROM files WHERE sha256 = ? LIMIT ?",
+                                  (sha256, limit))
+            return [row[0] for row in cur.fetchall()]
+
+    # all (path, object_name) pairs currently in the manifest
+    def entries(self):
+        with self.lock:
+            return self.db.execute("SELECT path, object_name FROM files").fetchall()
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+    # commit in batches so an interrupted run keeps most of its progress
+    def _commitEvery(self, batch=500):
+        self.pending += 1
+        if (self.pending >= batch):
+            self.db.commit()
+            self.pending = 0
+
+
+#
+# manifest filename for a bucket/folder pair
+#
+def manifestName(bucket, folder):
+    name = "{}_{}".format(bucket, folder)
+    name = re.sub(r'[^A-Za-z0-9._-]+', '_', name)
+    return name + ".db"
+
+
+#
+# sha256 of a file, read in chunks
+#
+def hashFile(filename, bufferSize=1024 * 1024):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(bufferSize)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
@@ -0,0 +1,387 @@
+import io
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from urllib.parse import quote
+from minio.definitions import UploadPart    # part record for completing uploads
+from minio.parsers import S3Element         # for copy part responses
+
+# s3 limits for multipart uploads
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PART_COUNT = 10000
+
+# largest object a single server side copy can create - bigger ones are
+# copied part by part
+MAX_COPY_SIZE = 5 * 1024 * 1024 * 1024
+
+# object metadata recording the part size of a multipart upload, so the
+# etag can be verified after a ranged download
+PART_SIZE_META = "x-amz-meta-part-size"
+
+
+#
+# metadata for a multipart upload with the given part size
+#
+def partSizeMeta(partSize, metadata=None):
+    meta = dict(metadata or {})
+    meta[PART_SIZE_META] = str(partSize)
+    return meta
+
+
+#
+# raised inside a streaming upload when the stop flag is set
+#
+class UploadStopped(Exception):
+    pass
+
+
+#
+# low level multipart calls.  minio 6 only exposes these as private methods
+# of the client, so they are kept together here.
+#
+def newMultipartUpload(s3Client, s3Bkt, objName, metadata=None):
+    return s3Client._new_multipart_upload(s3Bkt, objName, metadata)
+
+def putPart(s3Client, s3Bkt, objName, uploadId, partNumber, data):
+    result = s3Client._do_put_object(s3Bkt, objName, data, len(data), uploadId, partNumber)
+    return result[0] if isinstance(result, tuple) else result
+
+#
+# upload one part, retrying it on its own with backoff before giving up
+#
+def putPartWithRetry(s3Client, s3Bkt, objName, uploadId, partNumber, data, retries, retryCount=None):
+    attempt = 0
+    while True:
+        try:
+            return putPart(s3Client, s3Bkt, objName, uploadId, partNumber, data)
+        except Exception:
+            attempt += 1
+            if (attempt > retries):
+                raise
+            if (retryCount is not None):
+                retryCount.add()
+            time.sleep(min(0.5 * (2 ** attempt), 10) * random.uniform(0.5, 1.0))
+
+def completeMultipartUpload(s3Client, s3Bkt, objName, uploadId, partEtags, partSizes):
+    parts = dict()
+    for partNumber, etag in partEtags.items():
+        parts[partNumber] = UploadPart(s3Bkt, objName, uploadId, partNumber,
+                                       etag, None, partSizes.get(partNumber, 0))
+    result = s3Client._complete_multipart_upload(s3Bkt, objName, uploadId, parts)
+    if isinstance(result, tuple):
+        result = result[0]
+    return result.etag.replace('"', '')
+
+# server side copy of a byte range of source into a part (UploadPartCopy)
+def copyPart(s3Client, s3Bkt, objName, uploadId, partNumber, source, offset, length):
+    headers = {
+        "X-Amz-Copy-Source": quote("{}/{}".format(s3Bkt, source)),
+        "X-Amz-Copy-Source-Range": "bytes={}-{}".format(offset, offset + length - 1),
+    }
+    response = s3Client._url_open("PUT", bucket_name=s3Bkt, object_name=objName,
+            query={"partNumber": str(partNumber), "uploadId": uploadId}, headers=headers)
+    return S3Element.fromstring("CopyPartResult", response.data).get_etag_elem().replace('"', '')
+
+def abortMultipartUpload(s3Client, s3Bkt, objName, uploadId):
+    s3Client._remove_incomplete_upload(s3Bkt, objName, uploadId)
+
+def listIncompleteUploads(s3Client, s3Bkt, prefix):
+    return s3Client._list_incomplete_uploads(s3Bkt, prefix, recursive=True,
+                                             is_aggregate_size=False)
+
+
+#
+# part size for an upload of roughly sizeHint bytes - grows past partSize
+# when needed to stay under the s3 limit of 10000 parts
+#
+def choosePartSize(partSize, sizeHint):
+    partSize = max(partSize, MIN_PART_SIZE)
+    needed = -(-sizeHint // (MAX_PART_COUNT - 100))
+    if (needed > partSize):
+        mb = 1024 * 1024
+        partSize = -(-needed // mb) * mb
+    return partSize
+
+
+#
+# thread pool shared by all multipart uploads in a run
+#
+def newPartExecutor(threads):
+    return ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix="part")
+
+
+#
+# file-like object that uploads everything written to it as a multipart
+# upload of unknown total length.  written bytes are cut into parts of
+# partSize and handed to the shared part executor; at most partsInFlight
+# parts of this upload are buffered or uploading at once, so memory use
+# is bounded by partSize * partsInFlight no matter how big the stream is.
+#
+# a stream that ends before filling a single part is sent with one
+# put_object instead.
+#
+# with a checkpoint (see checkpoint.py) the upload id and finished parts
+# are journaled.  a rerun continues the same upload and skips parts the
+# server already holds with the same data, and a stopped or failed upload
+# is left on the server for the next run instead of being aborted.
+#
+class MultipartWriter:
+
+    def __init__(self, s3Client, s3Bkt, objName, partSize, partsInFlight,
+                 executor, shouldStop, metadata=None, retries=0, retryCount=None,
+                 checkpoint=None):
+        self.s3Client = s3Client
+        self.s3Bkt = s3Bkt
+        self.objName = objName
+        self.partSize = max(partSize, MIN_PART_SIZE)
+        self.executor = executor
+        self.shouldStop = shouldStop
+        self.metadata = metadata
+        self.retries = retries
+        self.retryCount = retryCount
+        self.checkpoint = checkpoint
+        self.slots = threading.BoundedSemaphore(max(1, partsInFlight))
+        self.buf = bytearray()
+        self.uploadId = None
+        self.partNumber = 0
+        self.futures = list()
+        self.partSizes = dict()
+        self.length = 0
+        self.error = None
+
+    def write(self, data):
+        if (self.shouldStop()):
+            raise UploadStopped(self.objName)
+
+        self.buf += data
+        self.length += len(data)
+        while (len(self.buf) >= self.partSize):
+            part = bytes(self.buf[:self.partSize])
+            del self.buf[:self.partSize]
+            self._submit(part)
+        return len(data)
+
+    # upload the remaining data and complete the upload - returns the etag
+    def close(self):
+        if (self.uploadId is None):
+            # everything fit in one part - a plain put is cheaper
+            data = bytes(self.buf)
+            self.buf = bytearray()
+            result = self.s3Client.put_object(self.s3Bkt, self.objName,
+                    io.BytesIO(data), len(data), metadata=self.metadata)
+            result = result[0] if isinstance(result, tuple) else result
+            return str(result).replace('"', '')
+
+        if (len(self.buf) > 0):
+            self._submit(bytes(self.buf))
+            self.buf = bytearray()
+
+        partEtags = dict()
+        for partNumber, future in self.futures:
+            partEtags[partNumber] = future.result()
+
+        return completeMultipartUpload(self.s3Client, self.s3Bkt, self.objName,
+                self.uploadId, partEtags, self.partSizes)
+
+    # cancel the upload - waits for parts in flight then aborts on the
+    # server, unless a checkpoint keeps it for the next run
+    def abort(self):
+        self.buf = bytearray()
+        if (self.uploadId is None):
+            return
+        for partNumber, future in self.futures:
+            try:
+                future.result()
+            except Exception:
+                pass
+        if (self.checkpoint is None):
+            abortMultipartUpload(self.s3Client, self.s3Bkt, self.objName, self.uploadId)
+        self.uploadId = None
+
+    def _submit(self, part):
+        if (self.uploadId is None):
+            self.uploadId = startUpload(self.s3Client, self.s3Bkt, self.objName, self.partSize,
+                    self.metadata, self.checkpoint)
+
+        # wait for a free slot - this is the backpressure on the writer
+        self.slots.acquire()
+        if (self.error is not None):
+            self.slots.release()
+            raise self.error
+        self.partNumber += 1
+        self.partSizes[self.partNumber] = len(part)
+        future = self.executor.submit(self._upload, self.partNumber, part)
+        self.futures.append((self.partNumber, future))
+
+        # fail fast if an earlier part already failed
+        if (self.error is not None):
+            raise self.error
+
+    def _upload(self, partNumber, part):
+        try:
+            return putCheckpointedPart(self.s3Client, self.s3Bkt, self.objName,
+                    self.uploadId, partNumber, part, self.retries, self.retryCount,
+                    self.checkpoint)
+        except Exception as err:
+            self.error = err
+            raise
+        finally:
+            self.slots.release()
+
+
+#
+# start a multipart upload - or continue the one a checkpoint holds when
+# it was made with the same part size.  returns the upload id
+#
+def startUpload(s3Client, s3Bkt, objName, partSize, metadata, checkpoint):
+    if (checkpoint is not None and checkpoint.uploadId and checkpoint.partSize == partSize):
+        return checkpoint.uploadId
+    uploadId = newMultipartUpload(s3Client, s3Bkt, objName, partSizeMeta(partSize, metadata))
+    if (checkpoint is not None):
+        checkpoint.started(uploadId, partSize)
+    return uploadId
+
+
+#
+# upload one part unless the checkpoint says the server already has it
+#
+def putCheckpointedPart(s3Client, s3Bkt, objName, uploadId, partNumber, data, retries,
+                        retryCount, checkpoint):
+    if (checkpoint is None):
+        return putPartWithRetry(s3Client, s3Bkt, objName, uploadId, partNumber, data,
+                retries, retryCount)
+
+    etag = checkpoint.resumedPart(partNumber, data)
+    if (etag is None):
+        etag = putPartWithRetry(s3Client, s3Bkt, objName, uploadId, partNumber, data,
+                retries, retryCount)
+        checkpoint.partDone(partNumber, etag)
+    return etag
+
+
+#
+# upload a file that is already on disk as a parallel multipart upload.
+# each part task reads its own byte range, so at most partsInFlight parts
+# of this file are in memory.  parts are retried on their own; if a part
+# still fails or the stop flag is set the upload is aborted on the server
+# - or kept for the next run when there is a checkpoint.
+# returns the etag, or None when stopped.
+#
+def uploadFileMultipart(s3Client, s3Bkt, objName, filename, size, partSize,
+                        partsInFlight, executor, shouldStop, retries=0, metadata=None,
+                        retryCount=None, checkpoint=None):
+    partSize = choosePartSize(partSize, size)
+    partCount = max(1, -(-size // partSize))
+    slots = threading.BoundedSemaphore(max(1, partsInFlight))
+    uploadId = startUpload(s3Client, s3Bkt, objName, partSize, metadata, checkpoint)
+    futures = list()
+    partSizes = dict()
+    failed = list()
+
+    def upload(partNumber, offset, length):
+        try:
+            with open(filename, 'rb') as f:
+                f.seek(offset)
+                data = f.read(length)
+            return putCheckpointedPart(s3Client, s3Bkt, objName, uploadId, partNumber, data,
+                    retries, retryCount, checkpoint)
+        except Exception as err:
+            failed.append(err)
+            raise
+        finally:
+            slots.release()
+
+    try:
+        for i in range(partCount):
+            slots.acquire()
+            if (shouldStop() or len(failed) > 0):
+                slots.release()
+                break
+            offset = i * partSize
+            length = min(partSize, size - offset)
+            partSizes[i + 1] = length
+            futures.append((i + 1, executor.submit(upload, i + 1, offset, length)))
+
+        partEtags = dict()
+        for partNumber, future in futures:
+            partEtags[partNumber] = future.result()
+
+        if (len(partEtags) < partCount):
+            if (checkpoint is None):
+                abortMultipartUpload(s3Client, s3Bkt, objName, uploadId)
+            return None
+
+        return completeMultipartUpload(s3Client, s3Bkt, objName, uploadId, partEtags, partSizes)
+    except Exception:
+        for partNumber, future in futures:
+            future.exception()
+        if (checkpoint is None):
+            abortMultipartUpload(s3Client, s3Bkt, objName, uploadId)
+        raise
+
+
+#
+# server side copy of the object source to objName.  objects up to
+# MAX_COPY_SIZE take one copy_object, bigger ones a multipart upload whose
+# parts are copied in parallel on executor.  user metadata is kept.
+# returns the etag of the copy
+#
+def copyObject(s3Client, s3Bkt, source, objName, partSize, executor, retries=0):
+    st = s3Client.stat_object(s3Bkt, source)
+    if (st.size <= MAX_COPY_SIZE):
+        result = s3Client.copy_object(s3Bkt, objName, "{}/{}".format(s3Bkt, source))
+        return result.etag.replace('"', '')
+
+    meta = {k: v for k, v in st.metadata.items() if k.lower().startswith("x-amz-meta-")}
+    meta.pop(PART_SIZE_META, None)
+    partSize = choosePartSize(partSize, st.size)
+    partCount = -(-st.size // partSize)
+    uploadId = newMultipartUpload(s3Client, s3Bkt, objName, partSizeMeta(partSize, meta))
+
+    def copy(partNumber, offset, length):
+        attempt = 0
+        while True:
+            try:
+                return copyPart(s3Client, s3Bkt, objName, uploadId, partNumber, source, offset, length)
+            except Exception:
+                attempt += 1
+                if (attempt > retries):
+                    raise
+                time.sleep(min(0.5 * (2 ** attempt), 10) * random.uniform(0.5, 1.0))
+
+    futures = list()
+    partSizes = dict()
+    try:
+        for i in range(partCount):
+            offset = i * partSize
+            partSizes[i + 1] = min(partSize, st.size - offset)
+            futures.append((i + 1, executor.submit(copy, i + 1, offset, partSizes[i + 1])))
+        partEtags = {partNumber: future.result() for partNumber, future in futures}
+        return completeMultipartUpload(s3Client, s3Bkt, objName, uploadId, partEtags, partSizes)
+    except Exception:
+        for partNumber, future in futures:
+            future.cancel()
+        abortMultipartUpload(s3Client, s3Bkt, objName, uploadId)
+        raise
+
+
+#
+# abort multipart uploads under prefix left behind by runs that crashed
+# or were killed before they could clean up.  uploads whose id is in keep
+# are left alone and their ids collected in kept
+#
+def abortIncompleteUploads(s3Client, s3Bkt, prefix, logger, keep=None, kept=None):
+    count = 0
+    try:
+        for upload in listIncompleteUploads(s3Client, s3Bkt, prefix):
+            if (keep is not None and upload.upload_id in keep):
+                if (kept is not None):
+                    kept.add(upload.upload_id)
+                continue
+            abortMultipartUpload(s3Client, s3Bkt, upload.object_name, upload.upload_id)
+            count += 1
+    except Exception as err:
+        logger.error("error aborting leftover multipart uploads: [{}]".format(err))
+    return count
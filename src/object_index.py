@@ -0,0 +1,287 @@
+import os
+import time
+import json
+import sqlite3                          # persistent index storage
+import threading
+
+from file_manifest import manifestName
+
+# upper bound for the keys under a prefix - sqlite compares text as utf-8 bytes
+KEY_END = "\U0010ffff"
+
+# list pages kept between commits of a refresh
+REFRESH_BATCH = 1000
+
+
+#
+# local index of the objects on an s3 server - key, size, etag, last
+# modified time and user metadata of each object, and the bucket list.
+# one sqlite database per server in s3.object_index_dir.
+#
+# a prefix is listed from the server once and then served from the index
+# until its listing is older than maxAge seconds.  uploads and deletes of
+# this client update the index in place, so it stays current in between.
+# a refresh pages through the listing and writes each page as it comes -
+# a refresh that is cut short continues after the last key it wrote, and
+# objects it did not see are only dropped once it reaches the end.
+#
+# the user metadata of an object is only known when the server lists it
+# (minio) or this client wrote it - it is None otherwise
+#
+class ObjectIndex:
+
+    def __init__(self, indexDir, server, maxAge):
+        if not os.path.exists(indexDir):
+            os.makedirs(indexDir)
+
+        self.path = os.path.join(indexDir, manifestName("objects", server))
+        self.maxAge = maxAge
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS objects ("
+                        "bucket TEXT, "
+                        "key TEXT, "
+                        "size INTEGER, "
+                        "etag TEXT, "
+                        "last_modified REAL, "
+                        "metadata TEXT, "
+                        "seen REAL, "
+                        "PRIMARY KEY (bucket, key))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS listings ("
+                        "bucket TEXT, "
+                        "prefix TEXT, "
+                        "listed REAL, "
+                        "started REAL, "
+                        "cursor TEXT, "
+                        "PRIMARY KEY (bucket, prefix))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS buckets ("
+                        "name TEXT PRIMARY KEY, "
+                        "created REAL, "
+                        "listed REAL)")
+        self.db.commit()
+
+    # has prefix (or a prefix of it) been listed within maxAge
+    def fresh(self, bucket, prefix):
+        oldest = time.time() - self.maxAge
+        with self.lock:
+            rows = self.db.execute("SELECT prefix, listed FROM listings WHERE bucket = ?",
+                                   (bucket,)).fetchall()
+        return any(prefix.startswith(p) and listed is not None and listed >= oldest
+                   for p, listed in rows)
+
+    # (key, size, etag, metadata, last modified) of the objects under
+    # prefix - from the index when it is fresh, otherwise while refreshing it
+    def listing(self, s3Client, bucket, prefix, shouldStop=None):
+        if (self.fresh(bucket, prefix)):
+            return iter(self.objects(bucket, prefix))
+        return self.refresh(s3Client, bucket, prefix, shouldStop)
+
+    # (key, size, etag, metadata, last modified) of the indexed objects under prefix
+    def objects(self, bucket, prefix):
+        with self.lock:
+            rows = self.db.execute("SELECT key, size, etag, metadata, last_modified FROM objects "
+                                   "WHERE bucket = ? AND key >= ? AND key < ? ORDER BY key",
+                                   (bucket, prefix, prefix + KEY_END)).fetchall()
+        return [(key, size, etag, _loadMeta(meta), modified) for key, size, etag, meta, modified in rows]
+
+    # list prefix from the server into the index - yields (key, size, etag,
+    # metadata, last modified) as the pages come in
+    def refresh(self, s3Client, bucket, prefix, shouldStop=None):
+        with self.lock:
+            row = self.db.execute("SELECT started, cursor FROM listings WHERE bucket = ? AND prefix = ?",
+                                  (bucket, prefix)).fetchone()
+        started, cursor = row if row is not None else (None, None)
+        if (cursor is None):
+            started = time.time()
+        else:
+            # continue the refresh that was cut short - what it wrote is
+            # served from the index first
+            with self.lock:
+                rows = self.db.execute("SELECT key, size, etag, metadata, last_modified FROM objects "
+                                       "WHERE bucket = ? AND key >= ? AND key <= ? AND seen >= ? ORDER BY key",
+                                       (bucket, prefix, cursor, started)).fetchall()
+            for key, size, etag, meta, modified in rows:
+                yield key, size, etag, _loadMeta(meta), modified
+
+        batch = list()
+        finished = False
+        try:
+            for obj in s3Client.list_objects_v2(bucket, prefix=prefix, recursive=True,
+                                                start_after=cursor, include_user_meta=True):
+                if (shouldStop is not None and shouldStop()):
+                    return
+                etag = obj.etag.replace('"', '')
+                meta = _userMeta(obj.metadata)
+                if (meta is None):
+                    # listings without metadata keep what is known of the same object
+                    known = self.get(bucket, obj.object_name)
+                    if (known is not None and known[1] == etag):
+                        meta = known[2]
+                record = (obj.object_name, obj.size, etag, meta, timestamp(obj.last_modified))
+                batch.append(record)
+                if (len(batch) >= REFRESH_BATCH):
+                    cursor = self._store(bucket, prefix, batch, started)
+                    batch = list()
+                yield record
+            finished = True
+        finally:
+            if (len(batch) > 0):
+                cursor = self._store(bucket, prefix, batch, started)
+            if (finished):
+                self._finish(bucket, prefix, started)
+            else:
+                self._saveCursor(bucket, prefix, started, cursor)
+
+    # write a page of the listing - returns its last key
+    def _store(self, bucket, prefix, batch, seen):
+        with self.lock:
+            for key, size, etag, meta, lastModified in batch:
+                self.db.execute("INSERT OR REPLACE INTO objects "
+                                "(bucket, key, size, etag, last_modified, metadata, seen) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (bucket, key, size, etag, lastModified, _dumpMeta(meta), seen))
+            self.db.execute("INSERT OR REPLACE INTO listings (bucket, prefix, listed, started, cursor) "
+                            "VALUES (?, ?, (SELECT listed FROM listings WHERE bucket = ? AND prefix = ?), ?, ?)",
+                            (bucket, prefix, bucket, prefix, seen, batch[-1][0]))
+            self.db.commit()
+            self.pending = 0
+        return batch[-1][0]
+
+    def _saveCursor(self, bucket, prefix, started, cursor):
+        if (cursor is None):
+            return
+        with self.lock:
+            self.db.execute("UPDATE listings SET started = ?, cursor = ? WHERE bucket = ? AND prefix = ?",
+                            (started, cursor, bucket, prefix))
+            self.db.commit()
+
+    # the listing reached its end - objects not seen since it started are gone
+    def _finish(self, bucket, prefix, started):
+        with self.lock:
+            self.db.execute("DELETE FROM objects WHERE bucket = ? AND key >= ? AND key < ? AND seen < ?",
+                            (bucket, prefix, prefix + KEY_END, started))
+            # listings inside prefix are covered by this one now
+            self.db.execute("DELETE FROM listings WHERE bucket = ? AND prefix >= ? AND prefix < ?",
+                            (bucket, prefix, prefix + KEY_END))
+            self.db.execute("INSERT INTO listings (bucket, prefix, listed, started, cursor) "
+                            "VALUES (?, ?, ?, NULL, NULL)", (bucket, prefix, started))
+            self.db.commit()
+            self.pending = 0
+
+    # returns (size, etag, metadata) or None
+    def get(self, bucket, key):
+        with self.lock:
+            row = self.db.execute("SELECT size, etag, metadata FROM objects WHERE bucket = ? AND key = ?",
+                                  (bucket, key)).fetchone()
+        if (row is None):
+            return None
+        return row[0], row[1], _loadMeta(row[2])
+
+    # an object this client wrote - etag as put_object returned it
+    def put(self, bucket, key, size, etag, metadata=None):
+        if isinstance(etag, tuple):
+            etag = etag[0]
+        etag = str(etag).replace('"', '')
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO objects "
+                            "(bucket, key, size, etag, last_modified, metadata, seen) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (bucket, key, size, etag, time.time(), _dumpMeta(_userMeta(metadata or {})),
+                             time.time()))
+            self._commitEvery()
+
+    # a server side copy - the new object has the size and metadata of its
+    # source.  a source the index does not know makes the listing stale
+    def copy(self, bucket, source, key, etag):
+        known = self.get(bucket, source)
+        if (known is None):
+            self.expire(bucket, key)
+            return
+        self.put(bucket, key, known[0], etag, known[2])
+
+    def remove(self, bucket, key):
+        with self.lock:
+            self.db.execute("DELETE FROM objects WHERE bucket = ? AND key = ?", (bucket, key))
+            self._commitEvery()
+
+    # the index no longer matches the server for key (a delete failed, an
+    # object was missing) - the prefixes holding it are listed again next time
+    def expire(self, bucket, key):
+        with self.lock:
+            self.db.execute("UPDATE listings SET listed = NULL WHERE bucket = ? AND "
+                            "substr(?, 1, length(prefix)) = prefix", (bucket, key))
+            self.db.commit()
+            self.pending = 0
+
+    # cached bucket list as (name, created) - None when it is too old
+    def buckets(self):
+        oldest = time.time() - self.maxAge
+        with self.lock:
+            rows = self.db.execute("SELECT name, created, listed FROM buckets").fetchall()
+        if (len(rows) == 0 or any(listed < oldest for name, created, listed in rows)):
+            return None
+        return [(name, created) for name, created, listed in rows]
+
+    def putBuckets(self, buckets):
+        now = time.time()
+        with self.lock:
+            self.db.execute("DELETE FROM buckets")
+            self.db.executemany("INSERT INTO buckets (name, created, listed) VALUES (?, ?, ?)",
+                                [(name, created, now) for name, created in buckets])
+            self.db.commit()
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+    # commit in batches - a lost batch only means a listing is repeated
+    def _commitEvery(self, batch=500):
+        self.pending += 1
+        if (self.pending >= batch):
+            self.db.commit()
+            self.pending = 0
+
+
+#
+# x-amz-meta-* entries of listed metadata or upload headers, lower case -
+# None when there are none
+#
+def _userMeta(metadata):
+    if (not metadata):
+        return None
+    meta = dict()
+    for key, value in metadata.items():
+        if (key.lower().startswith("x-amz-meta-")):
+            meta[key.lower()] = value
+    return meta or None
+
+
+def _dumpMeta(meta):
+    return json.dumps(meta, separators=(",", ":")) if meta is not None else None
+
+
+def _loadMeta(text):
+    return json.loads(text) if text is not None else None
+
+
+def timestamp(value):
+    if (hasattr(value, "timestamp")):
+        return value.timestamp()
+    return None
+
+
+#
+# object index from the config, or None when turned off
+#
+def openObjectIndex(config):
+    if (not config.getboolean('S3', 's3.object_index', fallback=False)):
+        return None
+    return ObjectIndex(config.get('S3', 's3.object_index_dir', fallback='./index'),
+                       config['S3']['s3.server'],
+                       config.getfloat('S3', 's3.object_index_max_age_hours', fallback=24) * 3600)
@@ -0,0 +1,185 @@
+import io
+import json
+import time
+import hashlib
+import threading
+
+from compression import DecompressingWriter
+from ranged_download import getRange
+from aead_crypt import decryptBytes
+from retry_queue import errorClass
+
+# pack objects and the index object stored next to each of them
+PACK_SUFFIX = ".pack"
+PACK_INDEX_SUFFIX = ".pack.idx"
+
+# below this share of a pack's files, single files are fetched with
+# ranged reads instead of streaming the whole pack
+RANGED_EXTRACT_SHARE = 0.5
+
+
+#
+# groups small files into pack objects of roughly packSize bytes.  every
+# pack gets an index object (<pack>.idx) listing the name, offset, length
+# and sha256 of each file in it.  files are added already compressed and /
+# or encrypted on their own, so any one of them can be read back with a
+# single ranged GET.
+#
+# add() is called from the upload workers - a pack that fills up is
+# uploaded by the worker whose file filled it.  close() uploads the last
+# partial pack.  packs that fail to upload are kept in memory until
+# retryFailed() sends them again.
+#
+class PackWriter:
+
+    def __init__(self, s3Client, s3Bkt, prefix, packSize, logger):
+        self.s3Client = s3Client
+        self.s3Bkt = s3Bkt
+        self.prefix = prefix
+        self.packSize = packSize
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.runId = time.strftime("%Y%m%d%H%M%S")
+        self.seq = 0
+        self.packCount = 0          # packs uploaded
+        self.fileCount = 0
+        self.failed = 0
+        self.uploaded = list()      # pack and index objects written
+        self.stored = list()        # (object name, size, etag) of the packs and indexes written
+        self.packFiles = dict()     # pack name -> [name, mtime] of the files in it
+        self.failedPacks = list()   # (pack name, data, entries, error classes) of packs not uploaded
+        self._open()
+
+    def _open(self):
+        self.seq += 1
+        self.packName = "{}pack-{}-{:05d}{}".format(self.prefix, self.runId, self.seq, PACK_SUFFIX)
+        self.buf = bytearray()
+        self.entries = list()
+
+    # add one file - returns the name of the pack it went into
+    def add(self, name, data, size, sha256, codec, encrypted, mtime=None):
+        sealed = None
+        with self.lock:
+            packName = self.packName
+            self.entries.append({
+                "name": name,
+                "offset": len(self.buf),
+                "length": len(data),
+                "size": size,
+                "sha256": sha256,
+                "codec": codec,
+                "encrypted": encrypted,
+                "mtime": mtime,
+            })
+            self.buf += data
+            if (len(self.buf) >= self.packSize):
+                sealed = (self.packName, self.buf, self.entries)
+                self._open()
+
+        if (sealed is not None):
+            self._upload(*sealed)
+        return packName
+
+    # upload whatever is left in the open pack
+    def close(self):
+        with self.lock:
+            sealed = (self.packName, self.buf, self.entries)
+            self._open()
+        if (len(sealed[2]) > 0):
+            self._upload(*sealed)
+
+    # upload the failed packs again - those that fail again stay in failedPacks
+    def retryFailed(self):
+        with self.lock:
+            packs = self.failedPacks
+            self.failedPacks = list()
+            self.failed -= sum(len(entries) for packName, buf, entries, errors in packs)
+        for packName, buf, entries, errors in packs:
+            self._upload(packName, buf, entries, errors)
+
+    def _upload(self, packName, buf, entries, errors=None):
+        index = json.dumps({"version": 1, "pack": packName, "files": entries},
+                separators=(",", ":")).encode("utf8")
+        try:
+            etag = self.s3Client.put_object(self.s3Bkt, packName, io.BytesIO(bytes(buf)), len(buf))
+            indexEtag = self.s3Client.put_object(self.s3Bkt, packName + ".idx", io.BytesIO(index),
+                    len(index), content_type="application/json")
+            with self.lock:
+                self.packCount += 1
+                self.fileCount += len(entries)
+                self.uploaded += [packName, packName + ".idx"]
+                self.stored += [(packName, len(buf), etag), (packName + ".idx", len(index), indexEtag)]
+                self.packFiles[packName] = [[e["name"], e["mtime"]] for e in entries]
+        except Exception as err:
+            with self.lock:
+                self.failed += len(entries)
+                self.failedPacks.append((packName, buf, entries, (errors or []) + [errorClass(err)]))
+            self.logger.error("ERROR: PACK_UPLOAD_ERROR [{}] [{}] files lost [{}]".format(
+                    packName, len(entries), err))
+
+
+#
+# read the index of a pack object
+#
+def loadPackIndex(s3Client, s3Bkt, packName):
+    response = s3Client.get_object(s3Bkt, packName + ".idx")
+    try:
+        return json.loads(response.read().decode("utf8"))
+    finally:
+        response.close()
+        response.release_conn()
+
+
+#
+# yield (entry, stored bytes) for the given index entries of a pack.  a
+# small share of the pack is fetched with one ranged GET per file,
+# otherwise the whole pack is streamed once and cut up on the way.
+#
+def readPackEntries(s3Client, s3Bkt, packName, entries, totalFiles, retries=0):
+    entries = sorted(entries, key=lambda e: e["offset"])
+    if (len(entries) < totalFiles * RANGED_EXTRACT_SHARE):
+        for entry in entries:
+            if (entry["length"] == 0):
+                yield entry, b""
+                continue
+            yield entry, getRange(s3Client, s3Bkt, packName, entry["offset"], entry["length"], retries)
+        return
+
+    response = s3Client.get_object(s3Bkt, packName)
+    try:
+        pos = 0
+        for entry in entries:
+            skip = entry["offset"] - pos
+            while (skip > 0):
+                data = response.read(min(skip, 1024 * 1024))
+                if not data:
+                    raise ValueError("pack [{}] is truncated".format(packName))
+                skip -= len(data)
+            data = response.read(entry["length"]) if entry["length"] > 0 else b""
+            if (len(data) != entry["length"]):
+                raise ValueError("pack [{}] is truncated".format(packName))
+            pos = entry["offset"] + entry["length"]
+            yield entry, data
+    finally:
+        response.close()
+        response.release_conn()
+
+
+#
+# turn the stored bytes of a packed file back into its content and check
+# it against the sha256 in the index
+#
+def decodePackEntry(entry, data, encryptionPass):
+    if (entry.get("encrypted", False)):
+        data = decryptBytes(data, encryptionPass)
+
+    if (entry.get("codec", "")):
+        fOut = io.BytesIO()
+        writer = DecompressingWriter(fOut, entry["codec"])
+        writer.write(data)
+        writer.close()
+        data = fOut.getvalue()
+
+    if (len(data) != entry["size"] or hashlib.sha256(data).hexdigest() != entry["sha256"]):
+        raise ValueError("packed file [{}] does not match its index".format(entry["name"]))
+    return data
@@ -0,0 +1,157 @@
+import os
+import time
+import threading
+
+# seconds between progress events sent to the gui
+REPORT_INTERVAL = 0.5
+
+# log lines sent per event - the rest of an interval is only counted
+MAX_LINES = 50
+
+# weight of the latest interval in the smoothed byte rate
+RATE_WEIGHT = 0.3
+
+
+#
+# progress of a backup or restore for the gui.  the workers report every
+# file to it, but it only puts one event on the queue per interval - a
+# dict with the counts and bytes done, the totals once they are known, the
+# byte rate and an eta, and the last few log lines of the interval.  busy
+# runs cost the gui the same as quiet ones.
+#
+# events go out from the thread that reports - there is no timer thread,
+# so close() sends the final state.
+#
+class ProgressReporter:
+
+    def __init__(self, q, kind, interval=REPORT_INTERVAL):
+        self.q = q
+        self.kind = kind
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.lastSent = 0
+        self.lastBytes = 0
+        self.rate = 0.0
+        self.files = 0
+        self.bytes = 0
+        self.failed = 0
+        self.totalFiles = 0
+        self.totalBytes = 0
+        self.totalsKnown = False
+        self.lines = list()
+        self.droppedLines = 0
+
+    # totals of the whole run - known tells the gui they are final
+    def setTotals(self, files, size, known=True):
+        with self.lock:
+            self.totalFiles = files
+            self.totalBytes = size
+            self.totalsKnown = known
+        self.report()
+
+    # one file finished - line is a log line for it
+    def fileDone(self, size, failed=False, line=None):
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+            if (failed):
+                self.failed += 1
+            if (line is not None):
+                if (len(self.lines) < MAX_LINES):
+                    self.lines.append(line)
+                else:
+                    self.droppedLines += 1
+        self.report()
+
+    # send an event when the interval is up (or always with force)
+    def report(self, force=False):
+        now = time.time()
+        with self.lock:
+            if (not force and now - self.lastSent < self.interval):
+                return
+            elapsed = now - self.lastSent if self.lastSent > 0 else now - self.start
+            if (elapsed > 0):
+                current = (self.bytes - self.lastBytes) / elapsed
+                self.rate = current if self.lastSent == 0 else (
+                        RATE_WEIGHT * current + (1 - RATE_WEIGHT) * self.rate)
+            self.lastSent = now
+            self.lastBytes = self.bytes
+
+            eta = None
+            if (self.totalsKnown and self.rate > 0):
+                eta = max(0, self.totalBytes - self.bytes) / self.rate
+            lines = self.lines
+            if (self.droppedLines > 0):
+                lines.append("... {} more".format(self.droppedLines))
+            event = {"kind": self.kind, "files": self.files, "bytes": self.bytes, "failed": self.failed,
+                     "totalFiles": self.totalFiles, "totalBytes": self.totalBytes,
+                     "totalsKnown": self.totalsKnown, "rate": self.rate, "eta": eta, "lines": lines}
+            self.lines = list()
+            self.droppedLines = 0
+        self.q.put(event)
+
+    def close(self):
+        self.report(force=True)
+
+
+#
+# background walk of inputDir that adds up the files and bytes a backup
+# will go through, for the progress totals.  partial totals are sent as
+# it goes, known once the walk is done
+#
+def startPreScan(inputDir, progress, shouldStop):
+
+    def scan():
+        files = 0
+        size = 0
+        lastSent = time.time()
+        for r, d, f in os.walk(inputDir):
+            if (shouldStop()):
+                return
+            for name in f:
+                try:
+                    size += os.stat(os.path.join(r, name)).st_size
+                    files += 1
+                except OSError:
+                    pass
+            if (time.time() - lastSent > 1):
+                progress.setTotals(files, size, False)
+                lastSent = time.time()
+        progress.setTotals(files, size, True)
+
+    thread = threading.Thread(target=scan, name="pre-scan", daemon=True)
+    thread.start()
+    return thread
+
+
+#
+# yields items and sets the progress totals from their sizes once the
+# last one has been listed
+#
+def countedItems(items, progress):
+    files = 0
+    size = 0
+    for item in items:
+        files += 1
+        size += item.size
+        yield item
+    progress.setTotals(files, size, True)
+
+
+# "1.5GB" style size for the gui
+def formatBytes(size):
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if (size < 1024 or unit == "TB"):
+            return "{}{}".format(round(size, 1) if unit != "B" else int(size), unit)
+        size /= 1024
+
+
+# "1h 2m 3s" style duration for the gui
+def formatDuration(seconds):
+    seconds = int(seconds)
+    if (seconds >= 3600):
+        return "{}h {}m".format(seconds // 3600, (seconds % 3600) // 60)
+    if (seconds >= 60):
+        return "{}m {}s".format(seconds // 60, seconds % 60)
+    return "{}s".format(seconds)
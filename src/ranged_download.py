@@ -0,0 +1,269 @@
+import os
+import time
+import random
+import hashlib                          # for etag verification
+import threading
+
+
+#
+# raised when a downloaded object does not match its size or etag
+#
+class VerifyError(Exception):
+    pass
+
+
+#
+# writes at absolute offsets into an open file.  uses os.pwrite where the
+# platform has it, otherwise falls back to seek + write under a lock.
+#
+class PositionalWriter:
+
+    def __init__(self, filename, size):
+        self.f = open(filename, 'r+b' if os.path.exists(filename) else 'w+b')
+        self.fd = self.f.fileno()
+        self.lock = threading.Lock()
+        preallocate(self.f, size)
+
+    def write(self, data, offset):
+        if hasattr(os, 'pwrite'):
+            view = memoryview(data)
+            while (len(view) > 0):
+                n = os.pwrite(self.fd, view, offset)
+                view = view[n:]
+                offset += n
+        else:
+            with self.lock:
+                self.f.seek(offset)
+                self.f.write(data)
+
+    # flush written data to disk
+    def sync(self):
+        with self.lock:
+            self.f.flush()
+        os.fsync(self.fd)
+
+    def close(self):
+        self.f.close()
+
+
+#
+# reserve size bytes for a file so ranges can be written in any order
+#
+def preallocate(f, size):
+    if hasattr(os, 'posix_fallocate') and size > 0:
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except OSError:
+            pass
+    f.truncate(size)
+
+
+#
+# part size used by a multipart upload with etag "<md5>-<parts>".  when the
+# uploader did not record it, the smallest 1MB multiple that gives the
+# same number of parts is the best guess (what most clients use).
+#
+def guessPartSize(size, etag):
+    if ("-" not in etag):
+        return 0
+    parts = int(etag.split("-")[1])
+    if (parts <= 1):
+        return size
+    mb = 1024 * 1024
+    partSize = -(-size // parts)
+    partSize = -(-partSize // mb) * mb
+    if (-(-size // partSize) != parts):
+        return 0
+    return partSize
+
+
+#
+# etag s3 gives an object made of parts with these md5 digests
+#
+def multipartEtag(digests):
+    return hashlib.md5(b"".join(digests)).hexdigest() + "-" + str(len(digests))
+
+
+#
+# md5 of a whole file, read sequentially
+#
+def md5File(filename, bufferSize=1024 * 1024):
+    h = hashlib.md5()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(bufferSize)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+#
+# multipart etag of a file on disk for a given part size
+#
+def multipartEtagOfFile(filename, partSize, bufferSize=1024 * 1024):
+    digests = list()
+    with open(filename, 'rb') as f:
+        while True:
+            h = hashlib.md5()
+            left = partSize
+            while (left > 0):
+                chunk = f.read(min(bufferSize, left))
+                if not chunk:
+                    break
+                h.update(chunk)
+                left -= len(chunk)
+            if (left == partSize):
+                break
+            digests.append(h.digest())
+    return multipartEtag(digests)
+
+
+#
+# fetch one byte range, retrying it on its own
+#
+def getRange(s3Client, s3Bkt, objName, offset, length, retries, retryCount=None):
+    attempt = 0
+    while True:
+        response = None
+        try:
+            response = s3Client.get_partial_object(s3Bkt, objName, offset, length)
+            data = response.read()
+            if (len(data) != length):
+                raise VerifyError("short read at offset {}: {} of {} bytes".format(
+                        offset, len(data), length))
+            return data
+        except Exception:
+            attempt += 1
+            if (attempt > retries):
+                raise
+            if (retryCount is not None):
+                retryCount.add()
+            time.sleep(min(0.5 * (2 ** attempt), 10) * random.uniform(0.5, 1.0))
+        finally:
+            if (response is not None):
+                response.close()
+                response.release_conn()
+
+
+#
+# download an object with concurrent ranged GETs into filename, writing
+# each range at its offset in the preallocated file.
+#
+# when the etag comes from a multipart upload and its parts (partSize, or
+# a guess when 0) are at most four times rangeSize, the ranges are aligned
+# to the parts so each range's md5 is a part md5 and the etag can be
+# checked without reading the file again.  otherwise the file is hashed
+# once it is complete.
+# with a checkpoint (see checkpoint.py) every range is synced to disk and
+# journaled once written, and ranges an earlier run already wrote to
+# filename are not fetched again.
+# with a decoder (an aead_crypt.RangeDecryptor) the object is fetched from
+# decoder.start in ranges of whole encrypted chunks and each range is
+# decrypted before it is written.  the chunk tags authenticate the data,
+# so the etag is not checked.
+# returns True once size and etag are verified, False when stopped and
+# raises VerifyError on a mismatch.
+#
+def downloadRanged(s3Client, s3Bkt, objName, filename, size, etag, partSize,
+                   rangeSize, rangesInFlight, executor, shouldStop, retries=0,
+                   logger=None, retryCount=None, checkpoint=None, decoder=None):
+    etag = etag.replace('"', '')
+    multipart = ("-" in etag and decoder is None)
+    knownPartSize = (partSize > 0)
+    if (multipart):
+        partSize = partSize or guessPartSize(size, etag)
+    aligned = (multipart and partSize > 0 and partSize <= rangeSize * 4)
+    if (aligned):
+        rangeSize = partSize
+
+    start = 0
+    outputSize = size
+    if (decoder is not None):
+        start = decoder.start
+        outputSize = decoder.outputSize
+        rangeSize = decoder.rangeSize(rangeSize)
+
+    rangeCount = max(1, -(-(size - start) // rangeSize))
+    resumed = checkpoint.resumed(rangeSize) if checkpoint is not None else dict()
+    slots = threading.BoundedSemaphore(max(1, rangesInFlight))
+    digests = [None] * rangeCount
+    failed = list()
+    futures = list()
+    writer = PositionalWriter(filename, outputSize)
+
+    def fetch(index, offset, length):
+        try:
+            data = getRange(s3Client, s3Bkt, objName, offset, length, retries, retryCount)
+            digest = hashlib.md5(data).digest() if (aligned or checkpoint is not None) else None
+            if (aligned):
+                digests[index] = digest
+            outOffset = offset
+            if (decoder is not None):
+                outOffset, data = decoder.decode(offset, data)
+            writer.write(data, outOffset)
+            if (checkpoint is not None):
+                writer.sync()
+                checkpoint.rangeDone(rangeSize, index, digest.hex())
+            return len(data)
+        except Exception as err:
+            failed.append(err)
+            raise
+        finally:
+            slots.release()
+
+    written = 0
+    done = 0
+    try:
+        for i in range(rangeCount):
+            offset = start + i * rangeSize
+            length = min(rangeSize, size - offset)
+            # written by an earlier run
+            if (i in resumed):
+                if (aligned):
+                    digests[i] = bytes.fromhex(resumed[i])
+                written += decoder.outputLength(offset, length) if decoder is not None else length
+                done += 1
+                continue
+
+            slots.acquire()
+            if (shouldStop() or len(failed) > 0):
+                slots.release()
+                break
+            futures.append(executor.submit(fetch, i, offset, length))
+            done += 1
+
+        for future in futures:
+            written += future.result()
+    finally:
+        for future in futures:
+            future.exception()
+        writer.close()
+
+    if (done < rangeCount):
+        return False
+
+    # verify the assembled object
+    if (written != outputSize or os.path.getsize(filename) != outputSize):
+        raise VerifyError("size mismatch for [{}]: expected {} got {}".format(objName, outputSize, written))
+
+    if (multipart):
+        if (partSize == 0):
+            actual = None
+        elif (aligned):
+            actual = multipartEtag(digests)
+        else:
+            actual = multipartEtagOfFile(filename, partSize)
+
+        if (actual != etag):
+            if (knownPartSize):
+                raise VerifyError("etag mismatch for [{}]: expected {} got {}".format(objName, etag, actual))
+            # part size was only a guess - can't tell a bad guess from bad data
+            if (logger is not None):
+                logger.warning("could not verify etag of [{}] - unknown part size".format(objName))
+    elif (len(etag) == 32 and decoder is None):
+        actual = md5File(filename)
+        if (actual != etag):
+            raise VerifyError("etag mismatch for [{}]: expected {} got {}".format(objName, etag, actual))
+
+    return True
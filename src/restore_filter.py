@@ -0,0 +1,106 @@
+import time
+import fnmatch
+from datetime import datetime
+
+# characters that start the wildcard part of a glob
+GLOB_CHARS = "*?["
+
+# accepted formats for --since / --until
+TIME_FORMATS = ("%Y-%m-%d", "%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%dT%H:%M:%S")
+
+
+#
+# picks the files of a selective restore.  paths are relative to the
+# restore folder and use / - a path selects that file or everything below
+# it.  include / exclude globs match the whole relative path (* also
+# matches /).  since / until (seconds since the epoch) select files by
+# their modification time, or by the time they were backed up when that
+# is not known.
+#
+# a file is restored when it matches a path or an include (or there are
+# neither), matches no exclude and lies in the time window
+#
+class RestoreFilter:
+
+    def __init__(self, includes=None, excludes=None, paths=None, since=None, until=None):
+        self.includes = [p.strip("/") for p in includes or [] if p.strip("/")]
+        self.excludes = [p.strip("/") for p in excludes or [] if p.strip("/")]
+        self.paths = [p.strip("/") for p in paths or [] if p.strip("/")]
+        self.since = since
+        self.until = until
+
+    def active(self):
+        return bool(self.includes or self.excludes or self.paths or
+                    self.since is not None or self.until is not None)
+
+    def matches(self, relPath, mtime=None):
+        if (self.paths or self.includes):
+            picked = any(relPath == p or relPath.startswith(p + "/") for p in self.paths)
+            if (not picked):
+                picked = any(fnmatch.fnmatchcase(relPath, p) for p in self.includes)
+            if (not picked):
+                return False
+        if (any(fnmatch.fnmatchcase(relPath, p) for p in self.excludes)):
+            return False
+        if (mtime is not None):
+            if (self.since is not None and mtime < self.since):
+                return False
+            if (self.until is not None and mtime >= self.until):
+                return False
+        return True
+
+    # relative prefixes every selected file starts with - [""] when any
+    # file of the folder can match
+    def prefixes(self):
+        found = list(self.paths)
+        for pattern in self.includes:
+            cut = min([pattern.find(c) for c in GLOB_CHARS if c in pattern] or [len(pattern)])
+            found.append(pattern[:cut])
+        if (len(found) == 0 or "" in found):
+            return [""]
+        # drop prefixes already covered by a shorter one
+        found.sort()
+        kept = [found[0]]
+        for prefix in found[1:]:
+            if (not prefix.startswith(kept[-1])):
+                kept.append(prefix)
+        return kept
+
+    def describe(self):
+        parts = list()
+        if (self.paths):
+            parts.append("paths [{}]".format(len(self.paths)))
+        if (self.includes):
+            parts.append("include [{}]".format(" ".join(self.includes)))
+        if (self.excludes):
+            parts.append("exclude [{}]".format(" ".join(self.excludes)))
+        if (self.since is not None):
+            parts.append("since [{}]".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.since))))
+        if (self.until is not None):
+            parts.append("until [{}]".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.until))))
+        return " - ".join(parts)
+
+
+#
+# seconds since the epoch of a local date / time given on the command line
+#
+def parseTime(text):
+    for fmt in TIME_FORMATS:
+        try:
+            return datetime.strptime(text.strip(), fmt).timestamp()
+        except ValueError:
+            pass
+    raise ValueError("unknown date / time [{}] - use YYYY-mm-dd [HH:MM[:SS]]".format(text))
+
+
+#
+# paths listed in a file, one per line - blank lines and # comments are skipped
+#
+def readPathList(filename):
+    paths = list()
+    with open(filename, 'r', encoding='utf8') as f:
+        for line in f:
+            line = line.strip()
+            if (line and not line.startswith("#")):
+                paths.append(line.replace("\\", "/"))
+    return paths
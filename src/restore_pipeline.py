@@ -0,0 +1,109 @@
+import threading
+import timeit                           # for per-object timing
+from queue import Queue
+
+from retry_queue import errorClass
+
+#
+# one object moving through the restore pipeline
+#
+class RestoreItem:
+
+    def __init__(self, objName, size=0, etag=""):
+        self.objName = objName
+        self.size = size
+        self.etag = etag
+        self.sha256 = ""            # content hash and codec when planned from a run manifest
+        self.codec = None           # None when not known
+        self.mtime = None           # file modification time, or when it was backed up
+        self.files = None           # [name, mtime] of the files in a pack, when known
+        self.filename = ""          # local file written
+        self.written = list()       # local files a pack was extracted to
+        self.ok = False             # set once the object is on disk
+        self.error = ""             # class of the error that made it fail
+        self.unchanged = False      # local file already matched (incremental mode)
+        self.resumed = False        # restored by the interrupted run this one resumes
+        self.retries = 0            # range retries
+        self.startTime = 0
+        self.runTime = 0
+
+
+#
+# parallel restore engine
+#   list     - one thread pages through the object listing and queues items
+#   download - worker threads fetch, decrypt and write each object
+# listing and downloading overlap, so the first objects are restored while
+# later listing pages are still being fetched.  finished items are handed
+# back to the caller in completion order.
+#
+# restore(item) is supplied by the caller and sets item.ok on success.
+#
+class RestorePipeline:
+
+    def __init__(self, workers, shouldStop, logger):
+        self.workers = max(1, workers)
+        self.shouldStop = shouldStop
+        self.logger = logger
+        self.listError = None       # error class when the listing broke off
+
+    def run(self, items, restore):
+        workQ = Queue(maxsize=self.workers * 4)
+        resultQ = Queue()
+        self.left = self.workers
+        self.lock = threading.Lock()
+        self.listError = None
+
+        threads = [threading.Thread(target=self._list, args=(items, workQ), daemon=True)]
+        for i in range(self.workers):
+            threads.append(threading.Thread(target=self._download,
+                    args=(restore, workQ, resultQ), daemon=True))
+        for t in threads:
+            t.start()
+
+        while True:
+            item = resultQ.get()
+            if (item is None):
+                break
+            yield item
+
+        for t in threads:
+            t.join()
+
+    # stage 1 - feed the work queue from the listing
+    def _list(self, items, workQ):
+        try:
+            for item in items:
+                if (self.shouldStop()):
+                    print("stop flag found - stop listing")
+                    break
+                workQ.put(item)
+        except Exception as err:
+            self.listError = errorClass(err)
+            self.logger.error("ERROR: LIST_ERROR [{}]".format(err))
+        finally:
+            for i in range(self.workers):
+                workQ.put(None)
+
+    # stage 2 - download / decrypt / write
+    def _download(self, restore, workQ, resultQ):
+        while True:
+            item = workQ.get()
+            if (item is None):
+                break
+
+            item.startTime = timeit.default_timer()
+            if (not self.shouldStop()):
+                try:
+                    restore(item)
+                except Exception as err:
+                    self.logger.error("ERROR: FILE_RESTORE_ERROR [{}] [{}]".format(item.objName, err))
+                    item.error = errorClass(err)
+
+            item.runTime = round(timeit.default_timer() - item.startTime, 2)
+            resultQ.put(item)
+
+        with self.lock:
+            self.left -= 1
+            last = (self.left == 0)
+        if (last):
+            resultQ.put(None)
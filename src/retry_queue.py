@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import random
+import tempfile
+
+# exit status of backup.py / restore.py (2 is a usage error)
+EXIT_OK = 0
+EXIT_ERROR = 1          # the run could not start
+EXIT_PARTIAL = 3        # some files failed
+EXIT_STOPPED = 4        # stopped before the end
+
+# errors the next attempt would hit again - not retried
+PERMANENT_ERRORS = ("AccessDenied", "NoSuchBucket", "InvalidAccessKeyId", "SignatureDoesNotMatch",
+                    "InvalidBucketName", "EntityTooLarge", "FileNotFoundError", "PermissionError",
+                    "IsADirectoryError", "NotADirectoryError")
+
+
+#
+# short class of an error for logs and the failure report - the s3 error
+# code is added for s3 errors (ResponseError:SlowDown)
+#
+def errorClass(err):
+    code = getattr(err, "code", None)
+    if (isinstance(code, str) and code):
+        return "{}:{}".format(type(err).__name__, code)
+    return type(err).__name__
+
+
+def isRetryable(error):
+    return error.split(":")[-1] not in PERMANENT_ERRORS
+
+
+#
+# transfers that failed in the main pass of a run.  they are held back
+# while the pass goes on and retried once it is done - attempts times,
+# with a jittered exponential wait starting at delay seconds, through
+# transfer(items), which runs fresh copies of them (usually with fewer
+# workers) and yields them back.
+#
+# retry() yields every held item once, in its final state - the caller
+# does its bookkeeping then, as for items of the main pass.  failed() adds
+# a final failure to the report, with the errors of all its attempts
+#
+class FailureQueue:
+
+    def __init__(self, attempts, delay, shouldStop, logger, name, isFailed, fresh):
+        self.attempts = attempts
+        self.delay = delay
+        self.shouldStop = shouldStop
+        self.logger = logger
+        self.name = name            # item -> its object name
+        self.isFailed = isFailed    # item -> did it fail
+        self.fresh = fresh          # item -> new item to try again
+        self.pending = list()
+        self.errors = dict()        # name -> error class of each attempt
+        self.recovered = 0
+        self.failures = list()
+
+    # hold a failed item - True when it will be retried
+    def hold(self, item):
+        self.errors.setdefault(self.name(item), list()).append(item.error or "unknown")
+        if (self.attempts <= 0 or self.shouldStop() or not isRetryable(item.error)):
+            return False
+        self.pending.append(item)
+        return True
+
+    def retry(self, transfer):
+        attempt = 0
+        while (len(self.pending) > 0):
+            items = self.pending
+            self.pending = list()
+            attempt += 1
+            if (not self.wait(attempt)):
+                for item in items:
+                    yield item
+                return
+
+            self.logger.info("retrying [{}] failed transfers - attempt [{}/{}]".format(
+                    len(items), attempt, self.attempts))
+            for item in transfer([self.fresh(item) for item in items]):
+                if (not self.isFailed(item)):
+                    self.recovered += 1
+                    yield item
+                elif (attempt >= self.attempts or not self.hold(item)):
+                    if (attempt >= self.attempts):
+                        self.errors[self.name(item)].append(item.error or "unknown")
+                    yield item
+
+    # sleep before an attempt - False when the run was stopped
+    def wait(self, attempt):
+        seconds = random.uniform(0.5, 1) * self.delay * 2 ** (attempt - 1)
+        end = time.time() + seconds
+        while (time.time() < end):
+            if (self.shouldStop()):
+                return False
+            time.sleep(min(0.25, end - time.time()))
+        return not self.shouldStop()
+
+    # a transfer that failed for good
+    def failed(self, name, path, error, errors=None):
+        errors = errors or self.errors.get(name) or [error or "unknown"]
+        self.failures.append({"name": name, "path": path, "error": errors[-1],
+                              "attempts": len(errors), "errors": errors,
+                              "retryable": isRetryable(errors[-1])})
+
+
+#
+# failure queue from the retry settings of a config section
+#
+def failureQueue(config, section, shouldStop, logger, name, isFailed, fresh):
+    prefix = section.lower()
+    return FailureQueue(config.getint(section, prefix + '.retry_attempts', fallback=3),
+                        config.getfloat(section, prefix + '.retry_delay_seconds', fallback=5),
+                        shouldStop, logger, name, isFailed, fresh)
+
+
+#
+# write the failures of a run as json to <log.failure_report_dir>/<kind>-failures.json
+# the file is replaced for every run, so it always describes the last one.
+# listError is the error class of a scan / listing that broke off - the
+# files after it were never tried, so the run is a partial one.
+# returns the exit status of the run
+#
+def writeFailureReport(config, kind, labels, failures, stopped, logger, listError=None):
+    status = EXIT_OK
+    if (stopped):
+        status = EXIT_STOPPED
+    elif (len(failures.failures) > 0 or listError is not None):
+        status = EXIT_PARTIAL
+
+    reportDir = config.get('LOG', 'log.failure_report_dir', fallback='./logs')
+    if (not reportDir):
+        return status
+    report = dict(labels)
+    report.update({"kind": kind, "finished": time.strftime("%Y-%m-%dT%H:%M:%S"), "stopped": stopped,
+                   "exit_status": status, "list_error": listError, "recovered": failures.recovered,
+                   "failed": len(failures.failures), "failures": failures.failures})
+    try:
+        os.makedirs(reportDir, exist_ok=True)
+        target = os.path.join(reportDir, "{}-failures.json".format(kind))
+        fd, tmpName = tempfile.mkstemp(dir=reportDir, prefix=".{}-failures-".format(kind), suffix=".tmp")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(report, f, indent=1)
+        os.replace(tmpName, target)
+    except OSError as err:
+        logger.error("ERROR: FAILURE_REPORT_ERROR [{}] [{}]".format(reportDir, err))
+    return status
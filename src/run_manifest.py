@@ -0,0 +1,92 @@
+import io
+import gzip
+import json
+import time
+
+from minio.error import NoSuchKey
+
+# object every finished backup run writes into its folder
+RUN_MANIFEST_NAME = ".backup-manifest.json.gz"
+VERSION = 1
+
+
+#
+# name of the run manifest object of an s3 folder (already in s3 form)
+#
+def runManifestName(prefix):
+    return prefix.rstrip("/") + "/" + RUN_MANIFEST_NAME
+
+
+def isRunManifest(objName):
+    return objName == RUN_MANIFEST_NAME or objName.endswith("/" + RUN_MANIFEST_NAME)
+
+
+#
+# the objects a backup run left in its folder - one record per object with
+# the file it holds, its size, sha256 and etag and how it was stored.  the
+# manifest is written gzipped into the folder once the run has finished
+# without failures, so a restore can plan its downloads from one GET
+# instead of listing the folder.
+#
+# add() is only called from the thread that collects finished items
+#
+class RunManifest:
+
+    def __init__(self, prefix, mode):
+        self.prefix = prefix.rstrip("/") + "/"
+        self.mode = mode
+        self.objects = list()
+
+    # one object - path and mtime are those of the file it holds, codec is
+    # None when not known.  pack objects list the [name, mtime] of their
+    # files instead
+    def add(self, objName, size, etag, path="", sha256="", encrypted=False, codec=None, mtime=None,
+            files=None):
+        record = {"key": objName, "path": path, "size": size, "sha256": sha256, "etag": etag,
+                  "encrypted": encrypted, "codec": codec, "mtime": mtime}
+        if (files is not None):
+            record["files"] = files
+        self.objects.append(record)
+
+    def data(self):
+        body = {"version": VERSION, "prefix": self.prefix, "mode": self.mode,
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "objects": self.objects}
+        return gzip.compress(json.dumps(body, separators=(",", ":")).encode("utf8"))
+
+    # returns (size, etag) of the manifest object
+    def write(self, s3Client, s3Bkt):
+        data = self.data()
+        etag = s3Client.put_object(s3Bkt, runManifestName(self.prefix), io.BytesIO(data), len(data),
+                content_type="application/gzip")
+        return len(data), etag
+
+
+#
+# remove the run manifest of a folder - a run that does not finish must
+# not leave a manifest behind that no longer matches the folder
+#
+def removeRunManifest(s3Client, s3Bkt, prefix):
+    try:
+        s3Client.remove_object(s3Bkt, runManifestName(prefix))
+    except NoSuchKey:
+        pass
+
+
+#
+# the object records of the run manifest in a folder, or None when the
+# folder has none (written by an older version, or the last run did not
+# finish) or it can not be read
+#
+def loadRunManifest(s3Client, s3Bkt, prefix):
+    try:
+        response = s3Client.get_object(s3Bkt, runManifestName(prefix))
+    except NoSuchKey:
+        return None
+    try:
+        body = json.loads(gzip.decompress(response.read()).decode("utf8"))
+    finally:
+        response.close()
+        response.release_conn()
+    if (body.get("version") != VERSION or body.get("prefix") != prefix.rstrip("/") + "/"):
+        return None
+    return body["objects"]
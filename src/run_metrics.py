@@ -0,0 +1,236 @@
+import os
+import json
+import re
+import math
+import time
+import socket
+import tempfile
+import threading
+import timeit
+import urllib3
+
+# quantiles reported for per-file latency
+QUANTILES = (0.5, 0.9, 0.99, 1.0)
+
+
+#
+# urllib3 pool manager that counts the requests it sends per http method.
+# retries urllib3 does on its own are part of the same request.
+#
+class CountingPoolManager(urllib3.PoolManager):
+
+    def __init__(self, *args, **kwargs):
+        urllib3.PoolManager.__init__(self, *args, **kwargs)
+        self.countLock = threading.Lock()
+        self.requestCounts = dict()
+
+    def urlopen(self, method, url, *args, **kwargs):
+        with self.countLock:
+            self.requestCounts[method] = self.requestCounts.get(method, 0) + 1
+        return urllib3.PoolManager.urlopen(self, method, url, *args, **kwargs)
+
+    def counts(self):
+        with self.countLock:
+            return dict(self.requestCounts)
+
+
+#
+# thread safe count of the part / range retries done for one file
+#
+class RetryCount:
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def add(self):
+        with self.lock:
+            self.value += 1
+
+
+#
+# read() wrapper that adds up the time spent reading the wrapped file
+#
+class TimedReader:
+
+    def __init__(self, f):
+        self.f = f
+        self.seconds = 0.0
+
+    def read(self, n=-1):
+        start = timeit.default_timer()
+        try:
+            return self.f.read(n)
+        finally:
+            self.seconds += timeit.default_timer() - start
+
+
+#
+# write() wrapper that adds up the time spent writing to the wrapped file
+#
+class TimedWriter:
+
+    def __init__(self, f):
+        self.f = f
+        self.seconds = 0.0
+
+    def write(self, data):
+        start = timeit.default_timer()
+        try:
+            return self.f.write(data)
+        finally:
+            self.seconds += timeit.default_timer() - start
+
+
+#
+# nearest-rank quantile of a sorted list
+#
+def quantile(values, q):
+    if (len(values) == 0):
+        return 0.0
+    index = max(0, min(len(values) - 1, math.ceil(q * len(values)) - 1))
+    return values[index]
+
+
+#
+# structured metrics for one backup or restore run.  per-file records and
+# a run summary are appended as json lines to jsonlPath; the summary is
+# also written as a prometheus textfile-collector file in textfileDir.
+# either output is off when its path is empty.  record() is only called
+# from the thread that consumes the pipeline results.
+#
+class RunMetrics:
+
+    def __init__(self, kind, jsonlPath, textfileDir, labels):
+        self.kind = kind
+        self.jsonlPath = jsonlPath
+        self.textfileDir = textfileDir
+        self.labels = dict(labels)
+        self.labels["kind"] = kind
+        self.labels["host"] = socket.gethostname()
+        self.runId = "{}-{}".format(kind, time.strftime("%Y%m%dT%H%M%S"))
+        self.start = time.time()
+        self.files = 0
+        self.bytes = 0
+        self.failed = 0
+        self.skipped = 0
+        self.copied = 0
+        self.retries = 0
+        self.latencies = list()
+        self.out = None
+        if (jsonlPath):
+            d = os.path.dirname(jsonlPath)
+            if (d):
+                os.makedirs(d, exist_ok=True)
+            self.out = open(jsonlPath, 'a')
+
+    # one file / object.  status is ok, copied (server side - no bytes
+    # transferred), failed or skipped
+    def record(self, name, status, size=0, seconds=0.0, retries=0, **timings):
+        if (status == "ok"):
+            self.files += 1
+            self.bytes += size
+            self.latencies.append(seconds)
+        elif (status == "copied"):
+            self.files += 1
+            self.copied += 1
+            self.latencies.append(seconds)
+        elif (status == "failed"):
+            self.failed += 1
+        else:
+            self.skipped += 1
+        self.retries += retries
+
+        if (self.out is not None):
+            rec = {"type": "file", "run": self.runId, "kind": self.kind, "time": round(time.time(), 3),
+                   "name": name, "status": status, "bytes": size, "seconds": round(seconds, 4),
+                   "retries": retries}
+            for key, value in timings.items():
+                rec[key] = round(value, 4)
+            self.out.write(json.dumps(rec) + "\n")
+
+    # write the run summary - requests is a {method: count} dict
+    def finish(self, requests=None, stopped=False):
+        duration = max(time.time() - self.start, 1e-6)
+        latencies = sorted(self.latencies)
+        requests = requests or {}
+        summary = {
+            "type": "run", "run": self.runId, "kind": self.kind, "time": round(time.time(), 3),
+            "labels": self.labels, "stopped": stopped,
+            "files": self.files, "bytes": self.bytes, "failed": self.failed, "skipped": self.skipped,
+            "copied": self.copied,
+            "retries": self.retries, "seconds": round(duration, 3),
+            "files_per_s": round(self.files / duration, 2),
+            "mb_per_s": round(self.bytes / (1024 * 1024) / duration, 3),
+            "latency_s": {"p{}".format(int(q * 100)): round(quantile(latencies, q), 4) for q in QUANTILES},
+            "requests": requests,
+        }
+
+        if (self.out is not None):
+            self.out.write(json.dumps(summary) + "\n")
+            self.out.close()
+            self.out = None
+        if (self.textfileDir):
+            self.writeTextfile(summary, latencies)
+        return summary
+
+    def writeTextfile(self, summary, latencies):
+        labels = ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in sorted(self.labels.items()))
+        prefix = "s3_backup_client_run_"
+        lines = list()
+
+        def metric(name, kind, help, value, extra=""):
+            lines.append("# HELP {}{} {}".format(prefix, name, help))
+            lines.append("# TYPE {}{} {}".format(prefix, name, kind))
+            lines.append("{}{}{{{}{}}} {}".format(prefix, name, labels, extra, value))
+
+        metric("files", "gauge", "files transferred by the last run", summary["files"])
+        metric("bytes", "gauge", "bytes transferred by the last run", summary["bytes"])
+        metric("failed_files", "gauge", "files that failed in the last run", summary["failed"])
+        metric("skipped_files", "gauge", "files skipped by the last run", summary["skipped"])
+        metric("copied_files", "gauge", "files copied server side by the last run", summary["copied"])
+        metric("retries", "gauge", "part / range retries in the last run", summary["retries"])
+        metric("duration_seconds", "gauge", "duration of the last run", summary["seconds"])
+        metric("throughput_bytes_per_second", "gauge", "throughput of the last run",
+               round(summary["bytes"] / max(summary["seconds"], 1e-6), 1))
+        metric("stopped", "gauge", "1 if the last run was stopped", int(summary["stopped"]))
+        metric("end_timestamp_seconds", "gauge", "end time of the last run", summary["time"])
+
+        lines.append("# HELP {}file_latency_seconds per-file latency in the last run".format(prefix))
+        lines.append("# TYPE {}file_latency_seconds summary".format(prefix))
+        for q in QUANTILES:
+            lines.append('{}file_latency_seconds{{{},quantile="{}"}} {}'.format(prefix, labels, q, quantile(latencies, q)))
+        lines.append("{}file_latency_seconds_sum{{{}}} {}".format(prefix, labels, round(sum(latencies), 4)))
+        lines.append("{}file_latency_seconds_count{{{}}} {}".format(prefix, labels, len(latencies)))
+
+        lines.append("# HELP {}requests s3 requests sent by the last run".format(prefix))
+        lines.append("# TYPE {}requests gauge".format(prefix))
+        for method, count in sorted(summary["requests"].items()):
+            lines.append('{}requests{{{},method="{}"}} {}'.format(prefix, labels, method, count))
+
+        # write to a temp file and rename so the collector never sees a partial file
+        os.makedirs(self.textfileDir, exist_ok=True)
+        target = os.path.join(self.textfileDir, textfileName(self.kind, self.labels))
+        fd, tmpName = tempfile.mkstemp(dir=self.textfileDir, prefix=".s3_backup_client-", suffix=".tmp")
+        with os.fdopen(fd, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmpName, target)
+
+
+#
+# textfile of a job - one per kind, bucket and folder, so scheduled jobs
+# on one host do not replace each other's metrics
+#
+def textfileName(kind, labels):
+    name = "s3_backup_client_{}_{}_{}".format(kind, labels.get("bucket", ""), labels.get("folder", ""))
+    return re.sub(r'[^A-Za-z0-9._-]+', '_', name) + ".prom"
+
+
+#
+# metrics for a run from the [LOG] config section
+#
+def runMetrics(config, kind, labels):
+    jsonlPath = config.get('LOG', 'log.metrics_jsonl', fallback='')
+    textfileDir = config.get('LOG', 'log.metrics_textfile_dir', fallback='')
+    return RunMetrics(kind, jsonlPath, textfileDir, labels)
@@ -0,0 +1,107 @@
+import ssl
+import socket
+import threading
+import urllib3
+import certifi                          # default ca bundle (minio dependency)
+from urllib3.connection import HTTPConnection
+from urllib3.util.ssl_ import create_urllib3_context
+
+from run_metrics import CountingPoolManager
+from adaptive import BackoffRetry, PacedPoolManager, TokenBucket
+
+# statuses retried with backoff - throttling and server errors
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+# smallest connection pool - enough for listings and the gui
+MIN_POOL_SIZE = 10
+
+# tcp keep-alive on every connection, so idle pooled connections are not
+# silently dropped by firewalls / load balancers between runs
+KEEPALIVE_OPTIONS = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+
+
+#
+# http transport shared by every s3 client of the process - one urllib3
+# pool manager with persistent (keep-alive) connections, one tls context
+# that has loaded the ca certs once, connect / read timeouts and retries
+# with jittered exponential backoff.
+#
+# backups, restores and the gui bucket list of one process all go through
+# it, so a new run reuses the open connections of the last one instead of
+# paying for new tcp and tls handshakes.  the backoff callback is that of
+# the run in progress
+#
+class S3Transport:
+
+    def __init__(self, config, poolSize):
+        self.poolSize = max(poolSize, MIN_POOL_SIZE)
+        self.onBackoff = None
+        self.http = None
+        self.clients = dict()       # s3 clients bound to this pool - see connectToS3
+
+        caCert = config.get('S3', 's3.ssl_cacert', fallback='') or certifi.where()
+        poolArgs = dict(
+                timeout=urllib3.Timeout(
+                    connect=config.getfloat('S3', 's3.connect_timeout_seconds', fallback=10),
+                    read=config.getfloat('S3', 's3.read_timeout_seconds', fallback=300)),
+                maxsize=self.poolSize,
+                cert_reqs='CERT_REQUIRED',
+                socket_options=HTTPConnection.default_socket_options + KEEPALIVE_OPTIONS,
+                retries=BackoffRetry(
+                    total=config.getint('S3', 's3.retries', fallback=5),
+                    backoff_factor=config.getfloat('S3', 's3.retry_backoff_seconds', fallback=0.5),
+                    status_forcelist=RETRY_STATUS,
+                    onBackoff=self.backoff,
+                    maxBackoff=config.getfloat('S3', 's3.retry_max_backoff_seconds', fallback=20)
+                )
+        )
+
+        # load the ca certs once for all connections - a cert that can not
+        # be read is left to urllib3, so connections fail as before
+        try:
+            context = create_urllib3_context(cert_reqs=ssl.CERT_REQUIRED)
+            context.load_verify_locations(cafile=caCert)
+            poolArgs["ssl_context"] = context
+        except (OSError, ssl.SSLError) as err:
+            print("ERROR: could not load ca cert [{}] [{}]".format(caCert, err))
+            poolArgs["ca_certs"] = caCert
+
+        # optional bandwidth cap shared by all connections
+        maxBandwidth = config.getfloat('S3', 's3.max_bandwidth_mb', fallback=0)
+        if (maxBandwidth > 0):
+            self.http = PacedPoolManager(TokenBucket(maxBandwidth * 1024 * 1024), **poolArgs)
+        else:
+            self.http = CountingPoolManager(**poolArgs)
+
+    # called by the retry policy for every throttled or failed request
+    def backoff(self):
+        onBackoff = self.onBackoff
+        if (onBackoff is not None):
+            onBackoff()
+
+    def close(self):
+        self.http.clear()
+
+
+_lock = threading.Lock()
+_transports = dict()
+
+
+#
+# the shared transport for the s3 settings of config.  a pool smaller than
+# poolSize is replaced by a bigger one for the runs that start from now on.
+# the old one is not closed - a run in progress (a gui backup next to a
+# restore) may still be using it.  it goes away with its clients once the
+# last of them is dropped
+#
+def sharedTransport(config, poolSize=0):
+    key = tuple(config.get('S3', name, fallback='') for name in (
+            's3.server', 's3.ssl_cacert', 's3.max_bandwidth_mb', 's3.connect_timeout_seconds',
+            's3.read_timeout_seconds', 's3.retries', 's3.retry_backoff_seconds',
+            's3.retry_max_backoff_seconds'))
+    with _lock:
+        transport = _transports.get(key)
+        if (transport is None or transport.poolSize < poolSize):
+            transport = S3Transport(config, poolSize)
+            _transports[key] = transport
+        return transport
@@ -0,0 +1,90 @@
+import time
+import threading
+
+# prefix of the snapshot folders under a backup folder
+SNAPSHOT_PREFIX = "snap-"
+
+
+#
+# name of a new snapshot - sorts by time.  taken are the snapshots that
+# already exist - a name in it gets a -2, -3 ... suffix
+#
+def newSnapshotId(taken=()):
+    now = time.time()
+    snapshotId = "{}{}-{:03d}".format(SNAPSHOT_PREFIX, time.strftime("%Y%m%d-%H%M%S", time.localtime(now)),
+                                      int(now * 1000) % 1000)
+    name = snapshotId
+    n = 1
+    while (name in taken):
+        n += 1
+        name = "{}-{}".format(snapshotId, n)
+    return name
+
+
+#
+# snapshot folders under folder, oldest first
+#
+def listSnapshots(s3Client, s3Bkt, folder):
+    prefix = folder.rstrip("/") + "/"
+    names = list()
+    for obj in s3Client.list_objects(s3Bkt, prefix=prefix + SNAPSHOT_PREFIX):
+        if (obj.is_dir):
+            names.append(obj.object_name[len(prefix):].rstrip("/"))
+    return sorted(names)
+
+
+#
+# objects in the bucket that hold a given content (sha256) in snapshot
+# mode, so identical content is copied server side instead of uploaded.
+#
+# known content comes from the snapshot manifest (earlier snapshots) and
+# from files finished in this run.  the first file of a run with a new
+# content claims it and uploads it - files with the same content that
+# come along while it uploads wait for it and then copy its object.
+#
+class ContentIndex:
+
+    def __init__(self, manifest, encrypted):
+        self.manifest = manifest
+        self.encrypted = encrypted
+        self.lock = threading.Lock()
+        self.claims = dict()        # sha256 -> [Event, object name or None]
+
+    # only objects with the same encryption can be copied
+    def usable(self, objName):
+        return objName is not None and objName.endswith(".enc") == self.encrypted
+
+    # returns (object to copy, owner).  the object is None when the caller
+    # has to upload the content itself - owner is True when it then has to
+    # call resolve
+    def claim(self, sha256, shouldStop):
+        with self.lock:
+            claim = self.claims.get(sha256)
+            if (claim is None):
+                for objName in self.manifest.findHash(sha256):
+                    if (self.usable(objName)):
+                        claim = [threading.Event(), objName]
+                        claim[0].set()
+                        self.claims[sha256] = claim
+                        return objName, False
+                self.claims[sha256] = [threading.Event(), None]
+                return None, True
+
+        # another file with this content is uploading - wait for it
+        while (not claim[0].wait(0.25)):
+            if (shouldStop()):
+                return None, False
+        # None when its upload failed - this one is uploaded instead
+        return claim[1], False
+
+    # the upload of content sha256 claimed by the caller finished - objName
+    # is None when it failed
+    def resolve(self, sha256, objName):
+        with self.lock:
+            claim = self.claims.get(sha256)
+            if (claim is None or claim[0].is_set()):
+                return
+            if (objName is None):
+                del self.claims[sha256]
+            claim[1] = objName
+        claim[0].set()
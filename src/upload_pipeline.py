@@ -0,0 +1,210 @@
+import threading
+import timeit                           # for per-file timing
+from queue import Queue
+
+from retry_queue import errorClass
+
+#
+# one file moving through the backup pipeline
+#
+class BackupItem:
+
+    def __init__(self, inputFile, relPath, s3Name):
+        self.inputFile = inputFile
+        self.relPath = relPath
+        self.s3Name = s3Name
+        self.size = 0
+        self.mtime = 0
+        self.sha256 = ""
+        self.entry = None           # previous manifest entry (incremental mode)
+        self.data = None            # buffered (possibly encrypted) payload
+        self.stream = False         # encrypted straight into a multipart upload
+        self.uploadFile = None      # encrypted spool file uploaded instead of inputFile
+        self.uploadSize = 0         # size of uploadFile
+        self.codec = ""             # compression codec, "" when sent as is
+        self.packed = False         # small file sent inside a pack object (pack mode)
+        self.copySource = None      # object copied server side instead of uploading (snapshot mode)
+        self.contentOwner = False   # first file of the run with its content (snapshot mode)
+        self.holdBytes = 0          # bytes charged against the in-flight budget
+        self.partSize = 0           # multipart part size picked for the file
+        self.skipped = False        # unchanged or stopped - nothing uploaded
+        self.unchanged = False      # skipped because it matches the manifest
+        self.resumed = False        # skipped because the interrupted run uploaded it
+        self.etag = None            # set once the upload succeeded
+        self.objectSize = 0         # size of the object written
+        self.sentBytes = 0          # new chunk bytes uploaded (dedup mode)
+        self.failed = False         # could not be read or uploaded
+        self.error = ""             # class of the error that made it fail
+        self.retries = 0            # part retries
+        self.inspectTime = 0        # stat / hash / sample
+        self.readTime = 0           # reading the source file
+        self.encodeTime = 0         # compressing / encrypting
+        self.uploadTime = 0         # sending to s3
+        self.startTime = 0
+        self.runTime = 0
+
+
+#
+# limits the number of bytes buffered between the read and upload stages.
+# a single item bigger than the whole budget is let through on its own
+# so it can never dead lock the pipeline.
+#
+class ByteBudget:
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.inFlight = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, n, shouldStop):
+        with self.cond:
+            while (self.inFlight > 0 and self.inFlight + n > self.maxBytes):
+                if (shouldStop()):
+                    return False
+                self.cond.wait(0.25)
+            self.inFlight += n
+            return True
+
+    def release(self, n):
+        with self.cond:
+            self.inFlight -= n
+            self.cond.notify_all()
+
+
+#
+# staged backup pipeline
+#   scan    - one thread walks the source and queues BackupItems
+#   prepare - worker threads stat / hash / read / encrypt
+#   upload  - worker threads send the prepared items to s3
+# finished items are handed back to the caller in completion order so
+# the caller can keep all bookkeeping (manifest, logging, gui queue) on
+# one thread.
+#
+# inspect(item), load(item) and upload(item) are supplied by the caller.
+# inspect sets item.skipped for items that need no upload and
+# item.holdBytes for the bytes load is about to buffer.  load only runs
+# once those bytes fit in the in-flight budget.
+# prepareWorkers raises the number of prepare threads above workers -
+# for loads that mostly wait on other processes (the crypto pool).
+#
+class UploadPipeline:
+
+    def __init__(self, workers, maxInflightBytes, shouldStop, logger, prepareWorkers=0):
+        self.workers = max(1, workers)
+        self.prepareWorkers = max(self.workers, prepareWorkers)
+        self.budget = ByteBudget(maxInflightBytes)
+        self.shouldStop = shouldStop
+        self.logger = logger
+        self.scanError = None       # error class when the scan broke off
+
+    def run(self, items, inspect, load, upload):
+        scanQ = Queue(maxsize=self.prepareWorkers * 4)
+        uploadQ = Queue(maxsize=self.workers * 2)
+        resultQ = Queue()
+        self.prepareLeft = self.prepareWorkers
+        self.uploadLeft = self.workers
+        self.lock = threading.Lock()
+
+        threads = [threading.Thread(target=self._scan, args=(items, scanQ), daemon=True)]
+        for i in range(self.prepareWorkers):
+            threads.append(threading.Thread(target=self._prepare,
+                    args=(inspect, load, scanQ, uploadQ), daemon=True))
+        for i in range(self.workers):
+            threads.append(threading.Thread(target=self._upload,
+                    args=(upload, uploadQ, resultQ), daemon=True))
+        for t in threads:
+            t.start()
+
+        while True:
+            item = resultQ.get()
+            if (item is None):
+                break
+            yield item
+
+        for t in threads:
+            t.join()
+
+    # stage 1 - feed the scan queue
+    def _scan(self, items, scanQ):
+        try:
+            for item in items:
+                if (self.shouldStop()):
+                    print("stop flag found - stop scanning")
+                    break
+                scanQ.put(item)
+        except Exception as err:
+            self.scanError = errorClass(err)
+            self.logger.error("ERROR: SCAN_ERROR [{}]".format(err))
+        finally:
+            for i in range(self.prepareWorkers):
+                scanQ.put(None)
+
+    # stage 2 - read / encrypt
+    def _prepare(self, inspect, load, scanQ, uploadQ):
+        while True:
+            item = scanQ.get()
+            if (item is None):
+                break
+
+            item.startTime = timeit.default_timer()
+            acquired = False
+            try:
+                if (self.shouldStop()):
+                    item.skipped = True
+                else:
+                    inspect(item)
+
+                # wait for room in the budget before buffering anything
+                if (not item.skipped):
+                    acquired = self.budget.acquire(item.holdBytes, self.shouldStop)
+                    if (acquired):
+                        load(item)
+                    else:
+                        item.skipped = True
+            except Exception as err:
+                self.logger.error("ERROR: FILE_READ_ERROR [{}] [{}]".format(item.inputFile, err))
+                item.error = errorClass(err)
+                item.skipped = True
+                item.failed = True
+
+            if (item.skipped):
+                item.data = None
+                if (acquired):
+                    self.budget.release(item.holdBytes)
+                item.holdBytes = 0
+
+            uploadQ.put(item)
+
+        with self.lock:
+            self.prepareLeft -= 1
+            last = (self.prepareLeft == 0)
+        if (last):
+            for i in range(self.workers):
+                uploadQ.put(None)
+
+    # stage 3 - upload
+    def _upload(self, upload, uploadQ, resultQ):
+        while True:
+            item = uploadQ.get()
+            if (item is None):
+                break
+
+            if (not item.skipped):
+                try:
+                    if (not self.shouldStop()):
+                        upload(item)
+                except Exception as err:
+                    self.logger.error("ERROR: FILE_UPLOAD_ERROR [{}] [{}]".format(item.s3Name, err))
+                    item.error = errorClass(err)
+                finally:
+                    item.data = None
+                    self.budget.release(item.holdBytes)
+
+            item.runTime = round(timeit.default_timer() - item.startTime, 2)
+            resultQ.put(item)
+
+        with self.lock:
+            self.uploadLeft -= 1
+            last = (self.uploadLeft == 0)
+        if (last):
+            resultQ.put(None)
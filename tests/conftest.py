@@ -0,0 +1,94 @@
+#
+# shared fixtures - the client modules from src/ and the in-memory s3
+# stand-in from bench/ on loopback
+#
+import os
+import sys
+import logging
+import configparser
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, "src"))
+sys.path.insert(0, os.path.join(REPO_DIR, "bench"))
+
+
+@pytest.fixture(scope="session")
+def s3Server():
+    import fake_s3
+    server = fake_s3.start()
+    yield server
+    server.shutdown()
+
+
+#
+# empty bucket on the stand-in
+#
+@pytest.fixture
+def s3Store(s3Server):
+    s3Server.store.buckets.clear()
+    s3Server.store.uploads.clear()
+    return s3Server.store
+
+
+#
+# client config pointing at the stand-in, with every file the client
+# writes kept under tmp_path.  settings is {"section.key": value}
+#
+@pytest.fixture
+def makeConfig(s3Server, tmp_path):
+
+    def make(settings=None):
+        config = configparser.ConfigParser()
+        config.read_dict({
+            "DEFAULT": {"file.encryption_password": "testpassword"},
+            "LOG": {"log.report_interval": "1000000",
+                    "log.metrics_jsonl": "",
+                    "log.failure_report_dir": str(tmp_path / "logs")},
+            "S3": {"s3.server": "127.0.0.1:{}".format(s3Server.server_address[1]),
+                   "s3.access_key": "test",
+                   "s3.secret_key": "testsecret",
+                   "s3.ssl_cacert": "",
+                   "s3.bucket_name": "test-bkt",
+                   "s3.secure": "false",
+                   "s3.object_index_dir": str(tmp_path / "index")},
+            "BACKUP": {"backup.manifest_dir": str(tmp_path / "manifests"),
+                       "backup.checkpoint_dir": str(tmp_path / "checkpoints"),
+                       "backup.retry_delay_seconds": "0.01"},
+            "RESTORE": {"restore.retry_delay_seconds": "0.01"},
+        })
+        for key, value in (settings or {}).items():
+            config[key.split(".")[0].upper()][key] = str(value)
+        return config
+
+    return make
+
+
+@pytest.fixture
+def logger():
+    return logging.getLogger("tests")
+
+
+#
+# write {relative path: bytes} under root
+#
+def writeTree(root, files):
+    for name, data in files.items():
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+
+#
+# {relative path: bytes} of every file under root
+#
+def readTree(root):
+    files = dict()
+    for r, d, f in os.walk(root):
+        for name in f:
+            path = os.path.join(r, name)
+            with open(path, 'rb') as fh:
+                files[os.path.relpath(path, root).replace(os.sep, "/")] = fh.read()
+    return files
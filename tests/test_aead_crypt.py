@@ -0,0 +1,123 @@
+import io
+import os
+
+import pytest
+import pyAesCrypt
+
+import aead_crypt
+from aead_crypt import (EncryptionKey, AeadError, RangeDecryptor, decryptAny, decryptBytes, encryptedSize,
+                        HEADER_SIZE, TAG_SIZE)
+
+PASSWORD = "testpassword"
+CHUNK = 64
+
+
+# small chunks and a cheap kdf, so a few hundred bytes span many chunks
+def newKey(password=PASSWORD):
+    return EncryptionKey(password, chunkSize=CHUNK, iterations=1000)
+
+
+def decrypt(data, password=PASSWORD):
+    out = io.BytesIO()
+    decryptAny(io.BytesIO(data), out, password, len(data))
+    return out.getvalue()
+
+
+def chunkAt(data, index):
+    start = HEADER_SIZE + index * (CHUNK + TAG_SIZE)
+    return start, start + CHUNK + TAG_SIZE
+
+
+@pytest.mark.parametrize("size", [0, 1, CHUNK - 1, CHUNK, CHUNK + 1, 5 * CHUNK, 5 * CHUNK + 7])
+def test_round_trip(size):
+    plain = os.urandom(size)
+    data = newKey().encryptBytes(plain)
+    assert data[:len(aead_crypt.MAGIC)] == aead_crypt.MAGIC
+    assert len(data) == encryptedSize(size, CHUNK)
+    assert decrypt(data) == plain
+
+
+def test_files_of_one_run_get_their_own_salt():
+    key = newKey()
+    plain = os.urandom(3 * CHUNK)
+    first = key.encryptBytes(plain)
+    second = key.encryptBytes(plain)
+    assert first != second
+    assert decrypt(first) == decrypt(second) == plain
+
+
+def test_aes_crypt_objects_still_decrypt():
+    plain = os.urandom(1000)
+    out = io.BytesIO()
+    pyAesCrypt.encryptStream(io.BytesIO(plain), out, PASSWORD, 64 * 1024)
+    assert decryptBytes(out.getvalue(), PASSWORD) == plain
+
+
+def test_wrong_password_is_rejected():
+    data = newKey().encryptBytes(os.urandom(3 * CHUNK))
+    with pytest.raises(AeadError):
+        decrypt(data, "otherpassword")
+
+
+@pytest.mark.parametrize("cut", [1, TAG_SIZE, CHUNK + TAG_SIZE, 2 * (CHUNK + TAG_SIZE)])
+def test_truncation_is_rejected(cut):
+    data = newKey().encryptBytes(os.urandom(4 * CHUNK + 10))
+    with pytest.raises(AeadError):
+        decrypt(data[:-cut])
+
+
+def test_truncated_header_is_rejected():
+    data = newKey().encryptBytes(os.urandom(CHUNK))
+    with pytest.raises(AeadError):
+        decrypt(data[:HEADER_SIZE - 1])
+
+
+def test_appended_chunk_is_rejected():
+    data = newKey().encryptBytes(os.urandom(3 * CHUNK))
+    start, end = chunkAt(data, 1)
+    with pytest.raises(AeadError):
+        decrypt(data + data[start:end])
+
+
+def test_reordered_chunks_are_rejected():
+    data = newKey().encryptBytes(os.urandom(4 * CHUNK))
+    a = chunkAt(data, 1)
+    b = chunkAt(data, 2)
+    swapped = data[:a[0]] + data[b[0]:b[1]] + data[a[0]:a[1]] + data[b[1]:]
+    assert len(swapped) == len(data)
+    with pytest.raises(AeadError):
+        decrypt(swapped)
+
+
+def test_chunk_from_another_file_is_rejected():
+    key = newKey()
+    plain = os.urandom(3 * CHUNK)
+    first = key.encryptBytes(plain)
+    second = key.encryptBytes(plain)
+    start, end = chunkAt(first, 1)
+    with pytest.raises(AeadError):
+        decrypt(first[:start] + second[start:end] + first[end:])
+
+
+@pytest.mark.parametrize("offset", [10, HEADER_SIZE - 1, HEADER_SIZE, HEADER_SIZE + CHUNK + 3, -1])
+def test_tampering_is_rejected(offset):
+    data = bytearray(newKey().encryptBytes(os.urandom(3 * CHUNK)))
+    data[offset] ^= 0x01
+    with pytest.raises(AeadError):
+        decrypt(bytes(data))
+
+
+def test_ranges_decrypt_on_their_own():
+    plain = os.urandom(7 * CHUNK + 9)
+    data = newKey().encryptBytes(plain)
+    decryptor = RangeDecryptor(data[:HEADER_SIZE], PASSWORD, len(data))
+    rangeSize = decryptor.rangeSize(2 * (CHUNK + TAG_SIZE) + 5)
+    assert rangeSize == 2 * (CHUNK + TAG_SIZE)
+
+    out = bytearray(decryptor.outputSize)
+    for offset in reversed(range(HEADER_SIZE, len(data), rangeSize)):
+        part = data[offset:offset + rangeSize]
+        at, text = decryptor.decode(offset, part)
+        assert len(text) == decryptor.outputLength(offset, len(part))
+        out[at:at + len(text)] = text
+    assert bytes(out) == plain
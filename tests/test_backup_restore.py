@@ -0,0 +1,169 @@
+import os
+import queue
+import shutil
+
+import pytest
+
+import backup_util
+from retry_queue import EXIT_OK, EXIT_PARTIAL
+from multipart_upload import newMultipartUpload
+from conftest import writeTree, readTree
+
+MB = 1024 * 1024
+
+# small files, a duplicate, a compressible one and one big enough for a
+# multipart upload and a ranged download
+FILES = {
+    "a.txt": b"hello world\n",
+    "empty.txt": b"",
+    "docs/report.txt": b"backup restore " * 5000,
+    "docs/copy.txt": b"backup restore " * 5000,
+    "data/random.bin": os.urandom(200 * 1024),
+    "data/big.bin": os.urandom(11 * MB),
+}
+
+# small thresholds so multipart uploads, streamed encryption, ranged
+# downloads, packs and chunking all run on a small tree
+SETTINGS = {
+    "backup.multipart_threshold_mb": 6,
+    "backup.stream_threshold_mb": 6,
+    "backup.part_size_mb": 5,
+    "backup.chunk_min_kb": 64,
+    "backup.chunk_avg_kb": 256,
+    "backup.chunk_max_kb": 1024,
+    "restore.ranged_threshold_mb": 6,
+    "restore.range_size_mb": 5,
+}
+
+
+@pytest.fixture(autouse=True)
+def runFlags():
+    backup_util.stopFlag = False
+    yield
+    backup_util.stopFlag = False
+
+
+def backup(config, logger, source, mode, encrypt, folder="job"):
+    return backup_util.doBackup(str(source), folder, queue.Queue(), config, logger, False,
+                                1 if encrypt else 0, "", mode, 2)
+
+
+def restore(config, logger, target, folder="job"):
+    return backup_util.doRestore(str(target), folder, queue.Queue(), config, logger, False, "", 2)
+
+
+def snapshotFolder(store):
+    names = set(name.split("/")[1] for name in store.buckets["test-bkt"] if name.startswith("job/snap-"))
+    return "job/" + max(names)
+
+
+# encryption format, or None for a plain backup
+@pytest.mark.parametrize("encryptionFormat", [None, "aescrypt", "aead"], ids=["plain", "aescrypt", "aead"])
+@pytest.mark.parametrize("mode", ["full", "incremental", "dedup", "pack", "mirror", "snapshot"])
+def test_backup_and_restore(s3Store, makeConfig, logger, tmp_path, mode, encryptionFormat):
+    config = makeConfig(dict(SETTINGS, **{"backup.encryption_format": encryptionFormat or "aescrypt"}))
+    source = tmp_path / "source"
+    writeTree(source, FILES)
+
+    assert backup(config, logger, source, mode, encryptionFormat is not None) == EXIT_OK
+    folder = snapshotFolder(s3Store) if mode == "snapshot" else "job"
+    assert restore(config, logger, tmp_path / "restore", folder) == EXIT_OK
+    assert readTree(tmp_path / "restore" / folder) == FILES
+
+
+@pytest.mark.parametrize("mode", ["incremental", "dedup", "mirror", "snapshot"])
+def test_second_backup_picks_up_changes(s3Store, makeConfig, logger, tmp_path, mode):
+    config = makeConfig(SETTINGS)
+    source = tmp_path / "source"
+    writeTree(source, FILES)
+    assert backup(config, logger, source, mode, False) == EXIT_OK
+
+    files = dict(FILES)
+    del files["docs/copy.txt"]
+    os.remove(source / "docs" / "copy.txt")
+    files["a.txt"] = b"changed\n"
+    files["new/file.txt"] = b"new file\n"
+    writeTree(source, {"a.txt": files["a.txt"], "new/file.txt": files["new/file.txt"]})
+    assert backup(config, logger, source, mode, False) == EXIT_OK
+
+    folder = snapshotFolder(s3Store) if mode == "snapshot" else "job"
+    assert restore(config, logger, tmp_path / "restore", folder) == EXIT_OK
+    assert readTree(tmp_path / "restore" / folder) == files
+
+
+#
+# the wipe of a full backup and the abort of leftover multipart uploads
+# only touch the folder of the job - not job2/ next to job/
+#
+def test_backup_cleanup_stays_in_its_folder(s3Store, makeConfig, logger, tmp_path):
+    config = makeConfig(SETTINGS)
+    source = tmp_path / "source"
+    writeTree(source, {"a.txt": b"a"})
+    backup(config, logger, source, "full", False, folder="job2")
+    s3Client = backup_util.connectToS3(config)
+    newMultipartUpload(s3Client, "test-bkt", "job2/in-progress.bin", {})
+    newMultipartUpload(s3Client, "test-bkt", "top/sub/in-progress.bin", {})
+
+    backup(config, logger, source, "full", False, folder="job")
+    backup(config, logger, source, "full", False, folder="top\\sub")
+    assert any(name.startswith("job2/") for name in s3Store.buckets["test-bkt"])
+    assert sorted(u["key"] for u in s3Store.uploads.values()) == ["job2/in-progress.bin"]
+
+
+#
+# a restore with a failure leaves its journal behind - a rerun into a
+# wiped restore dir has to restore everything again, not just the failure
+#
+def test_restore_journal_after_wiped_target(s3Store, makeConfig, logger, tmp_path, monkeypatch):
+    config = makeConfig(dict(SETTINGS, **{"restore.retry_attempts": 0}))
+    source = tmp_path / "source"
+    writeTree(source, FILES)
+    assert backup(config, logger, source, "full", False) == EXIT_OK
+
+    fetchObject = backup_util.fetchObject
+
+    def failing(s3Client, s3Bkt, item, *args, **kwargs):
+        if (item.objName.endswith("a.txt")):
+            item.error = "TestError"
+            return
+        return fetchObject(s3Client, s3Bkt, item, *args, **kwargs)
+
+    target = tmp_path / "restore"
+    monkeypatch.setattr(backup_util, "fetchObject", failing)
+    assert restore(config, logger, target) == EXIT_PARTIAL
+    assert os.listdir(tmp_path / "checkpoints")
+    monkeypatch.setattr(backup_util, "fetchObject", fetchObject)
+
+    shutil.rmtree(target)
+    assert restore(config, logger, target) == EXIT_OK
+    assert readTree(target / "job") == FILES
+    assert os.listdir(tmp_path / "checkpoints") == []
+
+
+#
+# a stopped backup leaves its journal behind and the next run completes it
+#
+def test_backup_resumes_after_stop(s3Store, makeConfig, logger, tmp_path, monkeypatch):
+    config = makeConfig(SETTINGS)
+    source = tmp_path / "source"
+    writeTree(source, FILES)
+
+    putBackupItem = backup_util.putBackupItem
+    calls = [0]
+
+    def stopping(*args, **kwargs):
+        calls[0] += 1
+        if (calls[0] == 2):
+            backup_util.stopFlag = True
+        return putBackupItem(*args, **kwargs)
+
+    monkeypatch.setattr(backup_util, "putBackupItem", stopping)
+    backup(config, logger, source, "full", False)
+    assert os.listdir(tmp_path / "checkpoints")
+    monkeypatch.setattr(backup_util, "putBackupItem", putBackupItem)
+
+    backup_util.stopFlag = False
+    assert backup(config, logger, source, "full", False) == EXIT_OK
+    assert os.listdir(tmp_path / "checkpoints") == []
+    assert restore(config, logger, tmp_path / "restore") == EXIT_OK
+    assert readTree(tmp_path / "restore" / "job") == FILES
@@ -0,0 +1,42 @@
+import io
+import os
+import random
+
+import pytest
+
+import chunk_store
+from chunk_store import Chunker
+
+
+def cutPoints(chunker, data):
+    return [len(chunk) for chunk in chunker.chunks(io.BytesIO(data))]
+
+
+@pytest.mark.parametrize("sizes", [(64, 256, 1024), (2048, 8192, 65536), (64 * 1024, 256 * 1024, 1024 * 1024)])
+def test_numpy_cuts_where_the_loop_does(sizes):
+    if (chunk_store.numpy is None):
+        pytest.skip("numpy is not installed")
+    rnd = random.Random(1)
+    text = b" ".join(rnd.choice([b"backup", b"restore", b"chunk", b"\n"]) for i in range(200000))
+    for data in (os.urandom(3 * 1024 * 1024), text, b"\0" * (sizes[2] * 3 + 5)):
+        fast = Chunker(*sizes)
+        slow = Chunker(*sizes)
+        slow.gear = None
+        assert cutPoints(fast, data) == cutPoints(slow, data)
+
+
+def test_chunks_stay_within_bounds_and_rebuild_the_data():
+    chunker = Chunker(2048, 8192, 65536)
+    data = os.urandom(1024 * 1024)
+    chunks = list(chunker.chunks(io.BytesIO(data)))
+    assert b"".join(chunks) == data
+    assert all(2048 < len(chunk) <= 65536 for chunk in chunks[:-1])
+
+
+def test_an_edit_only_changes_nearby_chunks():
+    chunker = Chunker(2048, 8192, 65536)
+    data = bytearray(os.urandom(1024 * 1024))
+    before = set(chunker.chunks(io.BytesIO(bytes(data))))
+    data[500000:500010] = b"x" * 10
+    after = set(chunker.chunks(io.BytesIO(bytes(data))))
+    assert len(after - before) <= 3